@@ -0,0 +1,58 @@
+import concurrent.futures
+import threading
+import time
+
+
+def idle_dispatch(function, *args):
+    from gi.repository import GLib
+
+    def call():
+        function(*args)
+        return False
+    GLib.idle_add(call)
+
+
+class BackgroundTasks:
+    """Запросы к серверу из окон GTK без блокировки главного цикла
+
+    Функции выполняются в пуле потоков, callback(result, error, duration)
+    вызывается через dispatch, по умолчанию в главном цикле GLib.
+    """
+    def __init__(self, max_workers=4, dispatch=None):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers,
+                                                              thread_name_prefix="kismon-task")
+        self.dispatch = dispatch or idle_dispatch
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def submit(self, callback, function, *args):
+        def run():
+            start = time.monotonic()
+            result = None
+            error = None
+            try:
+                result = function(*args)
+            except Exception as e:
+                error = e
+            duration = time.monotonic() - start
+            self.dispatch(finish, result, error, duration)
+
+        def finish(result, error, duration):
+            with self.lock:
+                self.pending -= 1
+            if not self.closed:
+                callback(result, error, duration)
+
+        with self.lock:
+            self.pending += 1
+        return self.executor.submit(run)
+
+    def is_busy(self):
+        return self.pending > 0
+
+    def shutdown(self):
+        """Результаты незавершённых задач после закрытия окна отбрасываются
+        """
+        self.closed = True
+        self.executor.shutdown(wait=False)
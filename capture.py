@@ -0,0 +1,50 @@
+import gzip
+import json
+import threading
+import time
+
+
+class CaptureWriter:
+    """Запись ответов Kismet в сжатый файл JSON lines
+
+    Первая строка сеанса - заголовок, далее [время от начала сеанса,
+    очередь, данные]. Повторный запуск дописывает новый сеанс в конец.
+    """
+    def __init__(self, path, uri):
+        self.path = path
+        self.file = gzip.open(path, 'at', encoding='utf-8')
+        self.start = time.monotonic()
+        self.lock = threading.Lock()
+        self.closed = False
+        self.records = 0
+        self.file.write(json.dumps({'capture': 1, 'uri': uri, 'start': time.time()}) + '\n')
+
+    def write(self, name, data):
+        line = json.dumps([round(time.monotonic() - self.start, 3), name, data], separators=(',', ':'))
+        with self.lock:
+            if self.closed:
+                return
+            self.file.write(line + '\n')
+            self.records += 1
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.file.close()
+
+
+def read_capture(path):
+    """Записи (время, очередь, данные), сеансы следуют друг за другом без пауз
+    """
+    offset = 0.0
+    last = 0.0
+    with gzip.open(path, 'rt', encoding='utf-8') as capture_file:
+        for line in capture_file:
+            record = json.loads(line)
+            if type(record) == dict:
+                offset = last
+                continue
+            last = offset + record[0]
+            yield last, record[1], record[2]
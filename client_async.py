@@ -0,0 +1,449 @@
+import asyncio
+import functools
+import json
+import threading
+import time
+import zlib
+from urllib.parse import urlparse, urlencode
+
+from kismon.client_rest import JsonStreamDecoder, ClientHandle
+
+
+class AsyncHttpError(Exception):
+    def __init__(self, message, rcode=None):
+        Exception.__init__(self, message)
+        self.rcode = rcode
+
+
+class AsyncHttpResponse:
+    def __init__(self, pool, connection, status, headers):
+        self.pool = pool
+        self.connection = connection
+        self.status = status
+        self.headers = headers
+        self.complete = False
+        self.received = 0
+        self.keep_alive = headers.get('connection', '').lower() != 'close'
+        encoding = headers.get('content-encoding', '')
+        if encoding == 'gzip':
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            self.decompressor = zlib.decompressobj()
+        else:
+            self.decompressor = None
+
+    def _decode(self, data):
+        if self.decompressor is None:
+            return data
+        return self.decompressor.decompress(data)
+
+    async def _raw_chunks(self):
+        reader = self.connection.reader
+        read = self.connection.read
+        if self.headers.get('transfer-encoding', '').lower() == 'chunked':
+            while True:
+                line = await read(reader.readline())
+                size = int(line.split(b';')[0].strip(), 16)
+                if size == 0:
+                    # skip the trailer
+                    while (await read(reader.readline())) not in (b'\r\n', b'\n', b''):
+                        pass
+                    return
+                data = await read(reader.readexactly(size))
+                await read(reader.readexactly(2))
+                yield data
+        elif 'content-length' in self.headers:
+            remaining = int(self.headers['content-length'])
+            while remaining > 0:
+                data = await read(reader.read(min(remaining, 65536)))
+                if not data:
+                    raise AsyncHttpError("соединение закрыто")
+                remaining -= len(data)
+                yield data
+        else:
+            self.keep_alive = False
+            while True:
+                data = await read(reader.read(65536))
+                if not data:
+                    return
+                yield data
+
+    async def iter_chunks(self):
+        async for data in self._raw_chunks():
+            self.received += len(data)
+            data = self._decode(data)
+            if data:
+                yield data
+        if self.decompressor is not None:
+            data = self.decompressor.flush()
+            if data:
+                yield data
+        self.complete = True
+
+    async def read(self):
+        try:
+            return b"".join([chunk async for chunk in self.iter_chunks()])
+        finally:
+            self.release()
+
+    def release(self):
+        """Вернуть соединение в пул, недочитанное соединение закрывается
+        """
+        if self.connection is None:
+            return
+        if self.complete and self.keep_alive:
+            self.pool.idle.append(self.connection)
+        else:
+            self.connection.close()
+        self.connection = None
+
+
+class AsyncHttpConnection:
+    def __init__(self, host, port, ssl, timeout):
+        self.host = host
+        self.port = port
+        self.ssl = ssl
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port, ssl=self.ssl), self.timeout)
+
+    async def read(self, coroutine):
+        return await asyncio.wait_for(coroutine, self.timeout)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+class AsyncHttpPool:
+    """Неблокирующий клиент HTTP/1.1 для одного сервера Kismet
+
+    Соединения keep-alive переиспользуются, параллельные запросы
+    разных точек API получают отдельные соединения.
+    """
+    def __init__(self, uri, headers=None, timeout=30):
+        parsed = urlparse(uri)
+        self.host = parsed.hostname
+        if parsed.scheme == "https":
+            import ssl
+            self.ssl = ssl.create_default_context()
+            self.port = parsed.port or 443
+        else:
+            self.ssl = None
+            self.port = parsed.port or 80
+        self.base_path = parsed.path.rstrip("/")
+        self.headers = headers or {}
+        self.timeout = timeout
+        self.idle = []
+        self.stats = {
+            'requests': 0,
+            'connections': 0,
+            'responses': 0,
+            'compressed': 0,
+        }
+
+    async def get_connection(self):
+        if self.idle:
+            return self.idle.pop()
+        connection = AsyncHttpConnection(self.host, self.port, self.ssl, self.timeout)
+        await connection.connect()
+        self.stats['connections'] += 1
+        return connection
+
+    async def request(self, method, path, data=None):
+        """Отправить запрос и прочитать заголовки ответа,
+        тело читается через read() или iter_chunks() + release()
+        """
+        reused = len(self.idle) > 0
+        connection = await self.get_connection()
+        try:
+            return await self._request(connection, method, path, data)
+        except (OSError, AsyncHttpError):
+            if not reused:
+                raise
+        # the server closed the idle keep-alive connection in the meantime
+        return await self._request(await self.get_connection(), method, path, data)
+
+    async def _request(self, connection, method, path, data):
+        lines = [
+            "%s %s/%s HTTP/1.1" % (method, self.base_path, path.lstrip("/")),
+            "Host: %s:%s" % (self.host, self.port),
+            "Accept-Encoding: gzip, deflate",
+            "Connection: keep-alive",
+        ]
+        for name in self.headers:
+            lines.append("%s: %s" % (name, self.headers[name]))
+        body = b""
+        if data is not None:
+            body = urlencode(data).encode()
+            lines.append("Content-Type: application/x-www-form-urlencoded")
+            lines.append("Content-Length: %s" % len(body))
+        try:
+            connection.writer.write(("\r\n".join(lines) + "\r\n\r\n").encode() + body)
+            await connection.read(connection.writer.drain())
+            status_line = (await connection.read(connection.reader.readline())).decode("latin-1")
+            if status_line == "":
+                raise AsyncHttpError("соединение закрыто")
+            headers = {}
+            while True:
+                line = (await connection.read(connection.reader.readline())).decode("latin-1").strip()
+                if line == "":
+                    break
+                name, _, value = line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+        except BaseException:
+            connection.close()
+            raise
+        self.stats['requests'] += 1
+        self.stats['responses'] += 1
+        if headers.get('content-encoding', '') in ('gzip', 'deflate'):
+            self.stats['compressed'] += 1
+        return AsyncHttpResponse(self, connection, int(status_line.split(" ")[1]), headers)
+
+    def close(self):
+        for connection in self.idle:
+            connection.close()
+        self.idle = []
+
+
+async def fetch_json(client, pool, endpoint, path, payload=None):
+    start = time.monotonic()
+    try:
+        if payload is None:
+            response = await pool.request("GET", path)
+        else:
+            response = await pool.request("POST", path, {'json': json.dumps(payload)})
+        if response.status != 200:
+            response.release()
+            raise AsyncHttpError("Request failed %s %s" % (path, response.status), response.status)
+        body = await response.read()
+        received = time.monotonic()
+        data = json.loads(body.decode('utf-8'))
+        decoded = time.monotonic()
+    except Exception:
+        client.metrics.record_error(endpoint)
+        raise
+    if type(data) == list:
+        count = len(data)
+    else:
+        count = 1
+    client.metrics.record(endpoint, decoded - start, response.received, count, decoded - received)
+    return data
+
+
+async def fetch_device_page(client, pool, queue_depth):
+    url, payload, device_filter, sync = client.get_device_page_request()
+    try:
+        data = await fetch_json(client, pool, 'smart_device_list', url, payload)
+    except AsyncHttpError as e:
+        if not client.disable_paging(e):
+            raise
+        return await fetch_devices(client, pool)
+    delta = client.handle_device_page(data, device_filter, sync)
+    client.update_device_interval(delta, queue_depth)
+    return delta
+
+
+async def fetch_devices(client, pool):
+    queue_depth = len(client.queue['dot11'])
+    if client.is_initial_sync():
+        if queue_depth >= client.page_size:
+            return 0
+        return await fetch_device_page(client, pool, queue_depth)
+    url, payload, device_filter, sync = client.get_devices_request()
+    start = time.monotonic()
+    decode = 0.0
+    handling = 0.0
+    count = 0
+    delta = 0
+    try:
+        response = await pool.request("POST", url, {'json': json.dumps(payload)})
+    except Exception:
+        client.metrics.record_error('smart_device_list')
+        raise
+    sync.begin()
+    try:
+        if response.status != 200:
+            error = "Request failed %s %s" % (url, response.status)
+            if client.disable_phy_view(device_filter, delta, error):
+                sync.rollback()
+                response.release()
+                return await fetch_devices(client, pool)
+            raise AsyncHttpError(error)
+        decoder = JsonStreamDecoder()
+        async for chunk in response.iter_chunks():
+            decode_start = time.monotonic()
+            devices = decoder.feed(chunk)
+            handling_start = time.monotonic()
+            decode += handling_start - decode_start
+            for device in devices:
+                count += 1
+                if client.handle_device(device, device_filter, sync):
+                    delta += 1
+            handling += time.monotonic() - handling_start
+        decoder.close()
+    except Exception:
+        sync.rollback()
+        client.metrics.record_error('smart_device_list')
+        raise
+    finally:
+        response.release()
+    sync.commit()
+    client.finish_device_sync()
+    client.metrics.record('smart_device_list', time.monotonic() - start - handling, response.received, count, decode)
+    client.update_device_interval(delta, queue_depth)
+    return delta
+
+
+async def fetch_system_status(client, pool):
+    try:
+        status = await fetch_json(client, pool, 'system_status', "system/status.json",
+                                  {'fields': client.status_fields})
+    except (OSError, ValueError, asyncio.TimeoutError, AsyncHttpError) as e:
+        client.set_connection_error(e)
+        return False
+    client.handle_system_status(status)
+    return True
+
+
+async def fetch_location(client, pool):
+    if not client.authenticated:
+        return False
+    client.put('location', await fetch_json(client, pool, 'location', "gps/location.json"))
+
+
+async def fetch_messages(client, pool):
+    client.handle_messages(await fetch_json(client, pool, 'messages', client.get_messages_url()))
+
+
+async def fetch_datasources(client, pool):
+    client.handle_datasources(await fetch_json(client, pool, 'datasources', "datasource/all_sources.json",
+                                               {'fields': client.datasource_fields}))
+
+
+async def fetch_signal_sources(client, pool):
+    request = client.get_signal_request()
+    if request is None:
+        return
+    client.handle_signal_sources(await fetch_json(client, pool, 'signal', *request))
+
+
+class AsyncClientEngine(threading.Thread):
+    """Один поток с циклом asyncio для всех серверов Kismet
+
+    Каждый сервер опрашивается сопрограммами вместо отдельных потоков,
+    данные попадают в те же очереди RestClient, что читает Core.
+    """
+    fetch_functions = {
+        'devices': fetch_devices,
+        'status': fetch_system_status,
+        'location': fetch_location,
+        'messages': fetch_messages,
+        'datasources': fetch_datasources,
+        'signal': fetch_signal_sources,
+    }
+
+    def __init__(self, logger):
+        threading.Thread.__init__(self, name="kismon-async", daemon=True)
+        self.logger = logger
+        self.loop = asyncio.new_event_loop()
+        self.lock = threading.Lock()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+        self.loop.close()
+
+    def ensure_running(self):
+        with self.lock:
+            if not self.is_alive():
+                self.start()
+
+    def stop(self):
+        if self.is_alive():
+            asyncio.run_coroutine_threadsafe(self.shutdown(), self.loop)
+            self.join(5)
+
+    async def shutdown(self):
+        # let the clients close their connections before the loop ends
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.loop.stop()
+
+    def start_client(self, handle):
+        self.ensure_running()
+        return asyncio.run_coroutine_threadsafe(self.run_client(handle), self.loop)
+
+    async def run_client(self, handle):
+        client = handle.client
+        pool = AsyncHttpPool(client.uri)
+        client.http_pool = pool
+        functions = {}
+        for name in self.fetch_functions:
+            functions[name] = functools.partial(self.fetch_functions[name], client, pool)
+        try:
+            while handle.is_running is True:
+                handle.breaker.attempt()
+                # connecting and the login still use the blocking connector
+                started = await self.loop.run_in_executor(None, client.try_start)
+                if started is not False:
+                    handle.breaker.record_success()
+                    pool.headers = client.get_auth_headers()
+                    if not handle.schedules:
+                        handle.schedules = client.get_schedules(functions)
+                    if client.push:
+                        client.start_push()
+                    await asyncio.gather(*[self.run_schedule(handle, schedule)
+                                           for schedule in handle.schedules.values()])
+                    client.stop_push()
+                    pool.close()
+                if handle.is_running is not True:
+                    break
+                delay = handle.get_reconnect_delay()
+                if delay is None:
+                    break
+                await asyncio.sleep(delay)
+        finally:
+            pool.close()
+            handle.finish()
+
+    async def run_schedule(self, handle, schedule):
+        while handle.is_running is True and handle.client.connected is True:
+            wait = schedule.get_next_run() - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            if schedule.enabled:
+                await schedule.run_async()
+            else:
+                schedule.last_start = time.monotonic()
+
+
+class AsyncClientHandle(ClientHandle):
+    """Замена RestClientThread для AsyncClientEngine с тем же интерфейсом
+    """
+    def __init__(self, engine, logger, uri=None):
+        ClientHandle.__init__(self, logger=logger, uri=uri)
+        self.engine = engine
+        self.future = None
+
+    def start(self):
+        self.is_running = True
+        self.client.error = []
+        self.future = self.engine.start_client(self)
+
+    def stop(self):
+        if self.future is not None:
+            self.future.cancel()
+        self.finish()
+
+    def finish(self):
+        self.is_running = None
+        self.client.stop()
@@ -28,9 +28,21 @@ ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 POSSIBILITY OF SUCH DAMAGE.
 """
 
+import collections
 import threading
 import time
+import base64
+import random
+import codecs
+import re
+import simplejson as json
 import requests
+from requests.adapters import HTTPAdapter
+
+from kismon.capture import CaptureWriter, read_capture
+from kismon.client_stream import EventStream
+from kismon.metrics import ClientMetrics
+from kismon.ringqueue import RingQueue
 
 try:
     # since Kismet 2019-05-R1
@@ -48,27 +60,188 @@ class RestClient:
         self.connected = False
         self.authenticated = False
         self.credentials = None
-        self.timestamp = {
-            'devices': 0,
-            'messages': 0,
+        self.push = False
+        self.streams = []
+        self.schedules = {}
+        self.sync = {
+            'devices': SyncWindow(),
+            'messages': SyncWindow(),
+        }
+        self.sync_filter = None
+        # the last valid server filter and the invalid one that was reported already
+        self.device_filter = None
+        self.invalid_filter = None
+        # True once a full device list arrived, the event stream only sends changes
+        self.devices_synced = False
+        self.http_pool = None
+        self.capture_path = None
+        self.capture = None
+        self.metrics = ClientMetrics()
+        self.datasource_state = {}
+        self.datasource_count = None
+        # initial sync in pages of page_size devices, 0 fetches everything at once
+        self.page_size = 500
+        self.page_interval = 0.1
+        self.initial_sync = None
+        self.clock_offset = None
+        self.intervals = {
+            'devices': 1,
+            'status': 1,
+            'location': 0.25,
+            'messages': 1,
+            'datasources': 10,
+            'signal': 1,
         }
+        self.adaptive = None
+        self.server_filter = None
+        self.phy_view = True
+        self.device_fields = [
+            'dot11.device',
+            'kismet.device.base.channel',
+            'kismet.device.base.crypt',
+            'kismet.device.base.first_time',
+            'kismet.device.base.key',
+            'kismet.device.base.last_time',
+            'kismet.device.base.location',
+            'kismet.device.base.macaddr',
+            'kismet.device.base.manuf',
+            'kismet.device.base.signal/kismet.common.signal.last_signal',
+            'kismet.device.base.signal/kismet.common.signal.min_signal',
+            'kismet.device.base.signal/kismet.common.signal.max_signal',
+            'kismet.device.base.signal/kismet.common.signal.type',
+        ]
+        # only what the GUI shows, the full records carry channel lists and RRD vectors
+        self.datasource_fields = [
+            'kismet.datasource.uuid',
+            'kismet.datasource.name',
+            'kismet.datasource.hardware',
+            'kismet.datasource.num_packets',
+            'kismet.datasource.channel',
+            'kismet.datasource.hopping',
+            'kismet.datasource.hop_rate',
+            'kismet.datasource.running',
+        ]
+        # per source signals, only requested for devices with an open signal graph
+        self.signal_fields = [
+            'kismet.device.base.macaddr',
+            'kismet.device.base.seenby',
+        ]
+        self.signal_subscriptions = SignalSubscriptions()
+        # set by Core to wake up the GTK main loop
+        self.wakeup = None
+        self.status_fields = [
+            'kismet.system.devices.count',
+            'kismet.system.timestamp.sec',
+            'kismet.system.timestamp.usec',
+        ]
         self.queue = {}
-        self.empty_queue()
+        self.configure_queue(50000, 'coalesce')
         self.error = []
+        self.init_session()
 
-    def empty_queue(self):
+    def init_session(self):
+        """Одна сессия с пулом keep-alive соединений для всех точек API
+        """
+        self.session = requests.Session()
+        self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=8)
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+        self.session.headers['Accept-Encoding'] = 'gzip, deflate'
+        self.session.hooks['response'].append(self._count_response)
+        self.http_stats = {
+            'responses': 0,
+            'compressed': 0,
+        }
+
+    def _count_response(self, response, *args, **kwargs):
+        self.http_stats['responses'] += 1
+        if response.headers.get('Content-Encoding', '') in ('gzip', 'deflate'):
+            self.http_stats['compressed'] += 1
+
+    def get_connection_stats(self):
+        stats = {
+            'requests': 0,
+            'connections': 0,
+            'responses': self.http_stats['responses'],
+            'compressed': self.http_stats['compressed'],
+        }
+        for key in self.adapter.poolmanager.pools.keys():
+            pool = self.adapter.poolmanager.pools.get(key)
+            if pool is None:
+                continue
+            stats['requests'] += pool.num_requests
+            stats['connections'] += pool.num_connections
+        if self.http_pool is not None:
+            # polling done by the asyncio engine
+            for key in ('requests', 'connections', 'responses', 'compressed'):
+                stats[key] += self.http_pool.stats[key]
+        if stats['requests'] > 0:
+            stats['reuse'] = 1 - stats['connections'] / stats['requests']
+        else:
+            stats['reuse'] = 0.0
+        stats['clock_offset'] = self.clock_offset
+        return stats
+
+    def configure_queue(self, size, overflow):
         self.queue = {
-            'dot11': [],
+            'dot11': RingQueue(size, overflow=overflow, key=get_device_key, merge=merge_device_updates),
             'status': None,
-            'location': [],
-            'messages': [],
-            'datasources': {},
+            'location': RingQueue(1000),
+            'messages': RingQueue(1000),
+            'datasources': RingQueue(256, overflow='coalesce', key=get_datasource_key),
+            'signal': RingQueue(1000),
         }
 
+    def empty_queue(self):
+        # cleared in place, the consumer may hold a reference to the queues
+        for name in ('dot11', 'location', 'messages', 'datasources', 'signal'):
+            self.queue[name].clear()
+        self.queue['status'] = None
+
+    def close_queue(self, closed=True):
+        for name in ('dot11', 'location', 'messages', 'datasources', 'signal'):
+            if closed:
+                self.queue[name].close()
+            else:
+                self.queue[name].open()
+
+    def put(self, name, data):
+        """Передать ответ точки API в очередь Core
+        """
+        if self.capture is not None:
+            self.capture.write(name, data)
+        if name == 'dot11':
+            # flattened here, in the client worker, the GTK thread only merges
+            data = normalize_device(data, self.logger)
+            if data is None:
+                return
+        if isinstance(self.queue[name], RingQueue):
+            self.queue[name].append(data)
+        else:
+            self.queue[name] = data
+        if self.wakeup is not None:
+            self.wakeup.signal()
+
+    def load_queue(self, data):
+        for name in data:
+            if isinstance(self.queue.get(name), RingQueue):
+                for item in data[name]:
+                    self.put(name, item)
+            else:
+                self.queue[name] = data[name]
+
+    def get_queue_stats(self):
+        stats = {}
+        for name in self.queue:
+            if isinstance(self.queue[name], RingQueue):
+                stats[name] = self.queue[name].get_stats()
+        return stats
+
     def start(self):
         """Open connection to the server
         """
         self.logger.info("Клиент: запуск %s" % self.uri)
+        self.close_queue(False)
 
         if not self._simple_server_check():
             self.connected = False
@@ -76,21 +249,41 @@ class RestClient:
 
         sessioncache_path = "~/.kismon/kismet-session-%s" % ''.join(e if e.isalnum() else '-' for e in self.uri)
         self.connector = KismetRest.KismetConnector(self.uri, sessioncache_path=sessioncache_path)
+        # the connector loaded the cached session cookie, all calls share our session
+        self.session.cookies.update(self.connector.session.cookies)
+        self.connector.session = self.session
         self.authenticate()
+        if self.capture_path is not None and self.capture is None:
+            self.capture = CaptureWriter(self.capture_path, self.uri)
         if not self.update_system_status():
             return False
         self.connected = True
 
+    def try_start(self):
+        """start, обрыв связи во время подключения даёт False вместо исключения
+        """
+        try:
+            return self.start()
+        except Exception as e:
+            self.set_connection_error(e)
+            return False
+
     def stop(self):
         """Close connection to the server
         """
         self.logger.info("Клиент: остановка %s" % self.uri)
         self.connected = False
+        self.stop_push()
+        # producers blocked on a full queue must not wait forever
+        self.close_queue()
+        if self.capture is not None:
+            self.capture.close()
+            self.capture = None
 
     def _simple_server_check(self):
         error_str = '%s не доступен или не правильно введён адрес \nОшибка: %s'
         try:
-            response = requests.get("%s/system/timestamp.json" % (self.uri))
+            response = self.session.get("%s/system/timestamp.json" % (self.uri))
         except requests.exceptions.RequestException as e:
             if 'reason' in dir(e.args[0]):
                 message = error_str % (self.uri, e.args[0].reason)
@@ -100,6 +293,10 @@ class RestClient:
             self.error.append(message)
             return False
         if response.status_code == 200:
+            try:
+                self.update_clock_offset(response.json())
+            except ValueError:
+                pass
             return True
         elif response.status_code == 401:
             return True
@@ -110,32 +307,257 @@ class RestClient:
 
     def _callback(self, device):
         # print(device['dot11.device']['dot11.device.last_beaconed_ssid'])
-        self.queue['dot11'].append(device)
+        self.put('dot11', device)
 
     def get_updated_devices(self, queue_list=None):
-        fields = [
-            'dot11.device',
-            'kismet.device.base.channel',
-            'kismet.device.base.crypt',
-            'kismet.device.base.first_time',
-            'kismet.device.base.key',
-            'kismet.device.base.last_time',
-            'kismet.device.base.location',
-            'kismet.device.base.macaddr',
-            'kismet.device.base.manuf',
-            'kismet.device.base.seenby',
-            'kismet.device.base.signal/kismet.common.signal.last_signal',
-            'kismet.device.base.signal/kismet.common.signal.min_signal',
-            'kismet.device.base.signal/kismet.common.signal.max_signal',
-            'kismet.device.base.signal/kismet.common.signal.type',
-        ]
         if queue_list:
             self.queue = queue_list
 
-        new_timestamp = time.time()
-        time_diff = int(self.timestamp['devices'] - new_timestamp - 1)
-        self.connector.smart_device_list(callback=self._callback, fields=fields, ts=time_diff)
-        self.timestamp['devices'] = new_timestamp
+        queue_depth = len(self.queue['dot11'])
+        if self.is_initial_sync():
+            if queue_depth >= self.page_size:
+                # the GUI did not catch up with the last page yet
+                return 0
+            url, payload, device_filter, sync = self.get_device_page_request()
+            try:
+                data = self.request_json('smart_device_list', url, payload)
+            except KismetRest.KismetRequestException as e:
+                if not self.disable_paging(e):
+                    raise
+                return self.get_updated_devices()
+            delta = self.handle_device_page(data, device_filter, sync)
+            self.update_device_interval(delta, queue_depth)
+            return delta
+
+        url, payload, device_filter, sync = self.get_devices_request()
+        delta = 0
+        sync.begin()
+        try:
+            for device in self.stream_request(url, payload):
+                if self.handle_device(device, device_filter, sync):
+                    delta += 1
+        except KismetRest.KismetRequestException as e:
+            sync.rollback()
+            if not self.disable_phy_view(device_filter, delta, e):
+                raise
+            return self.get_updated_devices()
+        except Exception:
+            sync.rollback()
+            raise
+        sync.commit()
+        self.finish_device_sync()
+        self.update_device_interval(delta, queue_depth)
+        return delta
+
+    def get_device_filter(self):
+        device_filter = None
+        if self.server_filter is not None and self.server_filter['enabled']:
+            try:
+                device_filter = DeviceFilter(self.server_filter['ssid'], self.server_filter['bssid'])
+            except re.error as e:
+                # unfiltered would download every device, the last valid filter stays
+                invalid_filter = (self.server_filter['ssid'], self.server_filter['bssid'])
+                if invalid_filter != self.invalid_filter:
+                    self.invalid_filter = invalid_filter
+                    self.logger.error("Клиент: неверное выражение фильтра: %s" % e)
+                return self.device_filter
+
+        # a changed filter needs the devices that were filtered out until now
+        filter_key = None if device_filter is None else device_filter.regex
+        if filter_key != self.sync_filter:
+            self.sync['devices'] = SyncWindow()
+            self.sync_filter = filter_key
+            self.initial_sync = None
+            self.devices_synced = False
+            if 'devices' in self.schedules:
+                self.schedules['devices'].enabled = True
+        self.device_filter = device_filter
+        return device_filter
+
+    def get_devices_request(self):
+        """URL и параметры запроса изменённых устройств
+        """
+        payload = {'fields': self.device_fields}
+        device_filter = self.get_device_filter()
+        if device_filter is not None and device_filter.regex:
+            payload['regex'] = device_filter.regex
+        sync = self.sync['devices']
+        # absolute server time, the one second overlap is removed by the sync window
+        if sync.high_water > 0:
+            ts = sync.high_water - 1
+        else:
+            ts = 1
+
+        if device_filter is not None and self.phy_view:
+            url = "devices/views/phy-IEEE802.11/last-time/%s/devices.itjson" % ts
+        else:
+            url = "devices/last-time/%s/devices.itjson" % ts
+        return url, payload, device_filter, sync
+
+    def is_initial_sync(self):
+        # done once the last page arrived, even if the server had no devices yet
+        return self.page_size > 0 and not self.devices_synced
+
+    def get_device_page_request(self):
+        """Следующая страница начальной загрузки, новые устройства первыми
+        """
+        url, payload, device_filter, sync = self.get_devices_request()
+        if self.initial_sync is None:
+            self.initial_sync = {'start': 0, 'total': None}
+        if device_filter is not None and self.phy_view:
+            view = 'phy-IEEE802.11'
+        else:
+            view = 'all'
+        payload['datatable'] = True
+        payload['start'] = self.initial_sync['start']
+        payload['length'] = self.page_size
+        payload['order[0][column]'] = self.device_fields.index('kismet.device.base.last_time')
+        payload['order[0][dir]'] = 'desc'
+        return "devices/views/%s/devices.json" % view, payload, device_filter, sync
+
+    def handle_device_page(self, data, device_filter, sync):
+        if type(data) == list:
+            # the server ignored the paging and sent everything
+            devices = data
+            total = len(data)
+        else:
+            devices = data.get('data', [])
+            total = data.get('recordsFiltered', data.get('recordsTotal'))
+        delta = 0
+        for device in devices:
+            if device_filter is not None and not device_filter.match(device):
+                continue
+            # pages are sorted by last_time, the window only moves forward
+            sync.advance(device['kismet.device.base.macaddr'], device['kismet.device.base.last_time'])
+            self._callback(device)
+            delta += 1
+
+        state = self.initial_sync
+        state['start'] += len(devices)
+        state['total'] = total
+        if type(data) == list or len(devices) < self.page_size or (total is not None and state['start'] >= total):
+            self.logger.info("Клиент: начальная загрузка завершена, устройств: %s" % state['start'])
+            self.initial_sync = None
+            self.finish_device_sync()
+        return delta
+
+    def disable_paging(self, error):
+        """True, если запрос нужно повторить без постраничной загрузки
+        """
+        if self.initial_sync is None or self.initial_sync['start'] > 0:
+            return False
+        if getattr(error, 'rcode', None) not in (400, 404):
+            # e.g. not logged in yet or a server error, left to the reconnect logic
+            return False
+        # Kismet without device views or datatable paging
+        self.logger.info("Клиент: постраничная загрузка недоступна (%s)" % error)
+        self.page_size = 0
+        self.initial_sync = None
+        return True
+
+    def get_sync_progress(self):
+        """(загружено, всего) во время начальной загрузки, иначе None
+        """
+        state = self.initial_sync
+        if state is None or state['total'] is None:
+            return None
+        return state['start'], state['total']
+
+    def handle_device(self, device, device_filter, sync):
+        if device_filter is not None and not device_filter.match(device):
+            return False
+        if not sync.accept(device['kismet.device.base.macaddr'], device['kismet.device.base.last_time']):
+            return False
+        self._callback(device)
+        return True
+
+    def disable_phy_view(self, device_filter, delta, error):
+        """True, если запрос нужно повторить без представления phy
+        """
+        if device_filter is None or not self.phy_view or delta > 0:
+            return False
+        # Kismet before 2019-09 has no per-phy device views
+        self.logger.info("Клиент: нет представления phy-IEEE802.11 (%s), фильтр только по regex" % error)
+        self.phy_view = False
+        return True
+
+    def update_device_interval(self, delta, queue_depth):
+        if 'devices' not in self.schedules:
+            return
+        schedule = self.schedules['devices']
+        if self.initial_sync is not None:
+            schedule.interval = self.page_interval
+            schedule.reason = "начальная загрузка: %s/%s" % (self.initial_sync['start'], self.initial_sync['total'])
+        elif self.adaptive is not None:
+            schedule.interval = self.adaptive.update(delta, queue_depth)
+            schedule.reason = self.adaptive.reason
+        else:
+            schedule.interval = self.intervals['devices']
+            schedule.reason = ''
+
+    def stream_request(self, url, payload, endpoint='smart_device_list'):
+        """Устройства передаются в очередь по мере получения данных,
+        в памяти находится только одна запись, а не весь ответ
+        """
+        full_url = "%s/%s" % (self.uri.rstrip('/'), url)
+        # only the time spent in here counts, not the processing of the caller
+        resumed = time.monotonic()
+        busy = 0.0
+        decode = 0.0
+        count = 0
+        try:
+            response = self.session.post(full_url, data={'json': json.dumps(payload)}, stream=True)
+        except Exception:
+            self.metrics.record_error(endpoint)
+            raise
+        try:
+            if response.status_code != 200:
+                raise KismetRest.KismetRequestException("Request failed %s %s" % (url, response.status_code),
+                                                        response.status_code)
+            decoder = JsonStreamDecoder()
+            for chunk in response.iter_content(chunk_size=65536):
+                decode_start = time.monotonic()
+                items = decoder.feed(chunk)
+                decode += time.monotonic() - decode_start
+                for item in items:
+                    count += 1
+                    busy += time.monotonic() - resumed
+                    yield item
+                    resumed = time.monotonic()
+            decoder.close()
+            busy += time.monotonic() - resumed
+        except Exception:
+            self.metrics.record_error(endpoint)
+            raise
+        finally:
+            response.close()
+        self.metrics.record(endpoint, busy, response.raw.tell(), count, decode)
+
+    def request_json(self, endpoint, url, payload=None):
+        """Запрос к API Kismet с записью времени, объёма и разбора ответа
+        """
+        full_url = "%s/%s" % (self.uri.rstrip('/'), url)
+        start = time.monotonic()
+        try:
+            if payload is None:
+                response = self.session.get(full_url)
+            else:
+                response = self.session.post(full_url, data={'json': json.dumps(payload)})
+            if response.status_code != 200:
+                raise KismetRest.KismetRequestException("Request failed %s %s" % (url, response.status_code),
+                                                        response.status_code)
+            received = time.monotonic()
+            data = json.loads(response.content.decode('utf-8'))
+            decoded = time.monotonic()
+        except Exception:
+            self.metrics.record_error(endpoint)
+            raise
+        if type(data) == list:
+            count = len(data)
+        else:
+            count = 1
+        self.metrics.record(endpoint, decoded - start, response.raw.tell(), count, decoded - received)
+        return data
 
     def loop(self):
         while self.connected is True:
@@ -151,35 +573,205 @@ class RestClient:
 
     def update_system_status(self):
         try:
-            status = self.connector.system_status()
+            status = self.request_json('system_status', "system/status.json", {'fields': self.status_fields})
         except Exception as e:
-            self.connected = False
-            self.logger.error("Клиент: ошибка подключения")
-            self.logger.error(e)
-            self.error.append("Ошибка подключение: %s" % e)
+            self.set_connection_error(e)
             return False
-        self.queue['status'] = status
+        self.handle_system_status(status)
         return True
 
+    def handle_system_status(self, status):
+        self.update_clock_offset(status)
+        self.put('status', status)
+
+    def set_connection_error(self, error):
+        self.connected = False
+        self.logger.error("Клиент: ошибка подключения")
+        self.logger.error(error)
+        self.error.append("Ошибка подключение: %s" % error)
+
+    def update_clock_offset(self, timestamp):
+        if 'kismet.system.timestamp.sec' not in timestamp:
+            return
+        server_time = timestamp['kismet.system.timestamp.sec'] + \
+            timestamp.get('kismet.system.timestamp.usec', 0) / 1000000
+        self.clock_offset = server_time - time.time()
+
+    def get_server_time(self):
+        """Текущее время по часам сервера Kismet
+        """
+        return time.time() + (self.clock_offset or 0)
+
     def update_location(self):
         if not self.authenticated:
             return False
-        self.queue['location'].append(self.connector.location())
+        self.put('location', self.request_json('location', "gps/location.json"))
 
     def queue_new_messages(self):
-        messages = self.connector.messages(ts_sec=self.timestamp['messages'])
-        self.timestamp['messages'] = int(time.time())
-        self.queue['messages'].extend(messages['kismet.messagebus.list'])
+        messages = self.request_json('messages', self.get_messages_url())
+        self.handle_messages(messages)
+
+    def get_messages_url(self):
+        return "messagebus/last-time/%s.0/messages.json" % max(0, self.sync['messages'].high_water - 1)
+
+    def handle_messages(self, messages):
+        sync = self.sync['messages']
+        sync.begin()
+        for message in messages['kismet.messagebus.list']:
+            if sync.accept(message['kismet.messagebus.message_string'], message['kismet.messagebus.message_time']):
+                self.put('messages', message)
+        sync.commit()
 
     def update_datasources(self):
-        self.queue['datasources'] = self.connector.datasources()
+        datasources = self.request_json('datasources', "datasource/all_sources.json",
+                                        {'fields': self.datasource_fields})
+        self.handle_datasources(datasources)
+
+    def get_signal_request(self):
+        """Запрос seenby только для устройств с открытым графом сигнала, None если таких нет
+        """
+        macs = self.signal_subscriptions.get_macs()
+        if not macs:
+            return None
+        return "devices/multimac/devices.json", {'devices': sorted(macs), 'fields': self.signal_fields}
+
+    def update_signal_sources(self):
+        request = self.get_signal_request()
+        if request is None:
+            return
+        self.handle_signal_sources(self.request_json('signal', *request))
+
+    def handle_signal_sources(self, devices):
+        for device in devices:
+            seenby = get_seenby(device)
+            if seenby:
+                self.put('signal', (device['kismet.device.base.macaddr'], seenby))
+
+    def handle_datasources(self, datasources):
+        """Только изменённые и удалённые источники попадают в очередь Core
+        """
+        current = {}
+        for datasource in datasources:
+            current[datasource['kismet.datasource.uuid']] = datasource
+        for uuid in current:
+            if self.datasource_state.get(uuid) != current[uuid]:
+                self.put('datasources', current[uuid])
+        for uuid in self.datasource_state:
+            if uuid not in current:
+                self.put('datasources', {'kismet.datasource.uuid': uuid, 'removed': True})
+        self.datasource_state = current
+        self.datasource_count = len(current)
+
+    def get_schedules(self, functions=None):
+        """Расписание опроса: у каждой точки API свой интервал
+        """
+        if functions is None:
+            functions = {
+                'devices': self.get_updated_devices,
+                'status': self.update_system_status,
+                'location': self.update_location,
+                'messages': self.queue_new_messages,
+                'datasources': self.update_datasources,
+                'signal': self.update_signal_sources,
+            }
+        self.schedules = {}
+        for name in functions:
+            self.schedules[name] = PollSchedule(name, functions[name], self.intervals[name], logger=self.logger)
+        return self.schedules
+
+    def get_auth_headers(self):
+        headers = {}
+        if self.credentials:
+            auth = base64.b64encode(("%s:%s" % self.credentials).encode()).decode()
+            headers['Authorization'] = "Basic %s" % auth
+        cookie = self.session.cookies.get('KISMET')
+        if cookie:
+            headers['Cookie'] = "KISMET=%s" % cookie
+        return headers
+
+    def start_push(self):
+        """Получение устройств, сообщений и GPS из потока событий Kismet,
+        опрос этих точек API остаётся запасным вариантом
+        """
+        headers = self.get_auth_headers()
+        device_stream = EventStream(self.uri, "devices/monitor.ws",
+                                    subscribe=[{"monitor": "*", "request": 1, "rate": 1,
+                                                "fields": self.device_fields}],
+                                    handler=self._handle_device_event,
+                                    on_connect=self._on_stream_connect, on_close=self._on_stream_close,
+                                    logger=self.logger, headers=headers)
+        device_stream.endpoints = ('devices',)
+        bus_stream = EventStream(self.uri, "eventbus/events.ws",
+                                 subscribe=[{"SUBSCRIBE": "MESSAGE"}, {"SUBSCRIBE": "GPS_LOCATION"}],
+                                 handler=self._handle_bus_event,
+                                 on_connect=self._on_stream_connect, on_close=self._on_stream_close,
+                                 logger=self.logger, headers=headers)
+        bus_stream.endpoints = ('messages', 'location')
+        self.streams = [device_stream, bus_stream]
+        for stream in self.streams:
+            stream.start()
+
+    def stop_push(self):
+        for stream in self.streams:
+            stream.stop()
+        self.streams = []
+
+    def finish_device_sync(self):
+        """Полный список устройств получен, дальше достаточно потока событий
+        """
+        if self.devices_synced:
+            return
+        self.devices_synced = True
+        for stream in self.streams:
+            if 'devices' in stream.endpoints and stream.connected.is_set() and stream.is_running:
+                self._on_stream_connect(stream)
+
+    def _on_stream_connect(self, stream):
+        self.logger.info("Клиент: поток событий %s подключен" % stream.websocket.path)
+        for name in stream.endpoints:
+            if name == 'devices' and not self.devices_synced:
+                # polling first loads the devices the stream will never send
+                continue
+            if name in self.schedules:
+                self.schedules[name].enabled = False
+
+    def _on_stream_close(self, stream, unexpected):
+        for name in stream.endpoints:
+            if name in self.schedules:
+                self.schedules[name].enabled = True
+        if unexpected:
+            self.logger.warning("Клиент: поток событий %s закрыт, возврат к опросу" % stream.websocket.path)
+
+    def _handle_device_event(self, data):
+        if type(data) != list:
+            data = [data]
+        device_filter = self.get_device_filter()
+        for device in data:
+            if 'kismet.device.base.macaddr' not in device:
+                continue
+            if device_filter is not None and not device_filter.match(device):
+                continue
+            if self.devices_synced:
+                # polling continues from here if the stream breaks
+                self.sync['devices'].advance(device['kismet.device.base.macaddr'],
+                                            device.get('kismet.device.base.last_time', 0))
+            self.put('dot11', device)
+
+    def _handle_bus_event(self, event):
+        if 'MESSAGE' in event:
+            message = event['MESSAGE']
+            if self.sync['messages'].accept(message['kismet.messagebus.message_string'],
+                                            message['kismet.messagebus.message_time']):
+                self.put('messages', message)
+        if 'GPS_LOCATION' in event:
+            self.put('location', event['GPS_LOCATION'])
 
     def get_available_datasources(self):
         if not self.authenticated:
             if not self.authenticate():
                 return False
 
-        datasources = self.connector.datasource_list_interfaces()
+        datasources = self.request_json('datasource_list_interfaces', "datasource/list_interfaces.json")
         return datasources
 
     def add_datasource(self, interface):
@@ -218,21 +810,485 @@ class RestClient:
             self.connector.config_datasource_set_hop_rate(uuid=uuid, rate=value)
 
 
-class RestClientThread(threading.Thread):
+class JsonStreamDecoder:
+    """Инкрементальный разбор потока байт: JSON массив или
+    объекты, разделённые переводом строки (itjson)
+    """
+    def __init__(self):
+        self.decoder = json.JSONDecoder()
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.buf = ''
+        self.started = False
+        self.incomplete = False
+
+    def feed(self, chunk):
+        """Все записи, полностью полученные с этим куском данных
+        """
+        text = self.utf8.decode(chunk)
+        self.buf += text
+        if self.incomplete and '}' not in text and ']' not in text:
+            # the pending record can not be complete yet
+            return []
+        self.incomplete = False
+        items = []
+        buf = self.buf
+        pos = 0
+        length = len(buf)
+        while True:
+            while pos < length and buf[pos] in ' \t\r\n,':
+                pos += 1
+            if not self.started and pos < length and buf[pos] == '[':
+                pos += 1
+                self.started = True
+                continue
+            if pos >= length or buf[pos] == ']':
+                pos = length
+                break
+            self.started = True
+            try:
+                item, end = self.decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                self.incomplete = True
+                break
+            items.append(item)
+            pos = end
+        self.buf = buf[pos:]
+        return items
+
+    def close(self):
+        buf = self.buf + self.utf8.decode(b'', final=True)
+        if buf.strip(' \t\r\n,]') != '':
+            raise ValueError("incomplete JSON stream: %s" % buf[:100])
+
+
+def iter_json_objects(chunks):
+    decoder = JsonStreamDecoder()
+    for chunk in chunks:
+        for item in decoder.feed(chunk):
+            yield item
+    decoder.close()
+
+
+class SyncWindow:
+    """Отметка максимального last_time, полученного с сервера
+
+    Время берётся из данных самого сервера, поэтому сдвиг часов между
+    клиентом и сенсором не влияет на окно. Ключи, уже полученные в
+    последнюю секунду, запоминаются, чтобы перекрытие окна в одну
+    секунду не давало дубликатов.
+
+    Ответ Kismet не отсортирован по last_time, поэтому между begin и
+    commit записи сравниваются с отметкой на начало запроса, а новая
+    отметка применяется только после полного ответа.
+    """
+    def __init__(self):
+        self.high_water = 0
+        self.boundary = set()
+        self.lock = threading.Lock()
+        self.pending = None
+
+    def begin(self):
+        with self.lock:
+            self.pending = {
+                'mark': self.high_water,
+                'mark_boundary': set(self.boundary),
+                'high_water': self.high_water,
+                'boundary': set(self.boundary),
+            }
+
+    def accept(self, key, last_time):
+        last_time = int(last_time)
+        with self.lock:
+            pending = self.pending
+            if pending is None:
+                # a single record, e.g. from the event stream
+                if last_time < self.high_water or (last_time == self.high_water and key in self.boundary):
+                    return False
+                self._raise(last_time, {key})
+                return True
+
+            if last_time < pending['mark']:
+                return False
+            if last_time == pending['mark'] and key in pending['mark_boundary']:
+                return False
+            if last_time > pending['high_water']:
+                pending['high_water'] = last_time
+                pending['boundary'] = {key}
+            elif last_time == pending['high_water']:
+                pending['boundary'].add(key)
+            return True
+
+    def commit(self):
+        """Ответ получен полностью, отметка переносится вперёд
+        """
+        with self.lock:
+            pending = self.pending
+            self.pending = None
+            if pending is not None:
+                self._raise(pending['high_water'], pending['boundary'])
+
+    def rollback(self):
+        """Ответ оборван, следующий запрос начнётся с прежней отметки
+        """
+        with self.lock:
+            self.pending = None
+
+    def _raise(self, high_water, boundary):
+        if high_water > self.high_water:
+            self.high_water = high_water
+            self.boundary = set(boundary)
+        elif high_water == self.high_water:
+            self.boundary |= boundary
+
+    def advance(self, key, last_time):
+        """Сдвинуть отметку без отбрасывания, для потока событий
+        """
+        with self.lock:
+            self._raise(int(last_time), {key})
+
+
+class DeviceFilter:
+    """Фильтр SSID/BSSID, который передаётся серверу Kismet
+
+    Kismet объединяет выражения regex через ИЛИ, поэтому точное
+    условие И проверяется ещё раз на клиенте до постановки в очередь.
+    """
+    ssid_fields = (
+        'dot11.device/dot11.device.last_beaconed_ssid',
+        'dot11.device/dot11.device.advertised_ssid_map/dot11.advertisedssid.ssid',
+    )
+
+    def __init__(self, ssid='', bssid=''):
+        self.regex = []
+        self.ssid = None
+        self.bssid = None
+        if ssid != '':
+            self.ssid = re.compile(ssid)
+            for field in self.ssid_fields:
+                self.regex.append([field, ssid])
+        if bssid != '':
+            self.bssid = re.compile(bssid, re.IGNORECASE)
+            # the server matches case-sensitive, the display filter does not
+            self.regex.append(['kismet.device.base.macaddr', '(?i)' + bssid])
+
+    def match(self, device):
+        if 'dot11.device' not in device or device['dot11.device'] == 0:
+            return False
+        if self.bssid is not None and self.bssid.search(device['kismet.device.base.macaddr']) is None:
+            return False
+        if self.ssid is not None:
+            dot11 = device['dot11.device']
+            ssids = [dot11.get('dot11.device.last_beaconed_ssid', '')]
+            for ssid_entry in dot11.get('dot11.device.advertised_ssid_map', []):
+                ssids.append(ssid_entry['dot11.advertisedssid.ssid'])
+            for ssid in ssids:
+                if self.ssid.search(ssid) is not None:
+                    return True
+            return False
+        return True
+
+
+class AdaptiveInterval:
+    """Интервал опроса устройств в зависимости от объёма изменений
+
+    Маленькие дельты сокращают интервал, большие дельты или
+    переполненная очередь GUI увеличивают его.
+    """
+    def __init__(self, interval=1, minimum=0.25, maximum=10, small_delta=50, large_delta=2000,
+                 queue_threshold=10000):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.small_delta = small_delta
+        self.large_delta = large_delta
+        self.queue_threshold = queue_threshold
+        self.interval = min(max(interval, minimum), maximum)
+        self.reason = ''
+
+    def update(self, delta, queue_depth):
+        if queue_depth > self.queue_threshold:
+            self.interval = min(self.maximum, self.interval * 2)
+            self.reason = "очередь GUI: %s" % queue_depth
+        elif delta > self.large_delta:
+            self.interval = min(self.maximum, self.interval * 2)
+            self.reason = "большая дельта: %s" % delta
+        elif delta < self.small_delta:
+            self.interval = max(self.minimum, self.interval / 2)
+            self.reason = "мало изменений: %s" % delta
+        else:
+            self.reason = "дельта: %s" % delta
+        return self.interval
+
+
+def get_device_key(device):
+    return device.mac
+
+
+DeviceRecord = collections.namedtuple('DeviceRecord', (
+    'mac', 'type', 'channel', 'ssid', 'cryptset', 'crypt', 'manuf', 'first_time', 'last_time',
+    'lat', 'lon', 'gps_fix', 'signal_min', 'signal_max', 'signal_last'))
+
+
+def normalize_device(device, logger=None):
+    """Устройство Kismet в плоскую запись DeviceRecord, None для устройств не 802.11
+    """
+    if 'dot11.device' not in device or device['dot11.device'] == 0:
+        return None
+    dot11 = device['dot11.device']
+    mac = device['kismet.device.base.macaddr']
+
+    channel = device['kismet.device.base.channel']
+    if channel.isdigit():
+        channel = int(channel)
+    else:
+        channel = 0
+
+    ssid = ''
+    cryptset = 0
+    ssid_map = dot11.get('dot11.device.advertised_ssid_map', [])
+    if len(ssid_map) > 1 and logger is not None:
+        logger.error("для выполнения: несколько SSID на устройство %s" % mac)
+    for ssid_entry in ssid_map:
+        ssid = ssid_entry['dot11.advertisedssid.ssid']
+        cryptset = ssid_entry['dot11.advertisedssid.crypt_set']
+        break
+    if ssid == '' and 'dot11.device.last_beaconed_ssid' in dot11:
+        ssid = dot11['dot11.device.last_beaconed_ssid']
+
+    location = device.get('kismet.device.base.location')
+    if location and location['kismet.common.location.loc_fix'] >= 2:
+        geopoint = location['kismet.common.location.avg_loc']['kismet.common.location.geopoint']
+        lat = geopoint[1]
+        lon = geopoint[0]
+        gps_fix = True
+    else:
+        lat = 0
+        lon = 0
+        gps_fix = False
+
+    if device['kismet.common.signal.type'] == 'dbm':
+        signal_min = device['kismet.common.signal.min_signal']
+        signal_max = device['kismet.common.signal.max_signal']
+        signal_last = device['kismet.common.signal.last_signal']
+    else:
+        signal_min = 0
+        signal_max = 0
+        signal_last = 0
+
+    return DeviceRecord(mac, decode_network_typeset(dot11['dot11.device.typeset']), channel, ssid, cryptset,
+                        device['kismet.device.base.crypt'], device['kismet.device.base.manuf'],
+                        device['kismet.device.base.first_time'], device['kismet.device.base.last_time'],
+                        lat, lon, gps_fix, signal_min, signal_max, signal_last)
+
+
+def get_seenby(device):
+    """(uuid источника, пакеты, сигнал дБм, время) для источников с сигналом в дБм
+    """
+    seenby = []
+    for source in device.get('kismet.device.base.seenby', ()):
+        signal = source['kismet.common.seenby.signal']
+        signal_type = signal.get('kismet.common.signal.type')
+        if signal_type is None:
+            # older Kismet versions keep dBm and RSSI in separate fields
+            last_signal = signal.get('kismet.common.signal.last_signal_dbm', 0)
+            if last_signal == 0:
+                continue
+        elif signal_type != 'dbm':
+            continue
+        else:
+            last_signal = signal['kismet.common.signal.last_signal']
+        seenby.append((source['kismet.common.seenby.uuid'], source['kismet.common.seenby.num_packets'],
+                       last_signal, source['kismet.common.seenby.last_time']))
+    return tuple(seenby)
+
+
+class SignalSubscriptions:
+    """MAC адреса устройств с открытым окном графа сигнала
+
+    Общий для GUI и всех клиентов, клиенты запрашивают seenby только
+    для этих устройств.
+    """
+    def __init__(self):
+        self.macs = frozenset()
+        self.lock = threading.Lock()
+
+    def add(self, mac):
+        with self.lock:
+            self.macs = self.macs | {mac}
+
+    def remove(self, mac):
+        with self.lock:
+            self.macs = self.macs - {mac}
+
+    def get_macs(self):
+        return self.macs
+
+
+def merge_device_updates(old, new):
+    """Две версии одного устройства: остаётся более новая запись,
+    минимальный и максимальный сигнал берутся по обеим
+    """
+    if old.last_time > new.last_time:
+        old, new = new, old
+    # 0 means no signal was measured
+    if old.signal_min != 0 and (new.signal_min == 0 or old.signal_min < new.signal_min):
+        new = new._replace(signal_min=old.signal_min)
+    if old.signal_max != 0 and (new.signal_max == 0 or old.signal_max > new.signal_max):
+        new = new._replace(signal_max=old.signal_max)
+    return new
+
+
+def coalesce_devices(devices):
+    """Одна запись на MAC для очередей без объединения, порядок первого появления
+    """
+    index = {}
+    for device in devices:
+        key = get_device_key(device)
+        if key in index:
+            index[key] = merge_device_updates(index[key], device)
+        else:
+            index[key] = device
+    return list(index.values())
+
+
+def get_datasource_key(datasource):
+    return datasource['kismet.datasource.uuid']
+
+
+class CircuitBreaker:
+    """Состояние соединения с сервером и задержка переподключения
+
+    closed - соединение работает, open - ожидание следующей попытки,
+    half-open - идёт попытка подключения. Задержка удваивается после
+    каждой неудачи, случайный разброс не даёт нескольким клиентам
+    переподключаться одновременно. attempts=0 - без ограничения попыток.
+    """
+    def __init__(self, minimum=1, maximum=60, attempts=0):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.attempts = attempts
+        self.state = 'closed'
+        self.failures = 0
+        self.delay = 0.0
+        self.next_attempt = None
+
+    def attempt(self):
+        self.state = 'half-open'
+
+    def record_success(self):
+        self.state = 'closed'
+        self.failures = 0
+        self.delay = 0.0
+        self.next_attempt = None
+
+    def record_failure(self):
+        """Задержка до следующей попытки в секундах
+        """
+        self.failures += 1
+        delay = min(self.maximum, self.minimum * 2 ** (self.failures - 1))
+        self.delay = random.uniform(delay / 2, delay)
+        self.next_attempt = time.monotonic() + self.delay
+        self.state = 'open'
+        return self.delay
+
+    def give_up(self):
+        return self.attempts > 0 and self.failures >= self.attempts
+
+    def get_stats(self):
+        if self.next_attempt is None:
+            wait = 0.0
+        else:
+            wait = max(0.0, self.next_attempt - time.monotonic())
+        return {
+            'state': self.state,
+            'failures': self.failures,
+            'delay': self.delay,
+            'wait': wait,
+        }
+
+
+class PollSchedule:
+    def __init__(self, name, function, interval, logger):
+        self.name = name
+        self.function = function
+        self.interval = interval
+        self.logger = logger
+        self.enabled = True
+        self.reason = ''
+        self.runs = 0
+        self.errors = 0
+        self.last_start = None
+        self.lateness = 0.0
+        self.max_lateness = 0.0
+        self.duration = 0.0
+
+    def get_next_run(self):
+        if self.last_start is None:
+            return time.monotonic()
+        return self.last_start + self.interval
+
+    def begin(self):
+        start = time.monotonic()
+        if self.last_start is not None:
+            # how much later than planned the endpoint is polled
+            self.lateness = max(0.0, start - self.last_start - self.interval)
+            self.max_lateness = max(self.max_lateness, self.lateness)
+        self.last_start = start
+        return start
+
+    def finish(self, start, error=None):
+        if error is not None:
+            self.errors += 1
+            self.logger.error("Клиент: ошибка опроса %s: %s" % (self.name, error))
+        self.duration = time.monotonic() - start
+        self.runs += 1
+
+    def run(self):
+        start = self.begin()
+        error = None
+        try:
+            self.function()
+        except Exception as e:
+            error = e
+        self.finish(start, error)
+
+    async def run_async(self):
+        """То же для сопрограммы, function должна быть async
+        """
+        start = self.begin()
+        error = None
+        try:
+            await self.function()
+        except Exception as e:
+            error = e
+        self.finish(start, error)
+
+    def get_stats(self):
+        return {
+            'interval': self.interval,
+            'reason': self.reason,
+            'enabled': self.enabled,
+            'runs': self.runs,
+            'errors': self.errors,
+            'lateness': self.lateness,
+            'max_lateness': self.max_lateness,
+            'duration': self.duration,
+        }
+
+
+class ClientHandle:
+    """Общая часть RestClientThread и AsyncClientHandle, которую использует Core
+    """
     def __init__(self, logger, uri=None):
-        threading.Thread.__init__(self)
         self.logger = logger
         self.debug = False
         self.client = RestClient(logger=logger)
         self.is_running = False
+        self.schedules = {}
+        self.reconnect = True
+        self.breaker = CircuitBreaker()
         if uri is not None:
             self.client.uri = uri
 
-    def stop(self):
-        self.is_running = None
-        if self.client.connected is True:
-            self.client.stop()
-
     def get_queue(self, name):
         try:
             return self.client.queue[name]
@@ -240,20 +1296,117 @@ class RestClientThread(threading.Thread):
             self.logger.debug("очередь %s отсутствует" % name)
             return False
 
+    def get_schedule_stats(self):
+        stats = {}
+        for name in self.schedules:
+            stats[name] = self.schedules[name].get_stats()
+        return stats
+
+    def get_reconnect_delay(self):
+        """Задержка перед повторным подключением, None - прекратить попытки
+        """
+        if not self.reconnect:
+            return None
+        delay = self.breaker.record_failure()
+        if self.breaker.give_up():
+            self.client.error.append("соединение потеряно, попыток: %s" % self.breaker.failures)
+            return None
+        self.client.error.append("соединение потеряно, повтор через %.0f с" % delay)
+        return delay
+
+
+class RestClientThread(ClientHandle, threading.Thread):
+    def __init__(self, logger, uri=None):
+        threading.Thread.__init__(self)
+        ClientHandle.__init__(self, logger=logger, uri=uri)
+        self.stop_event = threading.Event()
+
+    def stop(self):
+        self.is_running = None
+        self.stop_event.set()
+        # also after a lost connection, to close the streams and the capture
+        self.client.stop()
+
+    def run_schedule(self, schedule):
+        while self.is_running is True and self.client.connected is True:
+            wait = schedule.get_next_run() - time.monotonic()
+            if wait > 0:
+                self.stop_event.wait(wait)
+                continue
+            if schedule.enabled:
+                schedule.run()
+            else:
+                schedule.last_start = time.monotonic()
+
     def run(self):
         self.is_running = True
         self.client.error = []
-        if self.client.start() is False:
-            self.stop()
-        while self.is_running is True and (self.client.connected is True):
-            # try:
-            self.client.get_updated_devices()
-            self.client.update_system_status()
-            self.client.update_location()
-            self.client.queue_new_messages()
-            self.client.update_datasources()
-            # print(self.client.queue)
-            time.sleep(1)
+        while self.is_running is True:
+            self.breaker.attempt()
+            if self.client.try_start() is not False:
+                self.breaker.record_success()
+                if not self.schedules:
+                    self.schedules = self.client.get_schedules()
+                if self.client.push:
+                    self.client.start_push()
+                self.run_schedules()
+                self.client.stop_push()
+            if self.is_running is not True:
+                break
+            # the sync windows are kept, the client continues where it stopped
+            delay = self.get_reconnect_delay()
+            if delay is None or self.stop_event.wait(delay):
+                break
+        self.stop()
+
+    def run_schedules(self):
+        # every endpoint gets its own worker, a slow device list
+        # must not delay gps positions or messages
+        workers = []
+        for name in self.schedules:
+            worker = threading.Thread(target=self.run_schedule, args=(self.schedules[name],),
+                                      name="kismon-%s" % name, daemon=True)
+            worker.start()
+            workers.append(worker)
+        for worker in workers:
+            worker.join()
+
+
+class ReplayClientThread(RestClientThread):
+    """Воспроизведение записанного сеанса вместо подключения к серверу
+
+    speed: 1 - в реальном времени, N - в N раз быстрее, 0 - без пауз
+    """
+    def __init__(self, logger, path, speed=1, uri=None):
+        RestClientThread.__init__(self, logger=logger, uri=uri)
+        self.path = path
+        self.speed = speed
+        self.records = 0
+        self.duration = 0.0
+
+    def run(self):
+        self.is_running = True
+        self.client.error = []
+        self.client.close_queue(False)
+        self.client.connected = True
+        self.logger.info("Клиент: воспроизведение %s, скорость %s" % (self.path, self.speed))
+        start = time.monotonic()
+        try:
+            for timestamp, name, data in read_capture(self.path):
+                if self.is_running is not True:
+                    break
+                if self.speed > 0:
+                    wait = start + timestamp / self.speed - time.monotonic()
+                    if wait > 0 and self.stop_event.wait(wait):
+                        break
+                self.client.put(name, data)
+                self.records += 1
+        except (OSError, EOFError, ValueError) as e:
+            self.logger.error(e)
+            self.client.error.append("ошибка воспроизведения %s: %s" % (self.path, e))
+        self.duration = time.monotonic() - start
+        self.logger.info("Клиент: воспроизведено %s записей за %.1f с (%.0f в секунду)" % (
+            self.records, self.duration, self.records / max(self.duration, 0.001)))
         self.stop()
 
 
@@ -66,10 +66,49 @@ class Config:
             "networks": {
                 "autosave": 5,
                 "num_backups": 5,
+                # "json", "bin" for the binary snapshot or "sqlite", the file is networks.<storage>
+                "storage": "json",
+                # seconds between writes of changed networks to the journal or database
+                "journal_interval": 5,
+                # milliseconds the main loop may spend on new devices per slice
+                "ingest_budget": 25,
             },
             "tracks": {
                 "store": False,
             },
+            "client": {
+                "intervals": {
+                    "devices": 1,
+                    "status": 1,
+                    "location": 0.25,
+                    "messages": 1,
+                    "datasources": 10,
+                    # per source signals of the devices with an open signal graph
+                    "signal": 1,
+                },
+                # "threads": one thread per server, "asyncio": one event loop for all servers
+                "engine": "threads",
+                "reconnect": {
+                    "enabled": True,
+                    "min": 1,
+                    "max": 60,
+                    # 0: try until the server is switched off
+                    "attempts": 0,
+                },
+                # devices per page of the initial sync, 0: everything in one request
+                "initial_page_size": 500,
+                "queue_size": 50000,
+                # "block" is only used with the "threads" engine
+                "queue_overflow": "coalesce",
+                "adaptive_interval": {
+                    "enabled": True,
+                    "min": 0.25,
+                    "max": 10,
+                    "small_delta": 50,
+                    "large_delta": 2000,
+                    "queue_threshold": 10000,
+                },
+            },
             "filter_networks": {
                 "network_list": "current",
                 "map": "current",
@@ -92,6 +131,11 @@ class Config:
                 "ssid": "",
                 "bssid": "",
             },
+            "server_filter": {
+                "enabled": False,
+                "ssid": "",
+                "bssid": "",
+            },
             "network_list_columns": []
         }
 
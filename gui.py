@@ -73,6 +73,8 @@ class MainWindow(TemplateWindow):
 
         self.network_filter = {}
         self.signal_graphs = {}
+        # set by Core, the clients request per source signals for these devices
+        self.signal_subscriptions = None
         self.sources = sources
         self.client_threads = client_threads
 
@@ -393,9 +395,13 @@ class MainWindow(TemplateWindow):
         mac = self.network_list.network_selected
         signal_window = SignalWindow(mac, self.on_signal_graph_destroy, seconds=self.config['window']['signal_window_seconds'])
         self.signal_graphs[mac] = signal_window
+        if self.signal_subscriptions is not None:
+            self.signal_subscriptions.add(mac)
 
     def on_signal_graph_destroy(self, window, mac):
         del self.signal_graphs[mac]
+        if self.signal_subscriptions is not None:
+            self.signal_subscriptions.remove(mac)
 
     def on_file_import(self, widget):
         file_import_window = FileImportWindow(self.networks, self.networks_queue_progress)
@@ -436,7 +442,7 @@ class MainWindow(TemplateWindow):
     def export_remove_network(self, mac):
         self.export_networks[mac] = False
 
-    def update_statusbar(self):
+    def update_statusbar(self, ingest=None):
         if self.map is not None:
             on_map = len(self.map.markers)
         else:
@@ -445,6 +451,12 @@ class MainWindow(TemplateWindow):
         text = "Сети: %s в текущей сессии, %s всего, %s в списке сетей, %s на карте" % \
                (len(self.networks.recent_networks), len(self.networks.networks), len(self.network_list.network_iter),
                 on_map)
+        if ingest is not None and ingest['slices'] > 0:
+            text += " | приём: %.0f устр/с, задержка GUI %.0f мс (макс. %.0f), в очереди %s" % \
+                    (ingest['devices_per_second'], ingest['stall_p95'] * 1000, ingest['stall_max'] * 1000,
+                     ingest['backlog'])
+            if ingest['coalesced'] > 0:
+                text += ", объединено %.0f%%" % (ingest['coalesce_ratio'] * 100)
         self.statusbar.push(self.statusbar_context, text)
 
 
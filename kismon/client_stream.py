@@ -0,0 +1,221 @@
+import base64
+import hashlib
+import json
+import os
+import socket
+import struct
+import threading
+from urllib.parse import urlparse
+
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+OPCODE_CONTINUATION = 0x0
+OPCODE_TEXT = 0x1
+OPCODE_BINARY = 0x2
+OPCODE_CLOSE = 0x8
+OPCODE_PING = 0x9
+OPCODE_PONG = 0xa
+
+
+class WebSocketError(Exception):
+    pass
+
+
+def get_accept_key(key):
+    digest = hashlib.sha1((key + WEBSOCKET_GUID).encode()).digest()
+    return base64.b64encode(digest).decode()
+
+
+def encode_frame(payload, opcode=OPCODE_TEXT, mask=True):
+    """Кадр websocket (RFC 6455), клиент обязан маскировать данные
+    """
+    if type(payload) == str:
+        payload = payload.encode()
+    header = bytearray([0x80 | opcode])
+    length = len(payload)
+    mask_bit = 0x80 if mask else 0
+    if length < 126:
+        header.append(mask_bit | length)
+    elif length < 65536:
+        header.append(mask_bit | 126)
+        header.extend(struct.pack("!H", length))
+    else:
+        header.append(mask_bit | 127)
+        header.extend(struct.pack("!Q", length))
+
+    if not mask:
+        return bytes(header) + payload
+    mask_key = os.urandom(4)
+    masked = bytearray(payload)
+    for i in range(length):
+        masked[i] ^= mask_key[i % 4]
+    return bytes(header) + mask_key + bytes(masked)
+
+
+def read_frame(rfile):
+    """Чтение одного кадра, возвращает (fin, opcode, payload)
+    """
+    header = rfile.read(2)
+    if len(header) < 2:
+        raise WebSocketError("соединение закрыто")
+    fin = header[0] & 0x80 != 0
+    opcode = header[0] & 0x0f
+    masked = header[1] & 0x80 != 0
+    length = header[1] & 0x7f
+    if length == 126:
+        length = struct.unpack("!H", rfile.read(2))[0]
+    elif length == 127:
+        length = struct.unpack("!Q", rfile.read(8))[0]
+    mask_key = rfile.read(4) if masked else None
+    payload = rfile.read(length)
+    if len(payload) < length:
+        raise WebSocketError("соединение закрыто")
+    if masked:
+        payload = bytearray(payload)
+        for i in range(length):
+            payload[i] ^= mask_key[i % 4]
+        payload = bytes(payload)
+    return fin, opcode, payload
+
+
+class WebSocket:
+    def __init__(self, uri, path, headers=None, timeout=10):
+        self.uri = uri
+        self.path = path
+        self.headers = headers or {}
+        self.timeout = timeout
+        self.sock = None
+        self.rfile = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        parsed = urlparse(self.uri)
+        if parsed.scheme == "https":
+            import ssl
+            port = parsed.port or 443
+            sock = socket.create_connection((parsed.hostname, port), timeout=self.timeout)
+            sock = ssl.create_default_context().wrap_socket(sock, server_hostname=parsed.hostname)
+        else:
+            port = parsed.port or 80
+            sock = socket.create_connection((parsed.hostname, port), timeout=self.timeout)
+
+        key = base64.b64encode(os.urandom(16)).decode()
+        path = "%s/%s" % (parsed.path.rstrip("/"), self.path.lstrip("/"))
+        lines = [
+            "GET %s HTTP/1.1" % path,
+            "Host: %s:%s" % (parsed.hostname, port),
+            "Upgrade: websocket",
+            "Connection: Upgrade",
+            "Sec-WebSocket-Key: %s" % key,
+            "Sec-WebSocket-Version: 13",
+        ]
+        for name in self.headers:
+            lines.append("%s: %s" % (name, self.headers[name]))
+        sock.sendall(("\r\n".join(lines) + "\r\n\r\n").encode())
+
+        rfile = sock.makefile("rb")
+        status_line = rfile.readline().decode("latin-1").strip()
+        response_headers = {}
+        while True:
+            line = rfile.readline().decode("latin-1").strip()
+            if line == "":
+                break
+            name, _, value = line.partition(":")
+            response_headers[name.strip().lower()] = value.strip()
+
+        if " 101 " not in "%s " % status_line:
+            sock.close()
+            raise WebSocketError("ошибка websocket %s: %s" % (path, status_line))
+        if response_headers.get("sec-websocket-accept") != get_accept_key(key):
+            sock.close()
+            raise WebSocketError("неверный ответ websocket %s" % path)
+
+        # the stream may stay silent for a long time on a quiet sensor
+        sock.settimeout(None)
+        self.sock = sock
+        self.rfile = rfile
+
+    def send(self, data, opcode=OPCODE_TEXT):
+        with self.lock:
+            self.sock.sendall(encode_frame(data, opcode))
+
+    def send_json(self, data):
+        self.send(json.dumps(data))
+
+    def recv(self):
+        """Следующее текстовое сообщение, None если соединение закрыто
+        """
+        fragments = []
+        while True:
+            fin, opcode, payload = read_frame(self.rfile)
+            if opcode == OPCODE_PING:
+                self.send(payload, OPCODE_PONG)
+                continue
+            elif opcode == OPCODE_PONG:
+                continue
+            elif opcode == OPCODE_CLOSE:
+                return None
+            fragments.append(payload)
+            if fin:
+                return b"".join(fragments).decode("utf-8")
+
+    def close(self):
+        if self.sock is None:
+            return
+        try:
+            self.send(b"", OPCODE_CLOSE)
+        except OSError:
+            pass
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+        self.sock = None
+
+
+class EventStream(threading.Thread):
+    """Поток, получающий события Kismet через websocket
+
+    После подключения отправляет сообщения subscribe и вызывает on_connect,
+    затем handler для каждого полученного JSON объекта. on_close вызывается
+    при любом завершении, чтобы клиент вернулся к опросу.
+    """
+    def __init__(self, uri, path, subscribe, handler, on_connect, on_close, logger, headers=None):
+        threading.Thread.__init__(self, name="kismon-stream-%s" % path, daemon=True)
+        self.websocket = WebSocket(uri, path, headers=headers)
+        self.subscribe = subscribe
+        self.handler = handler
+        self.on_connect = on_connect
+        self.on_close = on_close
+        self.logger = logger
+        self.is_running = False
+        self.connected = threading.Event()
+        self.frames = 0
+
+    def stop(self):
+        self.is_running = False
+        self.websocket.close()
+
+    def run(self):
+        self.is_running = True
+        try:
+            self.websocket.connect()
+            for message in self.subscribe:
+                self.websocket.send_json(message)
+            self.connected.set()
+            self.on_connect(self)
+            while self.is_running:
+                message = self.websocket.recv()
+                if message is None:
+                    break
+                self.frames += 1
+                self.handler(json.loads(message))
+        except (OSError, ValueError, WebSocketError) as e:
+            if self.is_running:
+                self.logger.error("Клиент: поток событий %s: %s" % (self.websocket.path, e))
+        finally:
+            was_running = self.is_running
+            self.is_running = False
+            self.websocket.close()
+            self.on_close(self, was_running)
@@ -30,6 +30,7 @@ POSSIBILITY OF SUCH DAMAGE.
 
 import os
 import sys
+import time
 import gi
 
 gi.require_version('Gtk', '3.0')
@@ -37,6 +38,9 @@ from gi.repository import Gtk
 from gi.repository import GLib
 
 from kismon.client_rest import *
+from kismon.client_async import AsyncClientEngine, AsyncClientHandle
+from kismon.metrics import IngestMeter
+from kismon.wakeup import Wakeup
 from kismon.gui import MainWindow
 from kismon.config import Config
 from kismon.networks import Networks
@@ -71,6 +75,15 @@ class Core:
         self.crypt_cache = {}
         self.networks = Networks(config=self.config, logger=logger)
         self.client_threads = {}
+        self.async_engine = None
+        self.signal_subscriptions = SignalSubscriptions()
+        self.wakeup = Wakeup()
+        self.ingest_meter = IngestMeter()
+        self.ingest_task = None
+        self.ingest_next_server = 0
+        self.capture_path = utils.get_argument(sys.argv, "--capture")
+        self.replay_path = utils.get_argument(sys.argv, "--replay")
+        self.replay_speed = float(utils.get_argument(sys.argv, "--replay-speed", 1))
         self.init_client_threads()
         self.tracks = Tracks("%stracks.json" % user_dir)
         self.tracks.load()
@@ -96,33 +109,20 @@ class Core:
                                       self.client_threads,
                                       logger
                                       )
+        self.main_window.signal_subscriptions = self.signal_subscriptions
         self.main_window.log_list.add("Kismon", "started")
         if self.map_error is not None:
             self.main_window.log_list.add("Kismon", self.map_error)
 
-        self.networks_file = "%snetworks.json" % user_dir
-        if os.path.isfile(self.networks_file):
-            try:
-                self.networks.load(self.networks_file)
-            except:
-                error = sys.exc_info()[1]
-                logger.error(error)
-                dialog_message = "Не удалось прочитать сетевой файл '%s':\n%s\n\nВы хотите продолжить?" % (
-                self.networks_file, error)
-                dialog = Gtk.MessageDialog(self.main_window.gtkwin, Gtk.DialogFlags.DESTROY_WITH_PARENT,
-                                           Gtk.MessageType.ERROR, Gtk.ButtonsType.YES_NO, dialog_message)
-
-                def dialog_response(dialog, response_id):
-                    self.dialog_response = response_id
-
-                dialog.connect("response", dialog_response)
-                dialog.run()
-                dialog.destroy()
-                if self.dialog_response == -9:
-                    logger.error("exit")
-                    self.clients_stop()
-                    self.main_window.gtkwin = None
-                    return
+        self.networks_file = "%snetworks.%s" % (user_dir, self.config["networks"]["storage"])
+        load_file = self.networks_file
+        if not os.path.isfile(load_file):
+            # switching the storage, the stores create their file only when a full save into it is complete
+            load_file = "%snetworks.json" % user_dir
+        self.save_networks = True
+        if os.path.isfile(load_file):
+            self.networks.load_in_background(load_file,
+                                             lambda count, error: self.on_networks_loaded(load_file, error))
         self.networks.set_autosave(self.config["networks"]["autosave"], self.networks_file,
                                    self.main_window.log_list.add)
 
@@ -133,10 +133,32 @@ class Core:
 
         self.main_window.network_list.crypt_cache = self.crypt_cache
 
-        GLib.timeout_add(500, self.queues_handler)
-        GLib.timeout_add(300, self.queues_handler_networks)
+        # the clients wake the loop when data arrives, the timers only refresh the server state
+        GLib.io_add_watch(GLib.IOChannel.unix_new(self.wakeup.fileno()), GLib.PRIORITY_DEFAULT,
+                          GLib.IOCondition.IN, self.on_wakeup)
+        GLib.timeout_add(1000, self.queues_handler)
+        GLib.timeout_add(1000, self.queues_handler_networks)
         GLib.idle_add(self.networks.apply_filters)
 
+    def on_networks_loaded(self, filename, error):
+        if error is None or self.main_window.gtkwin is None:
+            return
+        dialog_message = "Не удалось прочитать сетевой файл '%s':\n%s\n\nВы хотите продолжить?" % (
+            filename, error)
+        dialog = Gtk.MessageDialog(self.main_window.gtkwin, Gtk.DialogFlags.DESTROY_WITH_PARENT,
+                                   Gtk.MessageType.ERROR, Gtk.ButtonsType.YES_NO, dialog_message)
+
+        def dialog_response(dialog, response_id):
+            dialog.destroy()
+            if response_id == Gtk.ResponseType.NO:
+                logger.error("exit")
+                # keep the file as it is for the next start
+                self.save_networks = False
+                self.main_window.gtkwin.destroy()
+
+        dialog.connect("response", dialog_response)
+        dialog.show()
+
     def init_map(self):
         if self.map_error is not None:
             self.map = None
@@ -149,9 +171,47 @@ class Core:
     def init_client_thread(self, server_id):
         server = self.config["servers"][server_id]
         server['id'] = server_id
-        self.client_threads[server_id] = RestClientThread(uri=server['uri'], logger=logger)
+        if self.replay_path is not None and server_id == 0:
+            self.client_threads[server_id] = ReplayClientThread(path=self.replay_path, speed=self.replay_speed,
+                                                                uri=server['uri'], logger=logger)
+        elif self.config['client']['engine'] == 'asyncio':
+            if self.async_engine is None:
+                self.async_engine = AsyncClientEngine(logger=logger)
+            self.client_threads[server_id] = AsyncClientHandle(self.async_engine, uri=server['uri'], logger=logger)
+        else:
+            self.client_threads[server_id] = RestClientThread(uri=server['uri'], logger=logger)
+        thread = self.client_threads[server_id]
+        reconnect = self.config['client']['reconnect']
+        thread.reconnect = reconnect['enabled']
+        thread.breaker = CircuitBreaker(minimum=reconnect['min'], maximum=reconnect['max'],
+                                        attempts=reconnect['attempts'])
+        client = thread.client
         if server['username'] != '' and server['password'] != '':
-            self.client_threads[server_id].client.credentials = (server['username'], server['password'])
+            client.credentials = (server['username'], server['password'])
+        client.intervals.update(self.config['client']['intervals'])
+        overflow = self.config['client']['queue_overflow']
+        if overflow == 'block' and isinstance(thread, AsyncClientHandle):
+            # a blocked producer would stop the event loop and with it every server
+            logger.warning("Клиент: политика очереди block недоступна для asyncio, используется coalesce")
+            overflow = 'coalesce'
+        client.configure_queue(self.config['client']['queue_size'], overflow)
+        client.push = server.get('push', False)
+        client.page_size = self.config['client']['initial_page_size']
+        if self.capture_path is not None:
+            if server_id == 0:
+                client.capture_path = self.capture_path
+            else:
+                client.capture_path = "%s-%s" % (self.capture_path, server_id)
+        client.server_filter = self.config['server_filter']
+        client.signal_subscriptions = self.signal_subscriptions
+        client.wakeup = self.wakeup
+        adaptive = self.config['client']['adaptive_interval']
+        if adaptive['enabled']:
+            client.adaptive = AdaptiveInterval(interval=client.intervals['devices'],
+                                               minimum=adaptive['min'], maximum=adaptive['max'],
+                                               small_delta=adaptive['small_delta'],
+                                               large_delta=adaptive['large_delta'],
+                                               queue_threshold=adaptive['queue_threshold'])
 
     def init_client_threads(self):
         server_id = 0
@@ -160,10 +220,16 @@ class Core:
             server_id += 1
 
     def client_start(self, server_id):
-        if server_id in self.client_threads and self.client_threads[server_id].is_running:
+        previous = self.client_threads.get(server_id)
+        if previous is not None and previous.is_running:
             self.client_stop(server_id)
         self.sources[server_id] = {}
         self.init_client_thread(server_id)
+        client = self.client_threads[server_id].client
+        if previous is not None and previous.client.uri == client.uri:
+            # same server: continue the incremental sync instead of a full download
+            client.sync = previous.client.sync
+            client.sync_filter = previous.client.sync_filter
         self.client_threads[server_id].start()
 
     def client_stop(self, server_id):
@@ -180,25 +246,55 @@ class Core:
             return False
 
         thread = self.client_threads[server_id]
+        server_tab = self.main_window.server_tabs[server_id]
         if len(thread.client.error) > 0:
             for error in thread.client.error:
                 self.main_window.log_list.add(server['uri'], error)
             thread.client.error = []
-            self.main_window.server_tabs[server_id].server_switch.set_active(False)
+        # while reconnecting the switch stays on, only a stopped client turns it off
+        if thread.is_running is None and server_tab.server_switch.get_active():
+            server_tab.server_switch.set_active(False)
             page_num = self.main_window.notebook.page_num(self.main_window.log_list.widget)
             self.main_window.notebook.set_current_page(page_num)
+        server_tab.update_breaker_info(thread.breaker.get_stats(), running=thread.is_running is True)
 
         # info
         status = thread.get_queue('status')
         if status:
             self.main_window.server_tabs[server_id].update_info_table(devices=status['kismet.system.devices.count'])
+        if thread.schedules:
+            self.main_window.server_tabs[server_id].update_schedule_table(thread.get_schedule_stats())
+        server_tab.update_sync_progress(thread.client.get_sync_progress())
+        if server_tab.metrics_expander.get_expanded():
+            server_tab.update_metrics_table(thread.client.metrics.get_summary())
+        self.main_window.server_tabs[server_id].update_queue_info(thread.client.get_queue_stats())
+        self.main_window.server_tabs[server_id].update_connection_info(thread.client.get_connection_stats())
+
+        if thread.client.datasource_count == 0:
+            # logger.debug("no active datasources")
+            if type(self.main_window.server_tabs[server_id].datasources_dialog_answer) == bool:
+                # question was already asked
+                pass
+            elif not thread.client.connected:
+                # not connected
+                pass
+            elif self.datasources_dialog(server_id):
+                self.main_window.server_tabs[server_id].on_manage_datasources()
+
+        self.queue_handler_data(server_id)
+
+    def queue_handler_data(self, server_id):
+        """Разбор очередей с данными клиента: gps, сообщения, источники и сигнал,
+        таблицы вкладки сервера обновляет только queue_handler по таймеру
+        """
+        server = self.config['servers'][server_id]
+        thread = self.client_threads[server_id]
 
         # gps
         gps = None
         gps_queue = thread.get_queue("location")
 
-        while len(gps_queue) > 0:
-            data = gps_queue.pop(0)
+        for data in gps_queue.drain():
             if not data:
                 continue
 
@@ -224,26 +320,18 @@ class Core:
                     self.map.add_marker(server_key, server_key, gps['lat'], gps['lon'])
 
         message_queue = thread.get_queue("messages")
-        while len(message_queue) > 0:
-            message = message_queue.pop(0)
+        for message in message_queue.drain():
             self.main_window.log_list.add(origin=server['uri'], message=message['kismet.messagebus.message_string'],
                                           timestamp=message['kismet.messagebus.message_time'])
 
-        datasources = thread.get_queue('datasources')
-        if len(datasources) == 0:
-            # logger.debug("no active datasources")
-            if type(self.main_window.server_tabs[server_id].datasources_dialog_answer) == bool:
-                # question was already asked
-                pass
-            elif not thread.client.connected:
-                # not connected
-                pass
-            elif self.datasources_dialog(server_id):
-                self.main_window.server_tabs[server_id].on_manage_datasources()
-
         sources_updated = False
-        for ds in datasources:
+        for ds in thread.get_queue('datasources').drain():
             uuid = ds['kismet.datasource.uuid']
+            if ds.get('removed'):
+                if uuid in self.sources[server_id]:
+                    del self.sources[server_id][uuid]
+                    sources_updated = True
+                continue
             source = {
                 'type': ds['kismet.datasource.hardware'],
                 'packets': ds['kismet.datasource.num_packets'],
@@ -254,13 +342,15 @@ class Core:
                 'name': ds['kismet.datasource.name'],
                 'uuid': uuid,
             }
-            if uuid in self.sources[server_id] and source['packets'] != self.sources[server_id][uuid]['packets']:
-                sources_updated = True
+            # the client only queues sources that changed
+            sources_updated = True
             self.sources[server_id][uuid] = source
 
         if sources_updated is True:
             self.main_window.server_tabs[server_id].update_sources_table(self.sources[server_id])
 
+        self.update_signal_graphs(server_id)
+
     def datasources_dialog(self, server_id):
         dialog_message = "Экземпляр Kismet %s, похоже, не имеет активных интерфейсов.\Не хотите ли вы активировать их сейчас? *\n\n* Требуется аутентификация" % (
         self.config["servers"][server_id]['uri'])
@@ -287,48 +377,114 @@ class Core:
             self.queue_handler(server_id)
         return True
 
-    def queue_handler_networks(self, server_id):
+    def queue_handler_networks(self, server_id, deadline=None):
+        """Обработка устройств из очереди клиента до наступления deadline,
+        остаток остаётся в очереди до следующего среза
+        """
         thread = self.client_threads[server_id]
 
         queue = thread.get_queue("dot11")
-        for x in range(0, len(queue)):
-            device = queue.pop(0)
-            if 'dot11.device' not in device or device['dot11.device'] == 0: # skip non-802.11 devices
+        count = 0
+        while True:
+            if deadline is None:
+                batch = queue.drain()
+            else:
+                batch = queue.drain(64)
+            received = len(batch)
+            if queue.overflow != 'coalesce':
+                # the queue keeps every copy, merge them before the store is touched
+                batch = coalesce_devices(batch)
+                self.ingest_meter.coalesced += received - len(batch)
+            for device in batch:
+                self.add_device(device, server_id)
+            count += received
+            if deadline is None or len(batch) == 0 or time.monotonic() >= deadline:
+                break
+
+        if deadline is None:
+            self.update_networks_queue()
+        return count
+
+    def add_device(self, device, server_id):
+        self.networks.add_device_data(device, server_id)
+
+    def update_signal_graphs(self, server_id):
+        """seenby приходит только для устройств, на которые подписаны окна графов
+        """
+        sources = self.sources[server_id]
+        for mac, seenby in self.client_threads[server_id].get_queue('signal').drain():
+            signal_graph = self.main_window.signal_graphs.get(mac)
+            if signal_graph is None:
                 continue
-            self.networks.add_device_data(device, server_id)
-            mac = device['kismet.device.base.macaddr']
-
-            for source in device['kismet.device.base.seenby']:
-                source_uuid = source['kismet.common.seenby.uuid']
-                if source_uuid not in self.sources[server_id]:
+            for source_uuid, packets, signal, timestamp in seenby:
+                if source_uuid not in sources:
                     continue
-                if mac not in self.main_window.signal_graphs:
-                    continue
-
-                if source['kismet.common.seenby.signal']['kismet.common.signal.type'] != 'dbm':
-                    continue
-                self.main_window.signal_graphs[mac].add_value(source_data=self.sources[server_id][source_uuid],
-                                                              packets=source['kismet.common.seenby.num_packets'],
-                                                              signal=source['kismet.common.seenby.signal'][
-                                                                  'kismet.common.signal.last_signal'],
-                                                              timestamp=source['kismet.common.seenby.last_time'],
-                                                              server_id=server_id)
+                signal_graph.add_value(source_data=sources[source_uuid], packets=packets, signal=signal,
+                                       timestamp=timestamp, server_id=server_id)
 
+    def update_networks_queue(self):
         if len(self.networks.notify_add_queue) > 0:
             self.networks.start_queue()
             if len(self.networks.notify_add_queue) > 500:
                 self.networks.disable_refresh()
                 self.main_window.networks_queue_progress()
 
-        self.main_window.update_statusbar()
+        self.main_window.update_statusbar(self.ingest_meter.get_summary())
 
-    def queues_handler_networks(self):
+    def on_wakeup(self, channel, condition):
+        self.wakeup.clear()
+        if self.main_window.gtkwin is None:
+            return False
+        # only the data, the server tab tables are refreshed by the timer
         for server_id in self.client_threads:
-            self.queue_handler_networks(server_id)
+            self.queue_handler_data(server_id)
+        self.queues_handler_networks()
         return True
 
+    def queues_handler_networks(self):
+        if self.ingest_task is None and self.ingest_slice():
+            # continue between the redraws instead of waiting for the next timeout
+            self.ingest_task = GLib.idle_add(self.ingest_continue)
+        return True
+
+    def ingest_continue(self):
+        if self.ingest_slice():
+            return True
+        self.ingest_task = None
+        return False
+
+    def ingest_slice(self):
+        """Один срез приёма, ограниченный по времени, чтобы главный цикл
+        не замирал после больших пачек. Возвращает True, если очереди не пусты
+        """
+        start = time.monotonic()
+        deadline = start + self.config['networks']['ingest_budget'] / 1000
+        server_ids = sorted(self.client_threads)
+        # start with a different server each slice so that none of them starves
+        if server_ids:
+            pos = self.ingest_next_server % len(server_ids)
+            server_ids = server_ids[pos:] + server_ids[:pos]
+            self.ingest_next_server += 1
+
+        count = 0
+        for server_id in server_ids:
+            count += self.queue_handler_networks(server_id, deadline)
+            if time.monotonic() >= deadline:
+                break
+
+        backlog = 0
+        for server_id in self.client_threads:
+            queue = self.client_threads[server_id].get_queue("dot11")
+            if queue is not False:
+                backlog += len(queue)
+        self.ingest_meter.record(count, time.monotonic() - start, backlog)
+        self.update_networks_queue()
+        return backlog > 0
+
     def quit(self):
         self.clients_stop()
+        if self.async_engine is not None:
+            self.async_engine.stop()
 
         if self.map is not None:
             lat = self.map.osm.get_property("latitude")
@@ -338,7 +494,9 @@ class Core:
         while None in self.config['servers']:
             self.config['servers'].remove(None)
         self.config_handler.write()
-        self.networks.save(self.networks_file, force=True)
+        self.networks.stop_loading()
+        if self.save_networks:
+            self.networks.save(self.networks_file, force=True)
         if self.config['tracks']['store']:
             self.tracks.save()
 
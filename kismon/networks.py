@@ -29,7 +29,6 @@ POSSIBILITY OF SUCH DAMAGE.
 """
 
 import os
-import simplejson as json
 import xml.parsers.expat
 import locale
 from gi.repository import GLib
@@ -37,6 +36,8 @@ import zipfile
 import re
 
 from kismon.client_rest import *
+from kismon.networkstore import open_store, dump_networks, copy_network
+from kismon.background import BackgroundTasks
 import kismon.utils as utils
 
 
@@ -58,38 +59,143 @@ class Networks:
         self.autosave_task = None
         self.autosave_filename = None
         self.autosave_notify = None
+        self.journal_task = None
+        self.store = None
+        self.changed = set()
+        self.tasks = None
+        self.last_store_task = None
+        self.loading = False
+        self.loading_stopped = False
+        self.load_batch_size = 2000
+        # added during the load and not merged with the stored record yet
+        self.unmerged = set()
+        self.saving = False
+        # snapshots that are being written right now
+        self.shared_networks = []
 
     def get_network(self, mac):
         return self.networks[mac]
 
+    def get_store(self, filename):
+        if self.store is not None and self.store.filename == filename:
+            return self.store
+        num_backups = self.config["networks"]["num_backups"] if self.config is not None else 5
+        return open_store(filename, num_backups)
+
+    def set_store(self, store):
+        if self.store is not None and self.store is not store:
+            self.store.close()
+        self.store = store
+
     def save(self, filename, notify=None, force=False):
-        if self.queue_running and not force:
-            self.logger.info("Не удается сохранить сети - очередь запущена")
+        """Сохраняет сети в фоновом потоке, с force ждёт окончания записи
+        """
+        if self.loading:
+            # a snapshot taken now would miss the networks that are not loaded yet,
+            # so the file to save into is not even opened before the load is done
+            if force:
+                # the load thread is done or stopped after this
+                self.wait_store_tasks()
+                self.merge_unloaded()
+            self.flush_changes()
+            if force:
+                self.wait_store_tasks()
             return True
 
+        store = self.get_store(filename)
+        if store is self.store:
+            self.flush_changes()
+            if not store.needs_compaction() or self.saving:
+                if force:
+                    self.wait_store_tasks()
+                return True
+
         msg = "сохранение %s сетей в %s" % (len(self.networks), filename)
         self.logger.info(msg)
         if notify is not None:
             notify("Kismon", msg)
 
-        tmpfilename = filename + ".new"
-        self.save_networks(tmpfilename)
-        for num in range(self.config["networks"]["num_backups"] - 2, -1, -1):
-            backup_filename = "%s.%s" % (filename, num)
-            if os.path.isfile(backup_filename):
-                os.rename(backup_filename, "%s.%s" % (filename, num + 1))
-
-        if os.path.isfile(filename):
-            os.rename(filename, filename + ".0")
-        os.rename(tmpfilename, filename)
+        old_store = self.store
+        self.store = store
+        self.changed = set()
+        self.saving = True
+        # the records are copied on write while the snapshot is in use
+        networks = dict(self.networks)
+
+        def save_snapshot():
+            if old_store is not None and old_store is not store:
+                old_store.close()
+            return store.save(networks)
+
+        def finish(size, duration):
+            self.saving = False
+            msg = "%s сетей сохранено в %s за %.1fсек" % (len(networks), filename, duration)
+            if size is not None:
+                msg += ", %s КБ" % (size // 1024)
+            self.logger.info(msg)
+            if notify is not None:
+                notify("Kismon", msg)
+
+        self.run_store_task(networks, save_snapshot, finish)
+        if force:
+            self.wait_store_tasks()
         return True
 
-    def save_networks(self, filename):
-        new_file = "%s.new" % filename
-        f = open(new_file, "w")
-        json.dump(self.networks, f, sort_keys=True, indent=2)
-        f.close()
-        os.rename(new_file, filename)
+    def flush_changes(self):
+        """Дописывает изменённые сети в хранилище, которое было загружено или сохранено
+        """
+        if self.store is None or not self.changed:
+            return
+        changed = self.changed - self.unmerged
+        # writing these would replace the stored record that is not loaded yet
+        self.changed = self.changed & self.unmerged
+        networks = {mac: self.networks[mac] for mac in changed if mac in self.networks}
+        if not networks:
+            return
+        self.run_store_task(networks, self.store.write, None, networks, list(networks))
+
+    def get_tasks(self):
+        if self.tasks is None:
+            self.tasks = BackgroundTasks(max_workers=1)
+        return self.tasks
+
+    def run_store_task(self, networks, function, callback, *args):
+        """Запись хранилища в фоновом потоке, по одной задаче за раз и по порядку
+        """
+        self.shared_networks.append(networks)
+
+        def finish(result, error, duration):
+            self.shared_networks.remove(networks)
+            if error is not None:
+                self.logger.error("Ошибка записи сетей: %s" % error)
+                self.saving = False
+            elif callback is not None:
+                callback(result, duration)
+
+        self.last_store_task = self.get_tasks().submit(finish, function, *args)
+
+    def wait_store_tasks(self):
+        if self.last_store_task is not None:
+            self.last_store_task.result()
+
+    def get_network_for_change(self, mac):
+        """Сеть, которую можно изменить, не затрагивая снимки в фоновой записи
+        """
+        network = self.networks[mac]
+        for networks in self.shared_networks:
+            if networks.get(mac) is network:
+                network = self.networks[mac] = copy_network(network)
+                break
+        return network
+
+    def set_comment(self, mac, comment):
+        self.get_network_for_change(mac)['comment'] = comment
+        self.changed.add(mac)
+
+    def save_networks(self, filename, networks=None):
+        if networks is None:
+            networks = self.networks
+        dump_networks(networks, filename)
 
     def set_autosave(self, minutes, filename=None, notify=None):
         if filename is not None:
@@ -100,34 +206,99 @@ class Networks:
         if self.autosave_task is not None:
             GLib.source_remove(self.autosave_task)
 
+        if self.journal_task is not None:
+            GLib.source_remove(self.journal_task)
+            self.journal_task = None
+
         if minutes > 0:
             self.autosave_task = GLib.timeout_add(minutes * 60 * 1000, self.save, self.autosave_filename,
                                                   self.autosave_notify)
+            journal_interval = self.config["networks"]["journal_interval"]
+            if journal_interval > 0:
+                self.journal_task = GLib.timeout_add_seconds(journal_interval, self.flush_journal)
+
+    def flush_journal(self):
+        self.flush_changes()
+        return True
 
     def load(self, filename):
-        f = open(filename)
+        self.logger.info("Загрузка %s" % os.path.basename(filename))
+        self.wait_store_tasks()
 
-        self.logger.info("Загрузка networks.json")
+        store = self.get_store(filename)
+        self.networks = store.load()
+        self.set_store(store)
+        self.changed = set()
 
-        self.networks = json.load(f)
+        self.logger.info("Всего сетей %d" % (len(self.networks)))
 
-        for mac in self.networks:
-            network = self.networks[mac]
-            if 'comment' not in network:
-                network['comment'] = ""
-            if 'servers' not in network:
-                network['servers'] = []
-            if 'crypt' not in network:
-                crypt = decode_cryptset(network['cryptset'], return_str=True)
-                if 'WEP,' in crypt and 'WPA' in crypt:
-                    crypt = crypt.replace('WEP,', '')
-                network['crypt'] = crypt
-            if network["type"] in ('generic', 'probe', 'data'):
-                network["type"] = 'unknown'
+    def load_in_background(self, filename, callback=None):
+        """Загружает сети в фоновом потоке, сначала самые новые
 
-        f.close()
+        Пачки сетей добавляются в главном цикле, сети от серверов можно
+        добавлять до окончания загрузки. callback(count, error) вызывается в конце.
+        """
+        self.logger.info("Загрузка %s" % os.path.basename(filename))
+        store = self.get_store(filename)
+        self.set_store(store)
+        self.changed = set()
+        self.loading = True
+        self.loading_stopped = False
+        tasks = self.get_tasks()
+
+        def load():
+            count = 0
+            batch = []
+            for mac, network in store.iter_networks():
+                if self.loading_stopped:
+                    break
+                batch.append((mac, network))
+                count += 1
+                if len(batch) >= self.load_batch_size:
+                    tasks.dispatch(self.add_loaded_networks, batch)
+                    batch = []
+            if batch:
+                tasks.dispatch(self.add_loaded_networks, batch)
+            return count
+
+        def finish(count, error, duration):
+            # dispatched after the last batch, what is still unmerged is not in the store
+            self.loading = False
+            self.unmerged = set()
+            if error is None:
+                self.logger.info("Всего сетей %d, %d загружено за %.1fсек" % (len(self.networks), count, duration))
+            else:
+                self.logger.error("Ошибка загрузки %s: %s" % (filename, error))
+            if callback is not None:
+                callback(count, error)
+
+        self.last_store_task = tasks.submit(finish, load)
+
+    def add_loaded_networks(self, networks):
+        macs = []
+        for mac, network in networks:
+            if mac in self.networks:
+                # seen by a server before the load got here
+                self.add_network_data(mac, network)
+                self.unmerged.discard(mac)
+            else:
+                self.networks[mac] = network
+                macs.append(mac)
 
-        self.logger.info("Всего сетей %d" % (len(self.networks)))
+        self.apply_filters_on_networks(macs)
+        self.disable_refresh()
+        self.start_queue()
+
+    def stop_loading(self):
+        self.loading_stopped = True
+
+    def merge_unloaded(self):
+        """Сливает сети, добавленные во время загрузки, с их ещё не загруженными записями
+        """
+        stored = self.store.get_networks(self.unmerged)
+        self.unmerged = set()
+        for mac in stored:
+            self.add_network_data(mac, stored[mac])
 
     def apply_filters(self):
         self.stop_queue()
@@ -248,108 +419,67 @@ class Networks:
         self.notify_add_queue = {}
 
     def add_device_data(self, device, server_id):
-        mac = device['kismet.device.base.macaddr']
-
-        new_channel = device['kismet.device.base.channel']
-        if new_channel.isdigit():
-            new_channel = int(new_channel)
-        else:
-            new_channel = 0
-
-        if 'dot11.device.advertised_ssid_map' in device['dot11.device']:
-            ssid_map = device['dot11.device']['dot11.device.advertised_ssid_map']
-            if len(ssid_map) > 1:
-                self.logger.error("для выполнения: несколько SSID на устройство %s" % mac)
-        else:
-            ssid_map = []
-
-        new_cryptset = 0
-        new_ssid = ''
-        if len(ssid_map) > 0:
-            for ssid_entry in ssid_map:
-                new_ssid = ssid_entry['dot11.advertisedssid.ssid']
-                new_cryptset = ssid_entry['dot11.advertisedssid.crypt_set']
-                break
-
-        if new_ssid == '' and 'dot11.device.last_beaconed_ssid' in device['dot11.device']:
-            new_ssid = device['dot11.device']['dot11.device.last_beaconed_ssid']
-
-        try:
-            location = device['kismet.device.base.location']
-        except KeyError:
-            location = None
-        if location and location['kismet.common.location.loc_fix'] >= 2:
-            new_lat = location['kismet.common.location.avg_loc']['kismet.common.location.geopoint'][1]
-            new_lon = location['kismet.common.location.avg_loc']['kismet.common.location.geopoint'][0]
-            gps_fix = True
-        else:
-            new_lat = 0
-            new_lon = 0
-            gps_fix = False
-
-        if device['kismet.common.signal.type'] == 'dbm':
-            signal_dbm_min = device['kismet.common.signal.min_signal']
-            signal_dbm_max = device['kismet.common.signal.max_signal']
-            signal_dbm_last = device['kismet.common.signal.last_signal']
-        else:
-            signal_dbm_min = 0
-            signal_dbm_max = 0
-            signal_dbm_last = 0
+        """device - запись DeviceRecord, разобранная клиентом
+        """
+        mac = device.mac
 
         if mac not in self.networks:
             network = {
-                "type": decode_network_typeset(device['dot11.device']['dot11.device.typeset']),
-                "channel": new_channel,
-                "firsttime": device['kismet.device.base.first_time'],
-                "lasttime": device['kismet.device.base.last_time'],
-                "lat": new_lat,
-                "lon": new_lon,
-                "manuf": device['kismet.device.base.manuf'],
-                "ssid": new_ssid,
-                "cryptset": new_cryptset,
-                "crypt": device['kismet.device.base.crypt'],
+                "type": device.type,
+                "channel": device.channel,
+                "firsttime": device.first_time,
+                "lasttime": device.last_time,
+                "lat": device.lat,
+                "lon": device.lon,
+                "manuf": device.manuf,
+                "ssid": device.ssid,
+                "cryptset": device.cryptset,
+                "crypt": device.crypt,
                 "signal_dbm": {
-                    "min": signal_dbm_min,
-                    "max": signal_dbm_max,
-                    "last": signal_dbm_last,
+                    "min": device.signal_min,
+                    "max": device.signal_max,
+                    "last": device.signal_last,
                 },
                 "comment": '',
                 "servers": [],
             }
             self.networks[mac] = network
+            if self.loading:
+                self.unmerged.add(mac)
         else:
-            network = self.networks[mac]
+            network = self.get_network_for_change(mac)
             if "signal_dbm" not in network or network["signal_dbm"]['max'] == 0:
                 network["signal_dbm"] = {
-                    "min": signal_dbm_min,
-                    "max": signal_dbm_max,
-                    "last": signal_dbm_last,
+                    "min": device.signal_min,
+                    "max": device.signal_max,
+                    "last": device.signal_last,
                 }
             if 'comment' not in network:
                 network['comment'] = ''
 
-            if device['kismet.device.base.last_time'] > network["lasttime"]:
-                if gps_fix and ((network["signal_dbm"]["max"] < signal_dbm_max and signal_dbm_max != 0) or
-                                (network["lat"] == 0 and network["lon"] == 0)):
-                    network["lat"] = new_lat
-                    network["lon"] = new_lon
+            if device.last_time > network["lasttime"]:
+                if device.gps_fix and ((network["signal_dbm"]["max"] < device.signal_max and device.signal_max != 0) or
+                                       (network["lat"] == 0 and network["lon"] == 0)):
+                    network["lat"] = device.lat
+                    network["lon"] = device.lon
 
-                network["channel"] = new_channel
-                network["lasttime"] = device['kismet.device.base.last_time']
-                network["cryptset"] = new_cryptset
-                network["crypt"] = device['kismet.device.base.crypt']
-                network["signal_dbm"]["last"] = signal_dbm_last
-                network["ssid"] = new_ssid
+                network["channel"] = device.channel
+                network["lasttime"] = device.last_time
+                network["cryptset"] = device.cryptset
+                network["crypt"] = device.crypt
+                network["signal_dbm"]["last"] = device.signal_last
+                network["ssid"] = device.ssid
 
-            network["firsttime"] = min(network["firsttime"], device['kismet.device.base.first_time'])
-            network["signal_dbm"]["min"] = min(network["signal_dbm"]["min"], signal_dbm_min)
-            network["signal_dbm"]["max"] = min(network["signal_dbm"]["max"], signal_dbm_max)
-            network["type"] = decode_network_typeset(device['dot11.device']['dot11.device.typeset'])
+            network["firsttime"] = min(network["firsttime"], device.first_time)
+            network["signal_dbm"]["min"] = min(network["signal_dbm"]["min"], device.signal_min)
+            network["signal_dbm"]["max"] = min(network["signal_dbm"]["max"], device.signal_max)
+            network["type"] = device.type
 
             server_uri = self.config['servers'][server_id]['uri']
             if server_uri not in network['servers']:
                 network['servers'].append(server_uri)
 
+        self.changed.add(mac)
         self.notify_add(mac)
 
     def add_network_data(self, mac, data):
@@ -362,10 +492,13 @@ class Networks:
             if 'servers' not in data:
                 data['servers'] = []
             self.networks[mac] = data
+            if self.loading:
+                self.unmerged.add(mac)
+            self.changed.add(mac)
             self.notify_add(mac)
             return
 
-        network = self.networks[mac]
+        network = self.get_network_for_change(mac)
         signal = False
         data_signal = False
 
@@ -389,6 +522,12 @@ class Networks:
         if network["manuf"] == "":
             network["manuf"] = data["manuf"]
 
+        if network.get("comment", "") == "" and data.get("comment"):
+            network["comment"] = data["comment"]
+        for server_uri in data.get("servers", []):
+            if server_uri not in network["servers"]:
+                network["servers"].append(server_uri)
+
         network["firsttime"] = min(network["firsttime"], data["firsttime"])
         if signal and data_signal:
             network["signal_dbm"]["min"] = min(network["signal_dbm"]["min"], data["signal_dbm"]["min"])
@@ -396,6 +535,7 @@ class Networks:
         elif data_signal:
             network["signal_dbm"] = data["signal_dbm"]
 
+        self.changed.add(mac)
         self.notify_add(mac)
 
     def import_networks(self, filetype, filename):
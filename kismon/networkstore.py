@@ -0,0 +1,360 @@
+import os
+import sqlite3
+import simplejson as json
+
+from kismon.client_rest import decode_cryptset
+import kismon.snapshot as snapshot
+
+
+def fix_network(network):
+    """Дополняет записи из старых версий kismon
+    """
+    if 'comment' not in network:
+        network['comment'] = ""
+    if 'servers' not in network:
+        network['servers'] = []
+    if 'crypt' not in network:
+        crypt = decode_cryptset(network['cryptset'], return_str=True)
+        if 'WEP,' in crypt and 'WPA' in crypt:
+            crypt = crypt.replace('WEP,', '')
+        network['crypt'] = crypt
+    if network["type"] in ('generic', 'probe', 'data'):
+        network["type"] = 'unknown'
+    return network
+
+
+def copy_network(network):
+    network = dict(network)
+    if "signal_dbm" in network:
+        network["signal_dbm"] = dict(network["signal_dbm"])
+    network["servers"] = list(network.get("servers", []))
+    return network
+
+
+def write_json(networks, filename):
+    with open(filename, "w") as f:
+        json.dump(networks, f, sort_keys=True, indent=2)
+
+
+def write_binary(networks, filename):
+    with open(filename, "wb") as f:
+        snapshot.dump(networks, f)
+
+
+def dump_networks(networks, filename):
+    """Записывает снимок сетей, .bin в двоичном формате, иначе в json
+    """
+    new_file = "%s.new" % filename
+    if filename.endswith(".bin"):
+        write_binary(networks, new_file)
+    else:
+        write_json(networks, new_file)
+    os.rename(new_file, filename)
+
+
+def rotate_backups(filename, num_backups):
+    for num in range(num_backups - 2, -1, -1):
+        backup_filename = "%s.%s" % (filename, num)
+        if os.path.isfile(backup_filename):
+            os.rename(backup_filename, "%s.%s" % (filename, num + 1))
+
+    if os.path.isfile(filename):
+        os.rename(filename, filename + ".0")
+
+
+class JsonStore:
+    """networks.json и журнал изменений networks.json.journal
+
+    Изменённые сети дописываются в журнал, при сжатии журнал
+    переносится в новый снимок с резервными копиями.
+    """
+
+    def __init__(self, filename, num_backups=5):
+        self.filename = filename
+        self.journal_filename = filename + ".journal"
+        self.num_backups = num_backups
+
+    def read_snapshot(self):
+        with open(self.filename) as f:
+            return json.load(f)
+
+    def write_snapshot(self, networks, filename):
+        write_json(networks, filename)
+
+    def load(self):
+        self.recover()
+        networks = {}
+        if os.path.isfile(self.filename):
+            networks = self.read_snapshot()
+        self.replay_journal(networks)
+        for mac in networks:
+            fix_network(networks[mac])
+        return networks
+
+    def iter_networks(self):
+        """Сети по одной, сначала самые новые, json приходится прочитать целиком
+        """
+        networks = self.load()
+        for mac in sorted(networks, key=lambda mac: snapshot.get_lasttime(networks[mac]), reverse=True):
+            yield mac, networks[mac]
+
+    def get_networks(self, macs):
+        networks = self.load()
+        return {mac: networks[mac] for mac in macs if mac in networks}
+
+    def replay_journal(self, networks):
+        if not os.path.isfile(self.journal_filename):
+            return 0
+        count = 0
+        with open(self.journal_filename) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # cut off by a crash
+                    continue
+                networks[entry["mac"]] = entry["network"]
+                count += 1
+        return count
+
+    def save(self, networks):
+        """Новый снимок заменяет и старый снимок, и журнал
+
+        Журнал может содержать более старые версии сетей, чем снимок,
+        поэтому он откладывается в .old до замены снимка и после этого
+        не применяется. Прерванное сохранение завершает recover.
+        """
+        tmpfilename = self.filename + ".new"
+        old_journal = self.journal_filename + ".old"
+        if os.path.isfile(old_journal):
+            # left by a save that got as far as replacing the snapshot
+            os.remove(old_journal)
+        self.write_snapshot(networks, tmpfilename)
+        if os.path.isfile(self.journal_filename):
+            os.rename(self.journal_filename, old_journal)
+        rotate_backups(self.filename, self.num_backups)
+        os.rename(tmpfilename, self.filename)
+        if os.path.isfile(old_journal):
+            os.remove(old_journal)
+        return os.path.getsize(self.filename)
+
+    def recover(self):
+        """Завершает сохранение, прерванное после записи снимка
+        """
+        old_journal = self.journal_filename + ".old"
+        if not os.path.isfile(old_journal):
+            return
+        tmpfilename = self.filename + ".new"
+        if os.path.isfile(tmpfilename):
+            # complete, the journal is only moved aside after the snapshot is written
+            if os.path.isfile(self.filename):
+                rotate_backups(self.filename, self.num_backups)
+            os.rename(tmpfilename, self.filename)
+        os.remove(old_journal)
+
+    def write(self, networks, macs):
+        lines = []
+        for mac in macs:
+            if mac in networks:
+                lines.append(json.dumps({"mac": mac, "network": networks[mac]}) + "\n")
+        if not lines:
+            return
+        with open(self.journal_filename, "a+b") as f:
+            if f.tell() > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    # don't glue the first record to a line cut off by a crash
+                    lines.insert(0, "\n")
+            f.write("".join(lines).encode())
+            f.flush()
+            os.fsync(f.fileno())
+
+    def needs_compaction(self):
+        """Журнал стал больше половины снимка
+        """
+        if not os.path.isfile(self.journal_filename):
+            return False
+        journal_size = os.path.getsize(self.journal_filename)
+        if journal_size == 0:
+            return False
+        if not os.path.isfile(self.filename):
+            return True
+        return journal_size > os.path.getsize(self.filename) // 2
+
+    def close(self):
+        pass
+
+
+class BinaryStore(JsonStore):
+    """Двоичный снимок networks.bin с тем же журналом
+    """
+    def read_snapshot(self):
+        with open(self.filename, "rb") as f:
+            return snapshot.load(f)
+
+    def write_snapshot(self, networks, filename):
+        write_binary(networks, filename)
+
+    def iter_networks(self):
+        """Сначала сети из журнала, они изменились последними, потом снимок
+        """
+        self.recover()
+        journal = {}
+        self.replay_journal(journal)
+        for mac in journal:
+            yield mac, fix_network(journal[mac])
+        if os.path.isfile(self.filename):
+            with open(self.filename, "rb") as f:
+                data = f.read()
+            for mac, network in snapshot.iter_networks(data):
+                if mac not in journal:
+                    yield mac, fix_network(network)
+
+
+class SqliteStore:
+    """Сети в базе SQLite, сохраняются только изменённые записи
+    """
+    columns = ('mac', 'type', 'channel', 'firsttime', 'lasttime', 'lat', 'lon', 'manuf', 'ssid',
+               'cryptset', 'crypt', 'signal_min', 'signal_max', 'signal_last', 'comment', 'servers', 'extra')
+    # keys stored in their own columns, everything else ends up as json in 'extra'
+    known_keys = frozenset(('type', 'channel', 'firsttime', 'lasttime', 'lat', 'lon', 'manuf', 'ssid',
+                            'cryptset', 'crypt', 'signal_dbm', 'comment', 'servers'))
+    batch_size = 5000
+
+    def __init__(self, filename):
+        self.filename = filename
+        # opened on first use, a store that is never written does not create a file
+        self.db = None
+        self.upsert = "INSERT OR REPLACE INTO networks (%s) VALUES (%s)" % (
+            ", ".join(self.columns), ", ".join("?" * len(self.columns)))
+
+    def open_database(self, filename):
+        # only used by one thread at a time, the writes run in the save thread of Networks
+        db = sqlite3.connect(filename, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        # channel without a type, kismet reports numbers and strings like "6HT40+"
+        db.execute("""CREATE TABLE IF NOT EXISTS networks (
+            mac TEXT PRIMARY KEY, type TEXT, channel, firsttime INTEGER, lasttime INTEGER,
+            lat REAL, lon REAL, manuf TEXT, ssid TEXT, cryptset INTEGER, crypt TEXT,
+            signal_min INTEGER, signal_max INTEGER, signal_last INTEGER,
+            comment TEXT, servers TEXT, extra TEXT)""")
+        for column in ('lasttime', 'ssid', 'channel', 'crypt'):
+            db.execute("CREATE INDEX IF NOT EXISTS networks_%s ON networks (%s)" % (column, column))
+        db.commit()
+        return db
+
+    def connect(self):
+        if self.db is None:
+            self.db = self.open_database(self.filename)
+        return self.db
+
+    def network_to_row(self, mac, network):
+        signal = network.get('signal_dbm')
+        if signal is None:
+            signal = {}
+        extra = {key: value for key, value in network.items() if key not in self.known_keys}
+        return (mac, network['type'], network['channel'], network['firsttime'], network['lasttime'],
+                network['lat'], network['lon'], network['manuf'], network['ssid'],
+                network['cryptset'], network.get('crypt'),
+                signal.get('min'), signal.get('max'), signal.get('last'),
+                network.get('comment', ''), json.dumps(network.get('servers', [])),
+                json.dumps(extra) if extra else None)
+
+    def row_to_network(self, row):
+        (mac, network_type, channel, firsttime, lasttime, lat, lon, manuf, ssid, cryptset, crypt,
+         signal_min, signal_max, signal_last, comment, servers, extra) = row
+        network = {
+            "type": network_type,
+            "channel": channel,
+            "firsttime": firsttime,
+            "lasttime": lasttime,
+            "lat": lat,
+            "lon": lon,
+            "manuf": manuf,
+            "ssid": ssid,
+            "cryptset": cryptset,
+            "comment": comment,
+            "servers": json.loads(servers) if servers else [],
+        }
+        if crypt is not None:
+            network["crypt"] = crypt
+        if signal_min is not None:
+            network["signal_dbm"] = {"min": signal_min, "max": signal_max, "last": signal_last}
+        if extra:
+            network.update(json.loads(extra))
+        return mac, fix_network(network)
+
+    def load(self):
+        return dict(self.iter_networks())
+
+    def iter_networks(self):
+        cursor = self.connect().execute("SELECT %s FROM networks ORDER BY lasttime DESC" % ", ".join(self.columns))
+        for row in cursor:
+            yield self.row_to_network(row)
+
+    def get_networks(self, macs):
+        networks = {}
+        macs = list(macs)
+        for start in range(0, len(macs), 500):
+            chunk = macs[start:start + 500]
+            cursor = self.connect().execute("SELECT %s FROM networks WHERE mac IN (%s)" % (
+                ", ".join(self.columns), ", ".join("?" * len(chunk))), chunk)
+            for row in cursor:
+                mac, network = self.row_to_network(row)
+                networks[mac] = network
+        return networks
+
+    def write(self, networks, macs, db=None):
+        """Записывает сети из macs, по batch_size записей за транзакцию
+        """
+        if db is None:
+            db = self.connect()
+        rows = []
+        for mac in macs:
+            if mac in networks:
+                rows.append(self.network_to_row(mac, networks[mac]))
+            if len(rows) >= self.batch_size:
+                self.write_rows(db, rows)
+                rows = []
+        if rows:
+            self.write_rows(db, rows)
+
+    def write_rows(self, db, rows):
+        with db:
+            db.executemany(self.upsert, rows)
+
+    def save(self, networks):
+        """Записывает все сети в новую базу, файл появляется только целиком
+        """
+        tmpfilename = self.filename + ".new"
+        for name in (tmpfilename, tmpfilename + "-wal", tmpfilename + "-shm"):
+            if os.path.isfile(name):
+                os.remove(name)
+        db = self.open_database(tmpfilename)
+        self.write(networks, list(networks), db)
+        # the last connection checkpoints and removes the -wal file
+        db.close()
+
+        self.close()
+        for name in (self.filename + "-wal", self.filename + "-shm"):
+            if os.path.isfile(name):
+                os.remove(name)
+        os.rename(tmpfilename, self.filename)
+        return os.path.getsize(self.filename)
+
+    def needs_compaction(self):
+        return False
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+
+def open_store(filename, num_backups=5):
+    if filename.endswith(".sqlite"):
+        return SqliteStore(filename)
+    if filename.endswith(".bin"):
+        return BinaryStore(filename, num_backups)
+    return JsonStore(filename, num_backups)
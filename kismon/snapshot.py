@@ -0,0 +1,180 @@
+import struct
+import simplejson as json
+
+MAGIC = b"KSNP"
+VERSION = 1
+
+# magic, version, number of strings, number of networks
+HEADER = struct.Struct("<4sHII")
+STRING = struct.Struct("<I")
+# mac, flags, type, channel, firsttime, lasttime, lat, lon, ssid, manuf, crypt, cryptset,
+# signal min/max/last, comment, extra, number of servers
+RECORD = struct.Struct("<6sBIiqqddIIIqiiiIIH")
+SERVER = struct.Struct("<I")
+
+FLAG_SIGNAL = 1
+FLAG_CRYPT = 2
+FLAG_CHANNEL_INT = 4
+FLAG_MAC_LOWER = 8
+
+INT64 = (-2 ** 63, 2 ** 63 - 1)
+INT32 = (-2 ** 31, 2 ** 31 - 1)
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def is_int(value, limits=INT64):
+    return type(value) is int and limits[0] <= value <= limits[1]
+
+
+class StringTable:
+    def __init__(self):
+        self.strings = [""]
+        self.index = {"": 0}
+
+    def add(self, string):
+        try:
+            return self.index[string]
+        except KeyError:
+            self.index[string] = len(self.strings)
+            self.strings.append(string)
+            return self.index[string]
+
+
+def pack_network(mac, network, strings):
+    """Значения, которые не помещаются в поля записи, сохраняются как json в extra
+    """
+    extra = {}
+
+    def get(key, check, default):
+        if key not in network:
+            return default
+        value = network[key]
+        if check(value):
+            return value
+        extra[key] = value
+        return default
+
+    def get_string(key):
+        return strings.add(get(key, lambda value: type(value) is str, ""))
+
+    for key in network:
+        if key not in ('type', 'channel', 'firsttime', 'lasttime', 'lat', 'lon', 'ssid', 'manuf', 'crypt',
+                       'cryptset', 'signal_dbm', 'comment', 'servers'):
+            extra[key] = network[key]
+
+    flags = 0
+    if mac.lower() == mac and mac.upper() != mac:
+        flags |= FLAG_MAC_LOWER
+    mac_bytes = int(mac.replace(":", ""), 16).to_bytes(6, "big")
+
+    channel = network.get("channel", "")
+    if is_int(channel, INT32):
+        flags |= FLAG_CHANNEL_INT
+    else:
+        channel = get_string("channel")
+
+    if "crypt" in network:
+        flags |= FLAG_CRYPT
+
+    signal = network.get("signal_dbm")
+    signal_values = (0, 0, 0)
+    if signal is not None:
+        if type(signal) is dict and sorted(signal) == ["last", "max", "min"] and \
+                all(is_int(signal[key], INT32) for key in signal):
+            flags |= FLAG_SIGNAL
+            signal_values = (signal["min"], signal["max"], signal["last"])
+        else:
+            extra["signal_dbm"] = signal
+
+    servers = get("servers", lambda value: type(value) is list and all(type(uri) is str for uri in value), [])
+    record = RECORD.pack(
+        mac_bytes, flags, get_string("type"), channel,
+        get("firsttime", is_int, 0), get("lasttime", is_int, 0),
+        get("lat", lambda value: type(value) is float, 0.0), get("lon", lambda value: type(value) is float, 0.0),
+        get_string("ssid"), get_string("manuf"), get_string("crypt"),
+        get("cryptset", is_int, 0),
+        signal_values[0], signal_values[1], signal_values[2],
+        get_string("comment"), strings.add(json.dumps(extra)) if extra else 0,
+        len(servers))
+    return record + b"".join(SERVER.pack(strings.add(uri)) for uri in servers)
+
+
+def dump(networks, f):
+    """Записывает сети в двоичный снимок, сначала самые новые
+    """
+    strings = StringTable()
+    records = []
+    for mac in sorted(networks, key=lambda mac: get_lasttime(networks[mac]), reverse=True):
+        records.append(pack_network(mac, networks[mac], strings))
+
+    f.write(HEADER.pack(MAGIC, VERSION, len(strings.strings), len(records)))
+    for string in strings.strings:
+        data = string.encode("utf-8")
+        f.write(STRING.pack(len(data)))
+        f.write(data)
+    f.write(b"".join(records))
+
+
+def get_lasttime(network):
+    lasttime = network.get("lasttime", 0)
+    return lasttime if type(lasttime) in (int, float) else 0
+
+
+def iter_networks(data):
+    """Разбирает снимок из bytes, сети выдаются в порядке записи
+    """
+    if len(data) < HEADER.size:
+        raise SnapshotError("snapshot too short")
+    magic, version, num_strings, num_networks = HEADER.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise SnapshotError("not a kismon snapshot")
+    if version != VERSION:
+        raise SnapshotError("unsupported snapshot version %s" % version)
+
+    offset = HEADER.size
+    strings = []
+    for num in range(num_strings):
+        length, = STRING.unpack_from(data, offset)
+        offset += STRING.size
+        strings.append(data[offset:offset + length].decode("utf-8"))
+        offset += length
+
+    for num in range(num_networks):
+        (mac_bytes, flags, network_type, channel, firsttime, lasttime, lat, lon, ssid, manuf, crypt, cryptset,
+         signal_min, signal_max, signal_last, comment, extra, num_servers) = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+        servers = [strings[SERVER.unpack_from(data, offset + pos * SERVER.size)[0]] for pos in range(num_servers)]
+        offset += num_servers * SERVER.size
+
+        mac = mac_bytes.hex()
+        mac = ":".join(mac[pos:pos + 2] for pos in range(0, 12, 2))
+        if not flags & FLAG_MAC_LOWER:
+            mac = mac.upper()
+
+        network = {
+            "type": strings[network_type],
+            "channel": channel if flags & FLAG_CHANNEL_INT else strings[channel],
+            "firsttime": firsttime,
+            "lasttime": lasttime,
+            "lat": lat,
+            "lon": lon,
+            "ssid": strings[ssid],
+            "manuf": strings[manuf],
+            "cryptset": cryptset,
+            "comment": strings[comment],
+            "servers": servers,
+        }
+        if flags & FLAG_CRYPT:
+            network["crypt"] = strings[crypt]
+        if flags & FLAG_SIGNAL:
+            network["signal_dbm"] = {"min": signal_min, "max": signal_max, "last": signal_last}
+        if extra:
+            network.update(json.loads(strings[extra]))
+        yield mac, network
+
+
+def load(f):
+    return dict(iter_networks(f.read()))
@@ -67,7 +67,7 @@ def get_client_test_data():
 def core_tests(test_core):
     test_networks = networks()
     test_core.networks = test_networks
-    test_core.client_threads[0].client.queue = get_client_test_data()
+    test_core.client_threads[0].client.load_queue(get_client_test_data())
     test_core.queue_handler(0)
     test_core.queue_handler_networks(0)
     task = test_core.networks.notify_add_queue_process()
@@ -76,6 +76,95 @@ def core_tests(test_core):
     test_core.quit()
 
 
+def start_event_server(events):
+    """Local stand-in for the Kismet websocket endpoints, sends the
+    frames in events[path] after the subscriptions were received
+    """
+    import json
+    import socketserver
+    import threading
+    from kismon.client_stream import get_accept_key, encode_frame, read_frame, WebSocketError
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            path = self.rfile.readline().decode().split(" ")[1]
+            headers = {}
+            while True:
+                line = self.rfile.readline().decode().strip()
+                if line == "":
+                    break
+                name, _, value = line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+            self.server.requests.append((path, headers))
+            self.wfile.write(("HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\n"
+                              "Connection: Upgrade\r\nSec-WebSocket-Accept: %s\r\n\r\n" %
+                              get_accept_key(headers['sec-websocket-key'])).encode())
+            path_events = events.get(path, {})
+            for x in range(path_events.get('subscriptions', 1)):
+                read_frame(self.rfile)
+            for frame in path_events.get('frames', []):
+                self.wfile.write(encode_frame(json.dumps(frame), mask=False))
+            if path_events.get('close', False):
+                return
+            try:
+                while True:
+                    read_frame(self.rfile)
+            except WebSocketError:
+                pass
+
+    socketserver.ThreadingTCPServer.allow_reuse_address = True
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    server.requests = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def start_http_server(routes):
+    """Local stand-in for the Kismet REST API, routes maps a path prefix
+    to a callable returning (status, body), the body is gzip compressed
+    when the client accepts it
+    """
+    import gzip
+    import http.server
+    import threading
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            return
+
+        def respond(self):
+            length = int(self.headers.get('Content-Length', 0))
+            post_data = self.rfile.read(length).decode() if length else ''
+            self.server.requests.append((self.command, self.path, post_data))
+            path = self.path.split('?')[0]
+            status, body = 404, 'not found'
+            for route in sorted(routes, key=len, reverse=True):
+                if path.startswith(route):
+                    status, body = routes[route](self.path, post_data)
+                    break
+            body = body.encode()
+            self.send_response(status)
+            if 'gzip' in self.headers.get('Accept-Encoding', ''):
+                body = gzip.compress(body)
+                self.send_header('Content-Encoding', 'gzip')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        do_GET = respond
+        do_POST = respond
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    server.requests = []
+    server.uri = "http://127.0.0.1:%s" % server.server_address[1]
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
 class TestWidget:
     def __init__(self):
         self.active = True
@@ -106,7 +195,7 @@ def gui_file_import_window():
     file_import_window = FileImportWindow(test_networks, main_window.networks_queue_progress)
     file_import_window.create_file_chooser("dir")
     filename = "%s%stest-networks-%s.json" % (tempfile.gettempdir(), os.sep, int(time.time()))
-    test_networks.save(filename)
+    test_networks.save(filename, force=True)
     file_import_window.add_file(filename)
     test_widget.text = "networks"
     file_import_window.on_filetype_changed(test_widget, filename)
@@ -121,6 +210,7 @@ def networks():
     from kismon.config import Config
     from kismon.networks import Networks
     from kismon.tracks import Tracks
+    from kismon.client_rest import normalize_device
 
     def dummy(bla):
         return
@@ -134,7 +224,7 @@ def networks():
     networks.notify_remove_list["map"] = dummy
     networks.notify_remove_list["network_list"] = dummy
     for device in test_data['dot11']:
-        networks.add_device_data(device, server_id=0)
+        networks.add_device_data(normalize_device(device), server_id=0)
 
     tmp_csv_file = "%s%stest-%s.csv" % (tempfile.gettempdir(), os.sep, int(time.time()))
     tmp_csv = open(tmp_csv_file, "w")
@@ -149,11 +239,11 @@ def networks():
     test_tracks = Tracks(tmp_tracks_file)
 
     networks_file = "%s%snetworks-%s.json" % (tempfile.gettempdir(), os.sep, int(time.time()))
-    networks.save(networks_file)
+    networks.save(networks_file, force=True)
     networks.load(networks_file)
     networks.import_networks("networks", networks_file)
     networks.apply_filters()
-    networks.save(networks_file)
+    networks.save(networks_file, force=True)
     networks.export_networks_netxml(tempfile.gettempdir() + os.sep + "test.netxml", networks.networks)
     networks.import_networks("netxml", tempfile.gettempdir() + os.sep + "test.netxml")
     networks.export_networks_kmz(tempfile.gettempdir() + os.sep + "test.kmz", networks.networks, tracks=test_tracks,
@@ -164,6 +254,33 @@ def networks():
     return networks
 
 
+def drop_once(function):
+    """Первый вызов function падает, как при обрыве связи
+    """
+    import requests
+    calls = []
+
+    def call(*args, **kwargs):
+        calls.append(args)
+        if len(calls) == 1:
+            raise requests.exceptions.ConnectionError("link dropped")
+        return function(*args, **kwargs)
+    return call
+
+
+def get_store_test_networks():
+    return {
+        "11:22:33:44:55:66": {"type": "infrastructure", "channel": 6, "firsttime": 100, "lasttime": 200,
+                              "lat": 52.5, "lon": 13.4, "manuf": "Foo", "ssid": "test", "cryptset": 1024,
+                              "crypt": "WPA2", "signal_dbm": {"min": -80, "max": -40, "last": -50},
+                              "comment": "", "servers": ["http://127.0.0.1:2501"]},
+        # imported from netxml, string channel, no signal and an unknown key
+        "11:22:33:44:55:77": {"type": "probe", "channel": "6HT40+", "firsttime": 50, "lasttime": 300,
+                              "lat": 0.0, "lon": 0.0, "manuf": "", "ssid": "", "cryptset": 0,
+                              "comment": "note", "servers": [], "wps": True},
+    }
+
+
 class TestKismon(unittest.TestCase):
     def test_client(self):
         from kismon.client_rest import RestClient, RestClientThread, encode_cryptset, decode_cryptset
@@ -199,6 +316,923 @@ class TestKismon(unittest.TestCase):
     # client_thread.run()
     # client_thread.stop()
 
+    def test_client_schedule(self):
+        import threading
+        from kismon.client_rest import RestClientThread, PollSchedule
+        location_calls = []
+
+        def slow_devices():
+            time.sleep(0.3)
+
+        def location():
+            location_calls.append(time.monotonic())
+
+        client_thread = RestClientThread(logger=logger)
+        client_thread.client.connected = True
+        client_thread.is_running = True
+        client_thread.schedules = {
+            'devices': PollSchedule('devices', slow_devices, 0.1, logger=logger),
+            'location': PollSchedule('location', location, 0.05, logger=logger),
+        }
+        runner = threading.Thread(target=client_thread.run_schedules)
+        runner.start()
+        time.sleep(0.5)
+        client_thread.stop()
+        runner.join(2)
+        self.assertFalse(runner.is_alive())
+
+        stats = client_thread.get_schedule_stats()
+        # the slow device list does not hold back the location endpoint
+        self.assertGreaterEqual(len(location_calls), 5)
+        self.assertLess(stats['location']['max_lateness'], 0.1)
+        self.assertGreater(stats['devices']['max_lateness'], 0.1)
+
+    def test_client_push(self):
+        from kismon.client_rest import RestClient
+        test_data = get_client_test_data()
+        device = test_data['dot11'][0]
+        message = {'kismet.messagebus.message_string': 'test', 'kismet.messagebus.message_time': 1}
+        location = {'kismet.common.location.fix': 3, 'kismet.common.location.geopoint': [13.3, 52.5],
+                    'kismet.common.location.alt': 50}
+        events = {
+            '/devices/monitor.ws': {'frames': [device, [device]]},
+            '/eventbus/events.ws': {'subscriptions': 2, 'close': True,
+                                    'frames': [{'MESSAGE': message}, {'GPS_LOCATION': location}]},
+        }
+        server = start_event_server(events)
+        client = RestClient(logger=logger)
+        client.uri = "http://127.0.0.1:%s" % server.server_address[1]
+        client.credentials = ('kismet', 'secret')
+        client.get_schedules()
+        client.start_push()
+        for x in range(50):
+            if client.queue['dot11'].total == 2 and not client.streams[1].is_alive():
+                break
+            time.sleep(0.1)
+
+        # both frames carry the same device, the queue coalesces them
+        self.assertEqual(client.queue['dot11'].total, 2)
+        self.assertEqual(len(client.queue['dot11']), 1)
+        self.assertEqual(client.queue['messages'].drain(), [message])
+        self.assertEqual(client.queue['location'].drain(), [location])
+        self.assertTrue(server.requests[0][1]['authorization'].startswith('Basic '))
+        # the event bus fell back to polling, the devices are polled until the first full list arrived
+        self.assertTrue(client.schedules['messages'].enabled)
+        self.assertTrue(client.schedules['location'].enabled)
+        self.assertTrue(client.schedules['devices'].enabled)
+        self.assertEqual(client.sync['devices'].high_water, 0)
+        client.finish_device_sync()
+        self.assertFalse(client.schedules['devices'].enabled)
+
+        # the server filter also applies to pushed devices
+        client.server_filter = {'enabled': True, 'ssid': '', 'bssid': '^ff:'}
+        client._handle_device_event(device)
+        self.assertEqual(client.queue['dot11'].total, 2)
+        # a new filter needs a new full list
+        self.assertTrue(client.schedules['devices'].enabled)
+        self.assertFalse(client.devices_synced)
+
+        client.stop_push()
+        server.shutdown()
+        server.server_close()
+
+    def test_client_adaptive_interval(self):
+        from kismon.client_rest import AdaptiveInterval
+        adaptive = AdaptiveInterval(interval=1, minimum=0.25, maximum=8, small_delta=10, large_delta=100,
+                                    queue_threshold=500)
+        self.assertEqual(adaptive.update(delta=2, queue_depth=0), 0.5)
+        self.assertEqual(adaptive.update(delta=2, queue_depth=0), 0.25)
+        self.assertEqual(adaptive.update(delta=2, queue_depth=0), 0.25)
+        self.assertEqual(adaptive.update(delta=50, queue_depth=0), 0.25)
+        self.assertEqual(adaptive.update(delta=1000, queue_depth=0), 0.5)
+        self.assertTrue(adaptive.reason.startswith("большая дельта"))
+        for x in range(10):
+            adaptive.update(delta=2, queue_depth=1000)
+        self.assertEqual(adaptive.interval, 8)
+        self.assertTrue(adaptive.reason.startswith("очередь GUI"))
+
+    def test_client_session(self):
+        import json
+        from kismon.client_rest import RestClient
+        devices = get_client_test_data()['dot11']
+        routes = {
+            '/system/timestamp.json': lambda path, data: (200, json.dumps({'kismet.system.timestamp.sec': 1})),
+            '/devices/last-time/-5/devices.itjson': lambda path, data: (
+                200, "\n".join(json.dumps(device) for device in devices)),
+        }
+        server = start_http_server(routes)
+        client = RestClient(logger=logger)
+        client.uri = server.uri
+        for x in range(3):
+            self.assertTrue(client._simple_server_check())
+        self.assertEqual(list(client.stream_request('devices/last-time/-5/devices.itjson', {})), devices)
+
+        stats = client.get_connection_stats()
+        self.assertEqual(stats['requests'], 4)
+        self.assertEqual(stats['connections'], 1)
+        self.assertEqual(stats['compressed'], 4)
+        self.assertAlmostEqual(stats['reuse'], 0.75)
+        server.shutdown()
+        server.server_close()
+
+    def test_client_server_filter(self):
+        import json
+        import urllib.parse
+        from kismon.client_rest import RestClient
+        import re
+        devices = get_client_test_data()['dot11']
+
+        def device_list(path, data):
+            # Kismet matches the MAC regex case-sensitive
+            regex = dict(json.loads(urllib.parse.parse_qs(data)['json'][0]).get('regex', []))
+            mac_regex = regex.get('kismet.device.base.macaddr')
+            return 200, "\n".join(json.dumps(device) for device in devices
+                                  if mac_regex is None or re.search(mac_regex, device['kismet.device.base.macaddr']))
+
+        routes = {'/devices/views/phy-IEEE802.11/last-time/': device_list}
+        server = start_http_server(routes)
+        client = RestClient(logger=logger)
+        client.uri = server.uri
+        client.server_filter = {'enabled': True, 'ssid': '^(GARTEN|Kunz)', 'bssid': '^e2:'}
+        self.assertEqual(client.get_updated_devices(), 1)
+        self.assertEqual([device.mac for device in client.queue['dot11'].drain()],
+                         ['E2:28:6D:22:33:44'])
+        payload = json.loads(urllib.parse.parse_qs(server.requests[-1][2])['json'][0])
+        # the lower case BSSID is sent case-insensitive
+        self.assertIn(['kismet.device.base.macaddr', '(?i)^e2:'], payload['regex'])
+        self.assertIn(['dot11.device/dot11.device.last_beaconed_ssid', '^(GARTEN|Kunz)'], payload['regex'])
+
+        # older servers without phy views
+        del routes['/devices/views/phy-IEEE802.11/last-time/']
+        routes['/devices/last-time/'] = device_list
+        client.server_filter['bssid'] = ''
+        self.assertEqual(client.get_updated_devices(), 2)
+        self.assertFalse(client.phy_view)
+        self.assertTrue(server.requests[-1][1].startswith('/devices/last-time/'))
+
+        # an invalid expression keeps the last valid filter instead of downloading everything
+        client.server_filter['ssid'] = '^(GAR'
+        client.get_updated_devices()
+        payload = json.loads(urllib.parse.parse_qs(server.requests[-1][2])['json'][0])
+        self.assertIn(['dot11.device/dot11.device.last_beaconed_ssid', '^(GARTEN|Kunz)'], payload['regex'])
+        self.assertEqual(client.sync_filter, client.device_filter.regex)
+        server.shutdown()
+        server.server_close()
+
+    def test_client_sync_window(self):
+        import json
+        from kismon.client_rest import RestClient, SyncWindow
+        devices = get_client_test_data()['dot11']
+        last_time = max(device['kismet.device.base.last_time'] for device in devices)
+        # the sensor clock is an hour behind the local clock
+        server_time = {'kismet.system.timestamp.sec': int(time.time()) - 3600,
+                       'kismet.system.timestamp.usec': 0}
+
+        def device_list(path, data):
+            return 200, "\n".join(json.dumps(device) for device in devices)
+
+        routes = {
+            '/system/timestamp.json': lambda path, data: (200, json.dumps(server_time)),
+            '/devices/last-time/': device_list,
+        }
+        server = start_http_server(routes)
+        client = RestClient(logger=logger)
+        client.uri = server.uri
+        self.assertTrue(client._simple_server_check())
+        self.assertAlmostEqual(client.clock_offset, -3600, delta=5)
+        self.assertAlmostEqual(client.get_server_time(), server_time['kismet.system.timestamp.sec'], delta=5)
+
+        self.assertEqual(client.get_updated_devices(), 3)
+        self.assertEqual(server.requests[-1][1], '/devices/last-time/1/devices.itjson')
+        # the overlapping second returns the same devices again
+        self.assertEqual(client.get_updated_devices(), 0)
+        self.assertEqual(server.requests[-1][1], '/devices/last-time/%s/devices.itjson' % (last_time - 1))
+
+        devices[0]['kismet.device.base.last_time'] = last_time + 1
+        self.assertEqual(client.get_updated_devices(), 1)
+        self.assertEqual(server.requests[-1][1], '/devices/last-time/%s/devices.itjson' % (last_time - 1))
+        self.assertEqual(client.get_updated_devices(), 0)
+        self.assertEqual(server.requests[-1][1], '/devices/last-time/%s/devices.itjson' % last_time)
+        self.assertEqual(len(client.queue['dot11'].drain()), 3)
+
+        # the device list is not sorted by last_time
+        for pos, device in enumerate(devices):
+            device['kismet.device.base.last_time'] = last_time + (10, 5, 8)[pos]
+        self.assertEqual(client.get_updated_devices(), 3)
+        # updated again within the second of the mark
+        devices[1]['kismet.device.base.last_time'] = last_time + 10
+        self.assertEqual(client.get_updated_devices(), 1)
+        self.assertEqual(server.requests[-1][1], '/devices/last-time/%s/devices.itjson' % (last_time + 9))
+        self.assertEqual(client.get_updated_devices(), 0)
+        server.shutdown()
+        server.server_close()
+
+        sync = SyncWindow()
+        sync.begin()
+        self.assertEqual([sync.accept(key, last_time) for key, last_time in (('a', 200), ('b', 150), ('c', 180))],
+                         [True, True, True])
+        sync.commit()
+        self.assertEqual((sync.high_water, sync.boundary), (200, {'a'}))
+        sync.begin()
+        self.assertEqual([sync.accept(key, last_time) for key, last_time in (('x', 204), ('a', 205), ('b', 204))],
+                         [True, True, True])
+        sync.rollback()
+        # an aborted response is requested again from the old mark
+        self.assertEqual(sync.high_water, 200)
+        sync.begin()
+        self.assertEqual([sync.accept(key, last_time) for key, last_time in (('a', 200), ('b', 204))], [False, True])
+        sync.commit()
+        self.assertEqual(sync.high_water, 204)
+
+    def test_client_async_engine(self):
+        import json
+        import threading
+        from kismon.client_async import AsyncClientEngine, AsyncClientHandle
+        from kismon.client_rest import CircuitBreaker
+        test_data = get_client_test_data()
+
+        def device_list(path, data):
+            return 200, "\n".join(json.dumps(device) for device in test_data['dot11'])
+
+        routes = {
+            '/system/timestamp.json': lambda path, data: (200, json.dumps({'kismet.system.timestamp.sec': 1})),
+            '/system/status.json': lambda path, data: (200, json.dumps(test_data['status'])),
+            '/devices/last-time/': device_list,
+            '/messagebus/last-time/': lambda path, data: (
+                200, json.dumps({'kismet.messagebus.list': test_data['messages']})),
+            '/datasource/all_sources.json': lambda path, data: (200, json.dumps(test_data['datasources'])),
+        }
+        servers = [start_http_server(routes) for x in range(3)]
+        engine = AsyncClientEngine(logger=logger)
+        handles = []
+        for server in servers:
+            handle = AsyncClientHandle(engine, uri=server.uri, logger=logger)
+            handles.append(handle)
+        # the link of the first server drops during the login
+        handles[0].breaker = CircuitBreaker(minimum=0.05, maximum=0.1)
+        handles[0].client.authenticate = drop_once(handles[0].client.authenticate)
+        for handle in handles:
+            handle.start()
+        for x in range(50):
+            if all(handle.client.queue['dot11'].total == 3 and handle.client.datasource_count is not None
+                   for handle in handles):
+                break
+            time.sleep(0.1)
+
+        # all servers share the one engine thread
+        names = [thread.name for thread in threading.enumerate()]
+        self.assertEqual(names.count('kismon-async'), 1)
+        self.assertNotIn('kismon-devices', names)
+        self.assertTrue(handles[0].client.error[0].startswith("не удалось подключиться"))
+        for handle in handles:
+            client = handle.client
+            self.assertTrue(handle.is_running)
+            self.assertEqual(client.queue['dot11'].total, 3)
+            self.assertEqual(client.queue['status'], test_data['status'])
+            self.assertEqual(len(client.queue['messages']), len(test_data['messages']))
+            self.assertEqual(client.queue['datasources'].drain(), test_data['datasources'])
+            self.assertEqual(handle.get_schedule_stats()['devices']['errors'], 0)
+            # keep-alive connections are reused between polls
+            stats = client.get_connection_stats()
+            self.assertGreater(stats['requests'], stats['connections'])
+            self.assertLessEqual(stats['connections'], len(handle.schedules) + 1)
+
+        for handle in handles:
+            handle.stop()
+            self.assertFalse(handle.client.connected)
+        engine.stop()
+        self.assertFalse(engine.is_alive())
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+
+    def test_client_reconnect(self):
+        import json
+        from kismon.client_rest import RestClientThread, CircuitBreaker
+        test_data = get_client_test_data()
+        link = {'status': 200}
+
+        def respond(body):
+            return lambda path, data: (link['status'], json.dumps(body))
+
+        routes = {
+            '/system/timestamp.json': respond({'kismet.system.timestamp.sec': 1}),
+            '/system/status.json': respond(test_data['status']),
+            '/devices/last-time/': lambda path, data: (
+                link['status'], "\n".join(json.dumps(device) for device in test_data['dot11'])),
+            '/messagebus/last-time/': respond({'kismet.messagebus.list': []}),
+            '/datasource/all_sources.json': respond(test_data['datasources']),
+        }
+        server = start_http_server(routes)
+        thread = RestClientThread(uri=server.uri, logger=logger)
+        thread.breaker = CircuitBreaker(minimum=0.05, maximum=0.2)
+        thread.client.intervals = dict.fromkeys(thread.client.intervals, 0.05)
+
+        def wait_for(condition):
+            for x in range(100):
+                if condition():
+                    return True
+                time.sleep(0.05)
+            return False
+
+        thread.start()
+        self.assertTrue(wait_for(lambda: thread.client.queue['dot11'].total == 3))
+        link['status'] = 503
+        self.assertTrue(wait_for(lambda: thread.breaker.failures >= 3))
+        self.assertTrue(thread.is_running)
+        self.assertIn(thread.breaker.get_stats()['state'], ('open', 'half-open'))
+        self.assertLessEqual(thread.breaker.delay, 0.2)
+
+        link['status'] = 200
+        self.assertTrue(wait_for(lambda: thread.breaker.state == 'closed' and thread.client.connected))
+        self.assertTrue(wait_for(lambda: len([request for request in server.requests
+                                               if request[1].startswith('/devices/')]) > 5))
+        # the sync window survived the reconnect, nothing was downloaded twice
+        full_syncs = [request for request in server.requests if request[1] == '/devices/last-time/1/devices.itjson']
+        self.assertEqual(len(full_syncs), 1)
+        self.assertEqual(thread.client.queue['dot11'].total, 3)
+        self.assertTrue(any(error.startswith("соединение потеряно") for error in thread.client.error))
+
+        thread.stop()
+        thread.join(2)
+        self.assertFalse(thread.is_alive())
+
+        # a limited number of attempts stops the thread
+        link['status'] = 503
+        thread = RestClientThread(uri=server.uri, logger=logger)
+        thread.breaker = CircuitBreaker(minimum=0.01, maximum=0.01, attempts=2)
+        thread.run()
+        self.assertIsNone(thread.is_running)
+        self.assertEqual(thread.breaker.failures, 2)
+
+        # the link drops between the server check and the login
+        link['status'] = 200
+        thread = RestClientThread(uri=server.uri, logger=logger)
+        thread.breaker = CircuitBreaker(minimum=0.01, maximum=0.05)
+        thread.client.authenticate = drop_once(thread.client.authenticate)
+        thread.start()
+        self.assertTrue(wait_for(lambda: thread.client.connected))
+        self.assertTrue(thread.is_alive())
+        self.assertTrue(thread.client.error[0].startswith("не удалось подключиться"))
+        thread.stop()
+        thread.join(2)
+        server.shutdown()
+        server.server_close()
+
+    def test_client_paged_sync(self):
+        import json
+        import urllib.parse
+        from kismon.client_rest import RestClient
+        template = get_client_test_data()['dot11'][0]
+        devices = []
+        for x in range(12):
+            device = copy.deepcopy(template)
+            device['kismet.device.base.macaddr'] = '00:11:22:33:44:%02X' % x
+            device['kismet.device.base.last_time'] = 1531150000 + x * 10
+            devices.append(device)
+
+        def device_view(path, data):
+            payload = json.loads(urllib.parse.parse_qs(data)['json'][0])
+            column = payload['fields'][int(payload['order[0][column]'])]
+            ordered = sorted(devices, key=lambda device: device[column], reverse=payload['order[0][dir]'] == 'desc')
+            page = ordered[payload['start']:payload['start'] + payload['length']]
+            return 200, json.dumps({'recordsTotal': len(devices), 'recordsFiltered': len(devices), 'data': page})
+
+        routes = {
+            '/devices/views/all/devices.json': device_view,
+            '/devices/last-time/': lambda path, data: (200, ''),
+        }
+        server = start_http_server(routes)
+        client = RestClient(logger=logger)
+        client.uri = server.uri
+        client.page_size = 5
+        self.assertTrue(client.is_initial_sync())
+        self.assertEqual(client.get_updated_devices(), 5)
+        self.assertEqual(client.get_sync_progress(), (5, 12))
+        # the most recent devices come first
+        first_page = client.queue['dot11'].drain()
+        self.assertEqual(first_page[0].mac, '00:11:22:33:44:0B')
+        self.assertEqual(client.get_updated_devices(), 5)
+        # the next page waits until the GUI took the last one
+        client.page_size = 3
+        self.assertEqual(client.get_updated_devices(), 0)
+        client.queue['dot11'].drain()
+        self.assertEqual(client.get_updated_devices(), 2)
+        self.assertIsNone(client.get_sync_progress())
+        self.assertFalse(client.is_initial_sync())
+
+        # afterwards the sync continues incrementally from the newest device
+        self.assertEqual(client.get_updated_devices(), 0)
+        self.assertEqual(server.requests[-1][1], '/devices/last-time/%s/devices.itjson' % (1531150000 + 11 * 10 - 1))
+
+        # a server without devices finishes the initial sync as well
+        del devices[:]
+        client = RestClient(logger=logger)
+        client.uri = server.uri
+        client.page_size = 5
+        self.assertEqual(client.get_updated_devices(), 0)
+        self.assertTrue(client.devices_synced)
+        self.assertFalse(client.is_initial_sync())
+        self.assertEqual(client.get_updated_devices(), 0)
+        self.assertEqual(server.requests[-1][1], '/devices/last-time/1/devices.itjson')
+
+        # a server error is not a missing paging support
+        from kismon.client_rest import KismetRest
+        routes['/devices/views/all/devices.json'] = lambda path, data: (503, 'busy')
+        client = RestClient(logger=logger)
+        client.uri = server.uri
+        client.page_size = 5
+        with self.assertRaises(KismetRest.KismetRequestException):
+            client.get_updated_devices()
+        self.assertEqual(client.page_size, 5)
+        # without the device view the whole list is requested at once
+        del routes['/devices/views/all/devices.json']
+        self.assertEqual(client.get_updated_devices(), 0)
+        self.assertEqual(client.page_size, 0)
+        server.shutdown()
+        server.server_close()
+
+    def test_client_metrics(self):
+        import json
+        from kismon.client_rest import RestClient
+        from kismon.metrics import EndpointMetrics
+        test_data = get_client_test_data()
+        routes = {
+            '/system/status.json': lambda path, data: (200, json.dumps(test_data['status'])),
+            '/datasource/all_sources.json': lambda path, data: (200, json.dumps(test_data['datasources'])),
+            '/devices/last-time/': lambda path, data: (
+                200, "\n".join(json.dumps(device) for device in test_data['dot11'])),
+        }
+        server = start_http_server(routes)
+        client = RestClient(logger=logger)
+        client.uri = server.uri
+        client.authenticated = True
+        self.assertTrue(client.update_system_status())
+        client.update_datasources()
+        for device in client.stream_request('devices/last-time/1/devices.itjson', {}):
+            # the processing of the caller is not part of the endpoint time
+            time.sleep(0.1)
+        with self.assertRaises(Exception):
+            client.update_location()
+
+        summary = client.metrics.get_summary()
+        self.assertEqual(summary['system_status']['calls'], 1)
+        self.assertEqual(summary['datasources']['count']['max'], len(test_data['datasources']))
+        self.assertEqual(summary['smart_device_list']['count']['max'], 3)
+        self.assertLess(summary['smart_device_list']['wall']['max'], 0.25)
+        self.assertGreater(summary['smart_device_list']['bytes']['max'], 0)
+        # compressed size on the wire
+        self.assertLess(summary['smart_device_list']['bytes']['max'],
+                        len("\n".join(json.dumps(device) for device in test_data['dot11'])))
+        self.assertEqual((summary['location']['calls'], summary['location']['errors']), (1, 1))
+
+        path = "%s%stest-metrics-%s.json" % (tempfile.gettempdir(), os.sep, int(time.time()))
+        client.metrics.dump(path)
+        with open(path) as f:
+            self.assertEqual(json.load(f)['endpoints']['system_status']['calls'], 1)
+        os.remove(path)
+        server.shutdown()
+        server.server_close()
+
+        metrics = EndpointMetrics(size=3)
+        for wall in (0.005, 0.03, 0.2, 10):
+            metrics.record(wall, 100, 1, 0.001)
+        summary = metrics.get_summary()
+        self.assertEqual(summary['samples'], 3)
+        self.assertEqual(summary['wall']['max'], 10)
+        self.assertEqual(summary['histogram'], [0, 0, 1, 0, 1, 0, 0, 0, 0, 1])
+
+    def test_client_datasources_diff(self):
+        import json
+        import urllib.parse
+        from kismon.client_rest import RestClient
+        test_data = get_client_test_data()
+        sources = test_data['datasources']
+        second = dict(sources[0])
+        second['kismet.datasource.uuid'] = '00000000-0000-0000-0000-000000000002'
+        sources.append(second)
+        server = start_http_server({
+            '/datasource/all_sources.json': lambda path, data: (200, json.dumps(sources)),
+        })
+        client = RestClient(logger=logger)
+        client.uri = server.uri
+        client.update_datasources()
+        self.assertEqual(client.datasource_count, len(sources))
+        self.assertEqual(client.queue['datasources'].drain(), sources)
+        # only the fields shown in the GUI are requested
+        post_data = urllib.parse.parse_qs(server.requests[0][2])
+        self.assertIn('kismet.datasource.num_packets', json.loads(post_data['json'][0])['fields'])
+
+        # unchanged sources are not queued again
+        client.update_datasources()
+        self.assertEqual(client.queue['datasources'].drain(), [])
+
+        changed = dict(sources[0])
+        changed['kismet.datasource.num_packets'] += 10
+        removed = sources[-1]['kismet.datasource.uuid']
+        sources[:] = [changed] + sources[1:-1]
+        client.update_datasources()
+        self.assertEqual(client.queue['datasources'].drain(),
+                         [changed, {'kismet.datasource.uuid': removed, 'removed': True}])
+        self.assertEqual(client.datasource_count, len(sources))
+        server.shutdown()
+
+    def test_background_tasks(self):
+        import threading
+        from kismon.background import BackgroundTasks
+        results = []
+        done = threading.Event()
+
+        def callback(result, error, duration):
+            results.append((result, error))
+            if len(results) == 3:
+                done.set()
+
+        def slow(value):
+            time.sleep(0.2)
+            if value is None:
+                raise ValueError("no value")
+            return value
+
+        tasks = BackgroundTasks(dispatch=lambda function, *args: function(*args))
+        start = time.monotonic()
+        for value in (1, 2, None):
+            tasks.submit(callback, slow, value)
+        self.assertTrue(tasks.is_busy())
+        self.assertTrue(done.wait(2))
+        # the requests run in parallel
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertFalse(tasks.is_busy())
+        self.assertEqual(sorted(result for result, error in results if error is None), [1, 2])
+        self.assertEqual([str(error) for result, error in results if error is not None], ["no value"])
+
+        # results arriving after the window was closed are dropped
+        tasks.submit(callback, slow, 3)
+        tasks.shutdown()
+        tasks.executor.shutdown(wait=True)
+        self.assertEqual(len(results), 3)
+
+    def test_device_coalescing(self):
+        from kismon.client_rest import RestClient, coalesce_devices, normalize_device
+        test_data = get_client_test_data()
+        client = RestClient(logger=logger)
+        updates = []
+        for last_time, last_signal, min_signal, max_signal in (
+                (100, -60, -70, -50), (102, -40, -65, -40), (101, -80, -80, -45)):
+            device = dict(test_data['dot11'][0])
+            device.update({
+                'kismet.device.base.last_time': last_time,
+                'kismet.common.signal.type': 'dbm',
+                'kismet.common.signal.last_signal': last_signal,
+                'kismet.common.signal.min_signal': min_signal,
+                'kismet.common.signal.max_signal': max_signal,
+            })
+            updates.append(device)
+        other = test_data['dot11'][1]
+
+        for device in updates + [other]:
+            client.put('dot11', device)
+        records = [normalize_device(device) for device in updates + [other]]
+        for devices in (client.queue['dot11'].drain(), coalesce_devices(records)):
+            self.assertEqual(len(devices), 2)
+            device = devices[0]
+            # the newest record wins, the signal range covers all copies
+            self.assertEqual(device.last_time, 102)
+            self.assertEqual(device.signal_last, -40)
+            self.assertEqual(device.signal_min, -80)
+            self.assertEqual(device.signal_max, -40)
+            self.assertEqual(devices[1], records[-1])
+        self.assertEqual(records[1].signal_min, -65)
+        self.assertAlmostEqual(client.queue['dot11'].get_stats()['coalesce_ratio'], 0.5)
+
+    def test_normalize_device(self):
+        from kismon.client_rest import normalize_device, get_seenby
+        test_data = get_client_test_data()
+        device = test_data['dot11'][0]
+        record = normalize_device(device)
+        self.assertEqual(record.mac, device['kismet.device.base.macaddr'])
+        self.assertEqual(record.last_time, device['kismet.device.base.last_time'])
+        self.assertEqual(record.signal_last, device['kismet.common.signal.last_signal'])
+        self.assertIsInstance(record.channel, int)
+        # the sample data has no signal type in seenby, the dBm field is used
+        source = device['kismet.device.base.seenby'][0]
+        seenby = get_seenby(device)
+        self.assertEqual(seenby[0], (source['kismet.common.seenby.uuid'],
+                                            source['kismet.common.seenby.num_packets'],
+                                            source['kismet.common.seenby.signal']['kismet.common.signal.last_signal_dbm'],
+                                            source['kismet.common.seenby.last_time']))
+        source['kismet.common.seenby.signal'] = {'kismet.common.signal.type': 'rssi',
+                                                 'kismet.common.signal.last_signal': 40}
+        self.assertNotIn(source['kismet.common.seenby.uuid'],
+                         [entry[0] for entry in get_seenby(device)])
+        device['dot11.device'] = 0
+        self.assertIsNone(normalize_device(device))
+
+    def test_signal_subscriptions(self):
+        import json
+        import urllib.parse
+        from kismon.client_rest import RestClient, SignalSubscriptions
+        device = get_client_test_data()['dot11'][0]
+        mac = device['kismet.device.base.macaddr']
+        server = start_http_server({
+            '/devices/multimac/devices.json': lambda path, data: (200, json.dumps([device])),
+        })
+        client = RestClient(logger=logger)
+        client.uri = server.uri
+        self.assertNotIn('kismet.device.base.seenby', client.device_fields)
+        client.signal_subscriptions = SignalSubscriptions()
+        # no open signal graph, no request
+        client.update_signal_sources()
+        self.assertEqual(server.requests, [])
+
+        client.signal_subscriptions.add(mac)
+        client.update_signal_sources()
+        payload = json.loads(urllib.parse.parse_qs(server.requests[-1][2])['json'][0])
+        self.assertEqual(payload['devices'], [mac])
+        signal = client.queue['signal'].drain()
+        self.assertEqual([entry[0] for entry in signal], [mac])
+        self.assertEqual(len(signal[0][1]), len(device['kismet.device.base.seenby']))
+
+        client.signal_subscriptions.remove(mac)
+        client.update_signal_sources()
+        self.assertEqual(len(server.requests), 1)
+        server.shutdown()
+
+    def test_wakeup(self):
+        import select
+        from kismon.client_rest import RestClient
+        from kismon.wakeup import Wakeup
+        wakeup = Wakeup()
+
+        def readable():
+            return select.select([wakeup.fileno()], [], [], 0)[0] != []
+
+        self.assertFalse(readable())
+        client = RestClient(logger=logger)
+        client.wakeup = wakeup
+        for x in range(3):
+            client.put('messages', {'x': x})
+        self.assertTrue(readable())
+        wakeup.clear()
+        self.assertFalse(readable())
+        client.put('location', {})
+        self.assertTrue(readable())
+        wakeup.clear()
+        self.assertFalse(readable())
+        wakeup.close()
+
+    def test_ingest_meter(self):
+        from kismon.metrics import IngestMeter
+        meter = IngestMeter(window=10)
+        self.assertEqual(meter.get_summary()['slices'], 0)
+        for x in range(11):
+            meter.record(100, 0.02, 500 - x * 10, now=100 + x)
+        meter.record(50, 0.08, 0, now=111)
+        summary = meter.get_summary()
+        # the first slice left the 10 second window
+        self.assertEqual(summary['slices'], 11)
+        self.assertEqual(summary['devices_per_second'], 105)
+        self.assertEqual(summary['stall_max'], 0.08)
+        self.assertEqual(summary['stall_p95'], 0.08)
+        self.assertEqual(summary['total'], 1150)
+        self.assertEqual(summary['backlog'], 0)
+
+    def test_network_store(self):
+        from kismon.networkstore import SqliteStore, JsonStore, open_store
+        networks = get_store_test_networks()
+        expected = copy.deepcopy(networks)
+        expected["11:22:33:44:55:77"]["type"] = "unknown"
+        expected["11:22:33:44:55:77"]["crypt"] = "none"
+
+        filename = "%s%stest-networks-%s.sqlite" % (tempfile.gettempdir(), os.sep, time.time())
+        store = open_store(filename)
+        self.assertIsInstance(store, SqliteStore)
+        # the file only appears with a complete save
+        self.assertFalse(os.path.isfile(filename))
+        store.save(networks)
+        self.assertFalse(os.path.isfile(filename + ".new"))
+        self.assertFalse(os.path.isfile(filename + "-wal"))
+        store.close()
+        store = SqliteStore(filename)
+        loaded = store.load()
+        self.assertEqual(loaded, expected)
+        self.assertEqual(list(loaded), ["11:22:33:44:55:77", "11:22:33:44:55:66"])
+        self.assertEqual([mac for mac, network in store.iter_networks()], list(loaded))
+        self.assertIsInstance(loaded["11:22:33:44:55:66"]["channel"], int)
+        indexes = [row[0] for row in store.db.execute("SELECT name FROM sqlite_master WHERE type='index'")]
+        for column in ('lasttime', 'ssid', 'channel', 'crypt'):
+            self.assertIn("networks_%s" % column, indexes)
+
+        # only the changed network is written
+        loaded["11:22:33:44:55:66"]["ssid"] = "changed"
+        loaded["11:22:33:44:55:77"]["ssid"] = "not written"
+        store.batch_size = 1
+        store.write(loaded, ["11:22:33:44:55:66"])
+        reloaded = store.load()
+        self.assertEqual(reloaded["11:22:33:44:55:66"]["ssid"], "changed")
+        self.assertEqual(reloaded["11:22:33:44:55:77"]["ssid"], "")
+        self.assertEqual(store.get_networks(["11:22:33:44:55:66", "00:00:00:00:00:01"]),
+                         {"11:22:33:44:55:66": reloaded["11:22:33:44:55:66"]})
+        store.close()
+        os.remove(filename)
+
+        filename = "%s%stest-networks-%s.json" % (tempfile.gettempdir(), os.sep, time.time())
+        store = open_store(filename, num_backups=2)
+        self.assertIsInstance(store, JsonStore)
+        store.save(networks)
+        store.save(networks)
+        store.save(networks)
+        self.assertTrue(os.path.isfile(filename + ".0"))
+        self.assertTrue(os.path.isfile(filename + ".1"))
+        self.assertFalse(os.path.isfile(filename + ".2"))
+        self.assertEqual(store.load(), expected)
+        self.assertFalse(store.needs_compaction())
+        self.assertEqual(store.get_networks(["11:22:33:44:55:77"]),
+                         {"11:22:33:44:55:77": expected["11:22:33:44:55:77"]})
+
+        # changes go into the journal and are replayed on top of the snapshot
+        changed = copy.deepcopy(expected)
+        changed["11:22:33:44:55:66"]["ssid"] = "changed"
+        changed["aa:bb:cc:dd:ee:ff"] = dict(changed["11:22:33:44:55:66"], ssid="new")
+        store.write(changed, ["11:22:33:44:55:66"])
+        with open(store.journal_filename, "a") as f:
+            f.write('{"mac": "aa:bb:cc:dd:ee:ff", "netw')
+        store.write(changed, ["aa:bb:cc:dd:ee:ff", "00:00:00:00:00:01"])
+        self.assertEqual(JsonStore(filename).load(), changed)
+        self.assertTrue(store.needs_compaction())
+        store.save(changed)
+        self.assertFalse(os.path.isfile(store.journal_filename))
+        self.assertEqual(JsonStore(filename).load(), changed)
+
+        # the journal holds an older version than the new snapshot
+        newer = copy.deepcopy(changed)
+        newer["11:22:33:44:55:66"]["ssid"] = "newer"
+        store.write(changed, ["11:22:33:44:55:66"])
+        old_journal = store.journal_filename + ".old"
+        # crashed after the snapshot was written and the journal moved aside
+        store.write_snapshot(newer, filename + ".new")
+        os.rename(store.journal_filename, old_journal)
+        self.assertEqual(JsonStore(filename, num_backups=2).load(), newer)
+        self.assertFalse(os.path.isfile(old_journal))
+        self.assertFalse(os.path.isfile(filename + ".new"))
+        # crashed after the snapshot was replaced
+        store.write(changed, ["11:22:33:44:55:66"])
+        os.rename(store.journal_filename, old_journal)
+        self.assertEqual(JsonStore(filename).load(), newer)
+        # crashed while writing the snapshot, the journal still applies
+        store.write(changed, ["11:22:33:44:55:66"])
+        with open(filename + ".new", "w") as f:
+            f.write('{"11:22:')
+        self.assertEqual(JsonStore(filename).load(), changed)
+        for name in (filename, filename + ".0", filename + ".1", filename + ".new", store.journal_filename):
+            os.remove(name)
+
+    def test_snapshot(self):
+        import io
+        import json
+        import kismon.snapshot as snapshot
+        from kismon.networkstore import BinaryStore, open_store
+        networks = get_store_test_networks()
+        networks["aa:bb:cc:dd:ee:01"] = dict(networks["11:22:33:44:55:66"], lasttime=250.5, lat=0,
+                                             comment="ÄÖÜ", servers=["a", "b", "a"])
+        for num in range(100):
+            networks["00:11:22:33:%02X:%02X" % (num // 256, num % 256)] = dict(
+                networks["11:22:33:44:55:66"], lasttime=num, ssid="net%s" % (num % 5))
+
+        f = io.BytesIO()
+        snapshot.dump(networks, f)
+        data = f.getvalue()
+        self.assertLess(len(data), len(json.dumps(networks)) / 2)
+        loaded = list(snapshot.iter_networks(data))
+        self.assertEqual(dict(loaded), networks)
+        self.assertEqual([mac for mac, network in loaded[:3]],
+                         ["11:22:33:44:55:77", "aa:bb:cc:dd:ee:01", "11:22:33:44:55:66"])
+        self.assertIsInstance(dict(loaded)["aa:bb:cc:dd:ee:01"]["lat"], int)
+
+        self.assertRaises(snapshot.SnapshotError, list, snapshot.iter_networks(b"KSNQ" + data[4:]))
+        self.assertRaises(snapshot.SnapshotError, list, snapshot.iter_networks(data[:6]))
+
+        filename = "%s%stest-networks-%s.bin" % (tempfile.gettempdir(), os.sep, time.time())
+        store = open_store(filename)
+        self.assertIsInstance(store, BinaryStore)
+        store.save(networks)
+        networks["11:22:33:44:55:66"]["ssid"] = "changed"
+        store.write(networks, ["11:22:33:44:55:66"])
+        self.assertEqual(BinaryStore(filename).load()["11:22:33:44:55:66"]["ssid"], "changed")
+        # the journal comes first, the snapshot newest first
+        loaded = [mac for mac, network in BinaryStore(filename).iter_networks()]
+        self.assertEqual(loaded[:4], ["11:22:33:44:55:66", "11:22:33:44:55:77", "aa:bb:cc:dd:ee:01",
+                                      "00:11:22:33:00:63"])
+        self.assertEqual(len(loaded), len(networks))
+        for name in (filename, store.journal_filename):
+            os.remove(name)
+
+    def test_client_capture_replay(self):
+        from kismon.capture import CaptureWriter, read_capture
+        from kismon.client_rest import RestClient, ReplayClientThread
+        test_data = get_client_test_data()
+        path = "%s%stest-capture-%s.jsonl.gz" % (tempfile.gettempdir(), os.sep, int(time.time()))
+
+        client = RestClient(logger=logger)
+        for session in range(2):
+            client.capture = CaptureWriter(path, client.uri)
+            client.put('status', test_data['status'])
+            for device in test_data['dot11']:
+                client.put('dot11', device)
+            time.sleep(0.1)
+            client.put('location', test_data['location'][0])
+            client.capture.close()
+        client.capture = None
+
+        records = list(read_capture(path))
+        self.assertEqual(len(records), 10)
+        self.assertEqual([record[1] for record in records[:5]], ['status', 'dot11', 'dot11', 'dot11', 'location'])
+        # the second session continues after the first one
+        timestamps = [record[0] for record in records]
+        self.assertEqual(timestamps, sorted(timestamps))
+        self.assertGreaterEqual(timestamps[-1], 0.2)
+
+        replay = ReplayClientThread(logger=logger, path=path, speed=0)
+        replay.start()
+        replay.join(5)
+        self.assertEqual(replay.records, 10)
+        self.assertEqual(replay.client.queue['status'], test_data['status'])
+        self.assertEqual(replay.client.queue['dot11'].total, 6)
+        self.assertEqual(len(replay.client.queue['dot11']), 3)
+        self.assertEqual(replay.client.queue['location'].drain(), [test_data['location'][0]] * 2)
+        self.assertEqual(replay.client.error, [])
+
+        # twice as fast as recorded
+        replay = ReplayClientThread(logger=logger, path=path, speed=2)
+        replay.run()
+        self.assertGreaterEqual(replay.duration, timestamps[-1] / 2)
+        self.assertLess(replay.duration, timestamps[-1])
+        os.remove(path)
+
+    def test_client_stream_decode(self):
+        import json
+        from kismon.client_rest import iter_json_objects
+        devices = get_client_test_data()['dot11']
+        devices[0]['kismet.device.base.manuf'] = 'Тест'
+
+        def chunked(data, size):
+            return [data[pos:pos + size] for pos in range(0, len(data), size)]
+
+        itjson = "\n".join(json.dumps(device) for device in devices).encode()
+        array = json.dumps(devices, indent=1).encode()
+        for data in (itjson, array):
+            for size in (1, 7, 1000, len(data)):
+                self.assertEqual(list(iter_json_objects(chunked(data, size))), devices)
+        self.assertEqual(list(iter_json_objects([b'[]'])), [])
+
+        # devices are handed out before the rest of the response arrived
+        stream = iter_json_objects(iter(chunked(itjson, 100)))
+        self.assertEqual(next(stream), devices[0])
+
+        with self.assertRaises(ValueError):
+            list(iter_json_objects([itjson[:-10]]))
+
+    def test_ring_queue(self):
+        import threading
+        from kismon.ringqueue import RingQueue
+
+        queue = RingQueue(3)
+        queue.extend(range(5))
+        self.assertEqual(queue.drain(2), [2, 3])
+        self.assertEqual(queue.drain(), [4])
+        self.assertEqual(queue.drain(), [])
+        stats = queue.get_stats()
+        self.assertEqual((stats['drops'], stats['high_water'], stats['total']), (2, 3, 5))
+
+        def merge(old, new):
+            new['count'] = old['count'] + new['count']
+            return new
+
+        queue = RingQueue(2, overflow='coalesce', key=lambda item: item['mac'], merge=merge)
+        for mac in ('a', 'b', 'a', 'c', 'c'):
+            queue.put({'mac': mac, 'count': 1})
+        # 'a' keeps its position when coalesced and is the oldest when 'c' arrives
+        self.assertEqual(queue.drain(), [{'mac': 'b', 'count': 1}, {'mac': 'c', 'count': 2}])
+        stats = queue.get_stats()
+        self.assertEqual((stats['drops'], stats['coalesced']), (1, 2))
+
+        queue = RingQueue(1, overflow='block')
+        queue.put(1)
+        producer = threading.Thread(target=queue.put, args=(2,))
+        producer.start()
+        time.sleep(0.1)
+        self.assertTrue(producer.is_alive())
+        self.assertEqual(queue.drain(), [1])
+        producer.join(1)
+        self.assertEqual(queue.drain(), [2])
+        queue.put(3)
+        producer = threading.Thread(target=queue.put, args=(4,))
+        producer.start()
+        queue.close()
+        producer.join(1)
+        self.assertFalse(producer.is_alive())
+        self.assertEqual(queue.get_stats()['drops'], 1)
+
     def test_config(self):
         from kismon.config import Config
         config_file = tempfile.gettempdir() + os.sep + "testconfig.conf"
@@ -215,6 +1249,15 @@ class TestKismon(unittest.TestCase):
         core_tests(test_core)
         test_core.add_network_to_map("00:12:2A:03:B9:12")
         test_core.queues_handler()
+
+        # a wakeup only drains the data queues, the tables wait for the timer
+        refreshed = []
+        server_tab = test_core.main_window.server_tabs[0]
+        server_tab.update_connection_info = lambda *args: refreshed.append(args)
+        test_core.client_threads[0].client.load_queue(get_client_test_data())
+        test_core.on_wakeup(None, None)
+        self.assertEqual(refreshed, [])
+        self.assertEqual(len(test_core.client_threads[0].get_queue("messages")), 0)
         test_core.clients_stop()
 
         arg = "--disable-map"
@@ -225,6 +1268,98 @@ class TestKismon(unittest.TestCase):
 
         test_core.clients_stop()
 
+    @unittest.skipUnless(gi_available, "gi module not available")
+    def test_networks_background_save(self):
+        import threading
+        from kismon.background import BackgroundTasks
+        from kismon.networkstore import JsonStore
+        test_networks = networks()
+        test_networks.tasks = BackgroundTasks(max_workers=1, dispatch=lambda function, *args: function(*args))
+        mac = list(test_networks.networks)[0]
+        filename = "%s%stest-networks-%s.json" % (tempfile.gettempdir(), os.sep, time.time())
+        # the save has to wait behind this task
+        blocker = threading.Event()
+        test_networks.run_store_task({}, blocker.wait, None)
+        test_networks.queue_running = True
+        test_networks.save(filename)
+        self.assertTrue(test_networks.saving)
+        old_network = test_networks.get_network(mac)
+        test_networks.set_comment(mac, "changed while saving")
+        self.assertIsNot(test_networks.get_network(mac), old_network)
+        self.assertEqual(old_network["comment"], "")
+        blocker.set()
+        test_networks.wait_store_tasks()
+        self.assertFalse(test_networks.saving)
+        self.assertEqual(JsonStore(filename).read_snapshot()[mac]["comment"], "")
+        test_networks.save(filename, force=True)
+        self.assertEqual(JsonStore(filename).load()[mac]["comment"], "changed while saving")
+
+    @unittest.skipUnless(gi_available, "gi module not available")
+    def test_networks_background_load(self):
+        from kismon.background import BackgroundTasks
+        from kismon.networks import Networks
+        from kismon.client_rest import normalize_device
+        test_networks = networks()
+        filename = "%s%stest-networks-%s.bin" % (tempfile.gettempdir(), os.sep, time.time())
+        test_networks.save(filename, force=True)
+
+        loaded_networks = Networks(test_networks.config, logger=logger)
+        loaded_networks.tasks = BackgroundTasks(max_workers=1, dispatch=lambda function, *args: function(*args))
+        loaded_networks.load_batch_size = 1
+        batches = []
+        add_loaded_networks = loaded_networks.add_loaded_networks
+
+        def add_batch(networks):
+            batches.append(networks[0][0])
+            add_loaded_networks(networks)
+        loaded_networks.add_loaded_networks = add_batch
+        loaded_networks.start_queue = lambda: None
+        # a live device arrives before the load is done
+        device = normalize_device(get_client_test_data()['dot11'][0])
+        loaded_networks.add_device_data(device, server_id=0)
+        results = []
+        loaded_networks.load_in_background(filename, lambda count, error: results.append((count, error)))
+        loaded_networks.wait_store_tasks()
+        self.assertFalse(loaded_networks.loading)
+        self.assertEqual(results, [(len(test_networks.networks), None)])
+        self.assertEqual(set(loaded_networks.networks), set(test_networks.networks))
+        lasttimes = [test_networks.networks[mac]["lasttime"] for mac in batches]
+        self.assertEqual(lasttimes, sorted(lasttimes, reverse=True))
+        # merged with the stored network, the result goes into the next journal write
+        self.assertIn(device.mac, loaded_networks.changed)
+
+    @unittest.skipUnless(gi_available, "gi module not available")
+    def test_networks_quit_while_loading(self):
+        from kismon.background import BackgroundTasks
+        from kismon.networks import Networks
+        from kismon.client_rest import normalize_device
+        test_networks = networks()
+        device = normalize_device(get_client_test_data()['dot11'][0])
+        stored = test_networks.get_network(device.mac)
+        stored["comment"] = "IMPORTANT"
+        stored["firsttime"] = 100
+        filename = "%s%stest-networks-%s.json" % (tempfile.gettempdir(), os.sep, time.time())
+        test_networks.save(filename, force=True)
+
+        loaded_networks = Networks(test_networks.config, logger=logger)
+        # the batches never reach the main loop
+        loaded_networks.tasks = BackgroundTasks(max_workers=1, dispatch=lambda function, *args: None)
+        loaded_networks.load_in_background(filename)
+        loaded_networks.add_device_data(device._replace(first_time=5000), server_id=0)
+        self.assertIn(device.mac, loaded_networks.unmerged)
+        loaded_networks.flush_changes()
+        self.assertIn(device.mac, loaded_networks.changed)
+        loaded_networks.stop_loading()
+        # the storage was switched to sqlite, networks.sqlite must not appear before a full save
+        sqlite_filename = "%s%stest-networks-%s.sqlite" % (tempfile.gettempdir(), os.sep, time.time())
+        loaded_networks.save(sqlite_filename, force=True)
+        self.assertFalse(os.path.isfile(sqlite_filename))
+
+        network = Networks(test_networks.config, logger=logger)
+        network.load(filename)
+        self.assertEqual(network.get_network(device.mac)["comment"], "IMPORTANT")
+        self.assertEqual(network.get_network(device.mac)["firsttime"], 100)
+
     @unittest.skipUnless(gi_available, "gi module not available")
     def test_gui_main_window(self):
         from gi.repository import Gtk
@@ -300,6 +1435,14 @@ class TestKismon(unittest.TestCase):
         test_widget.text = 'something'
         main_window.filter_tab.on_regex_changed(test_widget, 'ssid')
         main_window.filter_tab.on_regex_changed(test_widget, 'ssid')
+        main_window.filter_tab.server_filter_entries['ssid'].set_text('^(GAR')
+        main_window.filter_tab.on_server_filter_apply(None)
+        self.assertEqual(main_window.config['server_filter']['ssid'], '')
+        self.assertNotEqual(main_window.filter_tab.server_filter_error.get_text(), '')
+        main_window.filter_tab.server_filter_entries['ssid'].set_text('^(GARTEN|Kunz)')
+        main_window.filter_tab.on_server_filter_apply(None)
+        self.assertEqual(main_window.config['server_filter']['ssid'], '^(GARTEN|Kunz)')
+        self.assertEqual(main_window.filter_tab.server_filter_error.get_text(), '')
 
     @unittest.skipUnless(gi_available, "gi module not available")
     def test_gui_channel_window(self):
@@ -309,14 +1452,20 @@ class TestKismon(unittest.TestCase):
             "123": {"uuid": "123", "hop": 3, "name": "wlan0", "hop_rate": 3, "channel": 1},
             "234": {"uuid": "234", "hop": 0, "name": "wlan1", "hop_rate": 3, "channel": 6}
         }
+        from kismon.background import BackgroundTasks
         client_thread = RestClientThread(logger=logger)
-        channel_window = ChannelWindow(sources, client_thread, parent=None)
+        applied = []
+        client_thread.client.set_channel = lambda uuid, mode, value: applied.append((uuid, mode, value))
+        tasks = BackgroundTasks(dispatch=lambda function, *args: function(*args))
+        channel_window = ChannelWindow(sources, client_thread, parent=None, tasks=tasks)
         test_widget = TestWidget()
         channel_window.on_change_mode(test_widget, "123", "hop")
         channel_window.on_change_mode(test_widget, "123", "lock")
         channel_window.on_change_value(None, "123", "hop")
-        channel_window.on_cancel(None)
         channel_window.on_apply(None)
+        tasks.executor.shutdown(wait=True)
+        self.assertEqual(applied, [("123", "hop", 3)])
+        channel_window.on_cancel(None)
 
     @unittest.skipUnless(gi_available, "gi module not available")
     def test_gui_map_window(self):
@@ -412,11 +1561,15 @@ class TestKismon(unittest.TestCase):
             return kismon.test_data.available_datasources
 
         test_window = Gtk.Window()
+        from kismon.background import BackgroundTasks
         client_thread = RestClientThread(logger=logger)
         client_thread.client.get_available_datasources = dummy_datasources
+        tasks = BackgroundTasks(dispatch=lambda function, *args: function(*args))
         datasources_window = DatasourcesWindow(client_thread,
-                                               parent=test_window)
+                                               parent=test_window, tasks=tasks)
         datasources_window.on_refresh()
+        tasks.executor.shutdown(wait=True)
+        self.assertEqual(datasources_window.available_datasources, kismon.test_data.available_datasources)
         datasources_window.on_destroy()
 
     @unittest.skipUnless(gi_available, "gi module not available")
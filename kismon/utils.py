@@ -8,3 +8,14 @@ def format_timestamp(timestamp):
 
 def get_version():
     return '1.0.3'
+
+
+def get_argument(argv, name, default=None):
+    """Значение параметра командной строки вида "--name value"
+    """
+    if name not in argv:
+        return default
+    pos = argv.index(name) + 1
+    if pos >= len(argv):
+        return default
+    return argv[pos]
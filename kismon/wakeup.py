@@ -0,0 +1,58 @@
+import os
+import threading
+
+
+class Wakeup:
+    """Дескриптор, который становится читаемым, когда клиент положил данные в очередь
+
+    Главный цикл GLib следит за ним вместо опроса очередей по таймеру.
+    Пока Core не вызвал clear, повторные сигналы ничего не пишут.
+    """
+    def __init__(self):
+        self.pending = False
+        self.lock = threading.Lock()
+        if hasattr(os, 'eventfd'):
+            self.read_fd = self.write_fd = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+        else:
+            self.read_fd, self.write_fd = os.pipe()
+            os.set_blocking(self.read_fd, False)
+            os.set_blocking(self.write_fd, False)
+
+    def fileno(self):
+        return self.read_fd
+
+    def signal(self):
+        if self.pending:
+            return
+        with self.lock:
+            if self.pending:
+                return
+            self.pending = True
+        try:
+            if self.read_fd == self.write_fd:
+                os.eventfd_write(self.write_fd, 1)
+            else:
+                os.write(self.write_fd, b'\0')
+        except BlockingIOError:
+            # the reader was signalled already
+            pass
+
+    def clear(self):
+        """Вызывается перед обработкой очередей, данные после этого снова будят цикл
+        """
+        try:
+            while True:
+                if self.read_fd == self.write_fd:
+                    os.eventfd_read(self.read_fd)
+                    break
+                if not os.read(self.read_fd, 4096):
+                    break
+        except BlockingIOError:
+            pass
+        # only after the drain, a signal in between is covered by the following queue pass
+        self.pending = False
+
+    def close(self):
+        os.close(self.read_fd)
+        if self.write_fd != self.read_fd:
+            os.close(self.write_fd)
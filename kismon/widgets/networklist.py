@@ -186,8 +186,7 @@ class NetworkList:
         editable.connect("editing-done", self.on_comment_editing_done)
 
     def on_comment_editing_done(self, widget):
-        network = self.networks.get_network(self.network_selected)
-        network['comment'] = widget.get_text()
+        self.networks.set_comment(self.network_selected, widget.get_text())
         self.add_network(self.network_selected)
 
     def prepare_network_servers(self, value):
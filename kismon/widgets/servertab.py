@@ -1,3 +1,6 @@
+import os
+import time
+
 from gi.repository import Gtk
 
 from kismon.windows import ChannelWindow, DatasourcesWindow
@@ -53,6 +56,20 @@ class ServerTab:
         self.gps_expander = gps_expander
         self.init_gps_table()
 
+        schedule_expander = Gtk.Expander()
+        schedule_expander.set_label("Опрос")
+        right_table.pack_start(schedule_expander, False, False, 0)
+        row += 1
+        self.schedule_expander = schedule_expander
+        self.init_schedule_table()
+
+        metrics_expander = Gtk.Expander()
+        metrics_expander.set_label("Точки API")
+        right_table.pack_start(metrics_expander, False, False, 0)
+        row += 1
+        self.metrics_expander = metrics_expander
+        self.init_metrics_table()
+
         if self.map is not None:
             track_expander = Gtk.Expander()
             track_expander.set_label("Метка GPS")
@@ -136,7 +153,7 @@ class ServerTab:
 
     def init_info_table(self, server_id):
         self.info_table = {}
-        table = Gtk.Table(n_rows=4, n_columns=2)
+        table = Gtk.Table(n_rows=7, n_columns=2)
         row = 0
 
         label = Gtk.Label(label="URI: ")
@@ -163,12 +180,91 @@ class ServerTab:
         self.info_table['devices'] = networks_value_label
         row += 1
 
+        queue_label = Gtk.Label(label="Очередь: ")
+        queue_label.set_property("xalign", 0)
+        queue_label.set_property("yalign", 0)
+        table.attach(queue_label, 0, 1, row, row + 1)
+
+        queue_value_label = Gtk.Label()
+        queue_value_label.set_property("xalign", 0)
+        queue_value_label.set_property("yalign", 0)
+        table.attach(queue_value_label, 1, 2, row, row + 1)
+        self.info_table['queue'] = queue_value_label
+        row += 1
+
+        http_label = Gtk.Label(label="HTTP: ")
+        http_label.set_property("xalign", 0)
+        http_label.set_property("yalign", 0)
+        table.attach(http_label, 0, 1, row, row + 1)
+
+        http_value_label = Gtk.Label()
+        http_value_label.set_property("xalign", 0)
+        http_value_label.set_property("yalign", 0)
+        table.attach(http_value_label, 1, 2, row, row + 1)
+        self.info_table['http'] = http_value_label
+        row += 1
+
+        link_label = Gtk.Label(label="Связь: ")
+        link_label.set_property("xalign", 0)
+        link_label.set_property("yalign", 0)
+        table.attach(link_label, 0, 1, row, row + 1)
+
+        link_value_label = Gtk.Label()
+        link_value_label.set_property("xalign", 0)
+        link_value_label.set_property("yalign", 0)
+        table.attach(link_value_label, 1, 2, row, row + 1)
+        self.info_table['link'] = link_value_label
+        row += 1
+
+        progressbar = Gtk.ProgressBar()
+        progressbar.set_show_text(True)
+        progressbar.set_no_show_all(True)
+        table.attach(progressbar, 0, 2, row, row + 1)
+        self.info_table['sync'] = progressbar
+        row += 1
+
         table.show_all()
         self.info_expander.add(table)
 
     def update_info_table(self, devices):
         self.info_table['devices'].set_text("%s" % devices)
 
+    def update_connection_info(self, stats):
+        self.info_table['http'].set_text("%s/%s" % (stats['requests'], stats['connections']))
+        tooltip = "запросов/соединений\nповторное использование: %d%%\nсжатых ответов: %s из %s" % (
+            stats['reuse'] * 100, stats['compressed'], stats['responses'])
+        if stats.get('clock_offset') is not None:
+            tooltip += "\nрасхождение часов с сервером: %.1f с" % stats['clock_offset']
+        self.info_table['http'].set_tooltip_text(tooltip)
+
+    def update_sync_progress(self, progress):
+        progressbar = self.info_table['sync']
+        if progress is None:
+            progressbar.hide()
+            return
+        done, total = progress
+        progressbar.set_fraction(min(1.0, done / total) if total else 0.0)
+        progressbar.set_text("Загрузка: %s из %s" % (done, total))
+        progressbar.show()
+
+    def update_breaker_info(self, stats, running):
+        if not running:
+            text = "отключено"
+        elif stats['state'] == 'closed':
+            text = "подключено"
+        elif stats['state'] == 'half-open':
+            text = "подключение..."
+        else:
+            text = "повтор через %.0f с" % stats['wait']
+        self.info_table['link'].set_text(text)
+        self.info_table['link'].set_tooltip_text("неудачных попыток подряд: %s" % stats['failures'])
+
+    def update_queue_info(self, stats):
+        queue = stats['dot11']
+        self.info_table['queue'].set_text("%s/%s" % (queue['length'], queue['high_water']))
+        self.info_table['queue'].set_tooltip_text("текущая/максимальная длина\nпотеряно: %s, объединено: %s (%.0f%%)" % (
+            queue['drops'], queue['coalesced'], queue['coalesce_ratio'] * 100))
+
     def init_gps_table(self):
         table = Gtk.Table(n_rows=3, n_columns=2)
 
@@ -223,6 +319,88 @@ class ServerTab:
         self.gps_table_lat.set_text("%s" % lat)
         self.gps_table_lon.set_text("%s" % lon)
 
+    def init_schedule_table(self):
+        self.schedule_table = {}
+        table = Gtk.Table(n_rows=5, n_columns=2)
+        row = 0
+        for name, title in (('devices', 'Устройства'), ('status', 'Статус'), ('location', 'GPS'),
+                            ('messages', 'Сообщения'), ('datasources', 'Источники')):
+            label = Gtk.Label(label="%s: " % title)
+            label.set_property("xalign", 0)
+            label.set_property("yalign", 0)
+            table.attach(label, 0, 1, row, row + 1)
+
+            value_label = Gtk.Label()
+            value_label.set_property("xalign", 0)
+            value_label.set_property("yalign", 0)
+            table.attach(value_label, 1, 2, row, row + 1)
+            self.schedule_table[name] = value_label
+            row += 1
+
+        table.show_all()
+        self.schedule_expander.add(table)
+
+    def update_schedule_table(self, stats):
+        for name in stats:
+            if name not in self.schedule_table:
+                continue
+            schedule = stats[name]
+            text = "%gс, +%dмс" % (round(schedule['interval'], 2), schedule['lateness'] * 1000)
+            tooltip = "запусков: %s, ошибок: %s, макс. задержка: %dмс" % (
+                schedule['runs'], schedule['errors'], schedule['max_lateness'] * 1000)
+            if schedule['reason']:
+                text = "%s\n%s" % (text, schedule['reason'])
+                tooltip = "%s\nчастота: %.1f/с" % (tooltip, 1 / schedule['interval'])
+            self.schedule_table[name].set_text(text)
+            self.schedule_table[name].set_tooltip_text(tooltip)
+
+    def init_metrics_table(self):
+        self.metrics_table = {}
+        table = Gtk.Table(n_rows=7, n_columns=2)
+        row = 0
+        for name, title in (('smart_device_list', 'Устройства'), ('system_status', 'Статус'), ('location', 'GPS'),
+                            ('messages', 'Сообщения'), ('datasources', 'Источники'),
+                            ('datasource_list_interfaces', 'Интерфейсы')):
+            label = Gtk.Label(label="%s: " % title)
+            label.set_property("xalign", 0)
+            label.set_property("yalign", 0)
+            table.attach(label, 0, 1, row, row + 1)
+
+            value_label = Gtk.Label()
+            value_label.set_property("xalign", 0)
+            value_label.set_property("yalign", 0)
+            table.attach(value_label, 1, 2, row, row + 1)
+            self.metrics_table[name] = value_label
+            row += 1
+
+        box = Gtk.Box()
+        button = Gtk.Button(label="Сохранить JSON")
+        button.connect('clicked', self.on_metrics_dump_clicked)
+        box.pack_start(button, False, False, 0)
+        table.attach(box, 0, 2, row, row + 1)
+
+        table.show_all()
+        self.metrics_expander.add(table)
+
+    def update_metrics_table(self, summary):
+        for name in summary:
+            if name not in self.metrics_table:
+                continue
+            endpoint = summary[name]
+            self.metrics_table[name].set_text("%d/%dмс, %.1fКБ" % (
+                endpoint['wall']['p50'] * 1000, endpoint['wall']['p95'] * 1000, endpoint['bytes']['mean'] / 1024))
+            self.metrics_table[name].set_tooltip_text(
+                "время p50/p95/макс: %d/%d/%dмс\nразбор JSON p50/p95: %d/%dмс\n"
+                "записей p50/макс: %s/%s\nвызовов: %s, ошибок: %s" % (
+                    endpoint['wall']['p50'] * 1000, endpoint['wall']['p95'] * 1000, endpoint['wall']['max'] * 1000,
+                    endpoint['decode']['p50'] * 1000, endpoint['decode']['p95'] * 1000,
+                    endpoint['count']['p50'], endpoint['count']['max'], endpoint['calls'], endpoint['errors']))
+
+    def on_metrics_dump_clicked(self, widget):
+        path = os.path.expanduser("~/.kismon/metrics-server%s-%s.json" % (self.server_id + 1, int(time.time())))
+        self.client_threads[self.server_id].client.metrics.dump(path)
+        self.logger.info("Статистика точек API сохранена в %s" % path)
+
     def init_track_table(self):
         table = Gtk.Table(n_rows=2, n_columns=2)
         row = 0
@@ -328,7 +506,7 @@ class ServerTab:
         dialog.set_transient_for(self.window)
         box = dialog.get_content_area()
         row = 0
-        table = Gtk.Table(n_rows=4, n_columns=2)
+        table = Gtk.Table(n_rows=5, n_columns=2)
 
         label = Gtk.Label("URI: ")
         table.attach(label, 0, 1, row, row + 1)
@@ -365,6 +543,15 @@ class ServerTab:
         table.attach(password_entry, 1, 2, row, row + 1)
         row += 1
 
+        label = Gtk.Label("Поток событий: ")
+        table.attach(label, 0, 1, row, row + 1)
+
+        push_checkbutton = Gtk.CheckButton()
+        push_checkbutton.set_active(self.config["servers"][self.server_id].get('push', False))
+        push_checkbutton.set_tooltip_text("Получать устройства, сообщения и GPS через websocket, опрос используется как запасной вариант")
+        table.attach(push_checkbutton, 1, 2, row, row + 1)
+        row += 1
+
         label = Gtk.Label()
         label.set_markup("<b>* Обязателен, находится в kismet_httpd.conf</b>")
         table.attach(label, 0, 2, row, row + 1)
@@ -383,11 +570,13 @@ class ServerTab:
         uri = uri_entry.get_text()
         username = username_entry.get_text()
         password = password_entry.get_text()
+        push = push_checkbutton.get_active()
         dialog.destroy()
 
         self.config['servers'][self.server_id]['uri'] = uri
         self.config['servers'][self.server_id]['username'] = username
         self.config['servers'][self.server_id]['password'] = password
+        self.config['servers'][self.server_id]['push'] = push
         self.client_threads[self.server_id].client.credentials = (username, password)
         self.set_active(False)
         self.set_active(True)
@@ -1,18 +1,24 @@
 from gi.repository import Gtk
 
+from kismon.background import BackgroundTasks
+
 
 class ChannelWindow:
-    def __init__(self, sources, client_thread, parent):
+    def __init__(self, sources, client_thread, parent, tasks=None):
         self.sources = sources
         self.client_thread = client_thread
         self.changes = {}
         self.widgets = {}
+        self.tasks = tasks or BackgroundTasks()
+        self.failed = False
+        self.apply_button = None
 
         self.gtkwin = Gtk.Window()
         self.gtkwin.set_transient_for(parent)
         self.gtkwin.set_position(Gtk.WindowPosition.CENTER)
         self.gtkwin.set_default_size(320, 240)
         self.gtkwin.set_title("Настройка канала")
+        self.gtkwin.connect("destroy", self.on_destroy)
 
         self.vbox = None
         self.sources_list = None
@@ -93,6 +99,11 @@ class ChannelWindow:
             label.set_property("yalign", 0.5)
             table.attach(label, 2, 3, 1, 2, xoptions=Gtk.AttachOptions.FILL)
 
+            label = Gtk.Label()
+            label.set_property("xalign", 0)
+            self.widgets[uuid]["status"] = label
+            table.attach(label, 0, 3, 2, 3, xoptions=Gtk.AttachOptions.FILL)
+
         button_box = Gtk.HButtonBox()
         vbox.pack_end(button_box, False, False, 0)
 
@@ -103,6 +114,7 @@ class ChannelWindow:
         apply_button = Gtk.Button.new_with_mnemonic('_Принять')
         apply_button.connect("clicked", self.on_apply)
         button_box.add(apply_button)
+        self.apply_button = apply_button
 
         update_button = Gtk.Button.new_with_mnemonic('_Обновить')
         update_button.connect("clicked", self.on_refresh)
@@ -130,15 +142,43 @@ class ChannelWindow:
         self.changes[uuid] = mode
 
     def on_apply(self, widget):
+        """Все источники настраиваются параллельно, окно закрывается,
+        когда сервер подтвердил изменения
+        """
+        if not self.changes:
+            self.gtkwin.destroy()
+            return
+
+        self.failed = False
+        self.apply_button.set_sensitive(False)
         for uuid in self.changes:
             mode = self.changes[uuid]
             value = int(self.widgets[uuid][mode].get_value())
-            self.client_thread.client.set_channel(uuid, mode, value)
+            self.widgets[uuid]["status"].set_text("применение...")
+            self.tasks.submit(lambda result, error, duration, uuid=uuid: self.on_applied(uuid, result, error, duration),
+                              self.client_thread.client.set_channel, uuid, mode, value)
+
+    def on_applied(self, uuid, result, error, duration):
+        if error is None and result is False:
+            error = "нет соединения"
+        if error is None:
+            self.widgets[uuid]["status"].set_text("готово за %.1f с" % duration)
+        else:
+            self.failed = True
+            self.widgets[uuid]["status"].set_text("ошибка: %s" % error)
 
-        self.gtkwin.destroy()
+        if self.tasks.is_busy():
+            return
+        if self.failed:
+            self.apply_button.set_sensitive(True)
+        else:
+            self.gtkwin.destroy()
 
     def on_cancel(self, widget):
         self.gtkwin.destroy()
 
+    def on_destroy(self, window):
+        self.tasks.shutdown()
+
     def on_refresh(self, widget):
         self.init_box()
@@ -1,20 +1,44 @@
 from gi.repository import Gtk
 
+from kismon.background import BackgroundTasks
+
 
 class DatasourcesWindow:
-    def __init__(self, client_thread, parent):
+    def __init__(self, client_thread, parent, tasks=None):
         self.gtkwin = Gtk.Window()
         self.gtkwin.set_transient_for(parent)
         self.gtkwin.set_modal(True)
         self.gtkwin.set_position(Gtk.WindowPosition.CENTER)
         self.gtkwin.set_title("Manage Datasources")
+        self.gtkwin.connect("destroy", self.on_destroy)
 
         self.client_thread = client_thread
+        self.tasks = tasks or BackgroundTasks()
+        self.status = {}
+        self.activating = set()
+        self.available_datasources = []
 
         self.widget = None
         self.init_box()
 
     def init_box(self):
+        """Список интерфейсов запрашивается в фоне, таблица строится по его получении
+        """
+        label = Gtk.Label(label='Loading interfaces...')
+        label.set_property('margin', 20)
+        self.set_widget(label)
+        self.tasks.submit(self.on_datasources_loaded, self.client_thread.client.get_available_datasources)
+
+    def on_datasources_loaded(self, available_datasources, error, duration):
+        if error is not None or available_datasources is False:
+            label = Gtk.Label(label='Could not load the interfaces: %s' % (error or 'not authenticated'))
+            label.set_property('margin', 20)
+            self.set_widget(label)
+            return
+        self.available_datasources = available_datasources
+        self.build_table(available_datasources)
+
+    def build_table(self, available_datasources):
         table = Gtk.Grid()
         table.set_property('margin', 5)
 
@@ -30,7 +54,6 @@ class DatasourcesWindow:
         table.set_column_spacing(10)
         table.set_row_spacing(10)
 
-        available_datasources = self.client_thread.client.get_available_datasources()
         interfaces = [i['kismet.datasource.probed.interface'] for i in available_datasources]
         for interface in available_datasources:
             name = interface['kismet.datasource.probed.interface']
@@ -57,12 +80,12 @@ class DatasourcesWindow:
                     interface['kismet.datasource.type_driver']['kismet.datasource.driver.type'])
                 unsupported = True
             else:
-                status_text = 'inactive'
+                status_text = self.status.get(name, 'inactive')
 
             status_label = Gtk.Label(label=status_text)
             table.attach(status_label, 2, y, 2 if unsupported else 1, 1)
 
-            if not in_use and not unsupported:
+            if not in_use and not unsupported and name not in self.activating:
                 activate_button = Gtk.Button.new_with_mnemonic('_Activate')
                 activate_button.connect("clicked", self.on_activate, interface)
                 table.attach(activate_button, 3, y, 1, 1)
@@ -74,18 +97,36 @@ class DatasourcesWindow:
         refresh_button.set_tooltip_text('Refresh list')
         table.attach(refresh_button, 3, y, 1, 1)
 
+        self.set_widget(table)
+
+    def set_widget(self, widget):
+        if self.gtkwin is None:
+            return
         if self.widget:
             self.gtkwin.remove(self.widget)
 
-        self.gtkwin.add(table)
+        self.gtkwin.add(widget)
         self.gtkwin.show_all()
-        self.widget = table
+        self.widget = widget
 
     def on_activate(self, widget, interface):
-        self.client_thread.client.add_datasource(interface['kismet.datasource.probed.interface'])
+        name = interface['kismet.datasource.probed.interface']
+        self.status[name] = 'activating...'
+        self.activating.add(name)
+        self.build_table(self.available_datasources)
+        self.tasks.submit(lambda result, error, duration: self.on_activated(name, error, duration),
+                          self.client_thread.client.add_datasource, name)
+
+    def on_activated(self, name, error, duration):
+        self.activating.discard(name)
+        if error is None:
+            self.status[name] = 'activated in %.1fs' % duration
+        else:
+            self.status[name] = 'failed: %s' % error
         self.on_refresh()
 
     def on_destroy(self, window=None):
+        self.tasks.shutdown()
         self.gtkwin = None
 
     def on_refresh(self, widget=None):
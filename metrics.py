@@ -0,0 +1,141 @@
+import collections
+import json
+import threading
+import time
+
+# upper bounds of the latency histogram in milliseconds
+LATENCY_BUCKETS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+def get_percentile(values, percent):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+class EndpointMetrics:
+    """Скользящая статистика одной точки API за последние size вызовов
+
+    wall - время запроса и разбора ответа, bytes - принято байт
+    (со сжатием), count - записей в ответе, decode - разбор JSON.
+    """
+    fields = ('wall', 'bytes', 'count', 'decode')
+
+    def __init__(self, size=200):
+        self.samples = collections.deque(maxlen=size)
+        self.calls = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    def record(self, wall, size, count, decode):
+        with self.lock:
+            self.samples.append((wall, size, count, decode))
+            self.calls += 1
+
+    def record_error(self):
+        with self.lock:
+            self.calls += 1
+            self.errors += 1
+
+    def get_summary(self):
+        with self.lock:
+            samples = list(self.samples)
+            summary = {
+                'calls': self.calls,
+                'errors': self.errors,
+                'samples': len(samples),
+            }
+        for pos, field in enumerate(self.fields):
+            values = [sample[pos] for sample in samples]
+            summary[field] = {
+                'mean': sum(values) / len(values) if values else 0,
+                'p50': get_percentile(values, 50),
+                'p95': get_percentile(values, 95),
+                'max': max(values) if values else 0,
+            }
+        histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+        for sample in samples:
+            wall = sample[0] * 1000
+            bucket = 0
+            while bucket < len(LATENCY_BUCKETS) and wall > LATENCY_BUCKETS[bucket]:
+                bucket += 1
+            histogram[bucket] += 1
+        summary['histogram'] = histogram
+        return summary
+
+
+class ClientMetrics:
+    """Статистика всех точек API одного клиента
+    """
+    def __init__(self, size=200):
+        self.size = size
+        self.endpoints = {}
+        self.lock = threading.Lock()
+
+    def get_endpoint(self, name):
+        with self.lock:
+            if name not in self.endpoints:
+                self.endpoints[name] = EndpointMetrics(self.size)
+            return self.endpoints[name]
+
+    def record(self, name, wall, size, count, decode):
+        self.get_endpoint(name).record(wall, size, count, decode)
+
+    def record_error(self, name):
+        self.get_endpoint(name).record_error()
+
+    def get_summary(self):
+        with self.lock:
+            endpoints = dict(self.endpoints)
+        summary = {}
+        for name in endpoints:
+            summary[name] = endpoints[name].get_summary()
+        return summary
+
+    def dump(self, path):
+        data = {
+            'time': time.time(),
+            'latency_buckets_ms': LATENCY_BUCKETS,
+            'endpoints': self.get_summary(),
+        }
+        with open(path, 'w') as f:
+            json.dump(data, f, indent=1)
+
+
+class IngestMeter:
+    """Приём устройств в главном потоке: сколько устройств в секунду
+    обработано и насколько долго был занят цикл GTK за один срез
+    """
+    def __init__(self, window=10):
+        self.window = window
+        self.slices = collections.deque()
+        self.total = 0
+        self.coalesced = 0
+        self.backlog = 0
+
+    def record(self, count, duration, backlog, now=None):
+        if now is None:
+            now = time.monotonic()
+        self.slices.append((now, count, duration))
+        self.total += count
+        self.backlog = backlog
+        while self.slices and self.slices[0][0] < now - self.window:
+            self.slices.popleft()
+
+    def get_summary(self):
+        stalls = [duration for start, count, duration in self.slices]
+        if len(self.slices) > 1:
+            elapsed = max(self.slices[-1][0] - self.slices[0][0], 1)
+        else:
+            elapsed = self.window
+        return {
+            'devices_per_second': sum(count for start, count, duration in self.slices) / elapsed,
+            'stall_p95': get_percentile(stalls, 95),
+            'stall_max': max(stalls) if stalls else 0,
+            'slices': len(stalls),
+            'total': self.total,
+            'coalesced': self.coalesced,
+            'coalesce_ratio': self.coalesced / self.total if self.total else 0.0,
+            'backlog': self.backlog,
+        }
@@ -0,0 +1,126 @@
+import collections
+import threading
+
+OVERFLOW_POLICIES = ('block', 'drop-oldest', 'coalesce')
+
+
+class RingQueue:
+    """Ограниченная очередь: несколько потоков клиента пишут, Core забирает пачками
+
+    Политики переполнения:
+        block - производитель ждёт, пока потребитель освободит место
+        drop-oldest - самая старая запись вытесняется
+        coalesce - записи с одинаковым ключом (MAC) заменяют друг друга,
+                   при переполнении вытесняется самая старая
+    """
+    def __init__(self, maxlen, overflow='drop-oldest', key=None, merge=None):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("unknown overflow policy %s" % overflow)
+        if overflow == 'coalesce' and key is None:
+            raise ValueError("coalesce needs a key function")
+        self.maxlen = maxlen
+        self.overflow = overflow
+        self.key = key
+        self.merge = merge
+        self.items = collections.deque()
+        self.index = {}
+        self.lock = threading.Lock()
+        self.not_full = threading.Condition(self.lock)
+        self.closed = False
+        self.total = 0
+        self.drops = 0
+        self.coalesced = 0
+        self.high_water = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def _put(self, item):
+        self.total += 1
+        if self.overflow == 'coalesce':
+            key = self.key(item)
+            if key in self.index:
+                if self.merge is not None:
+                    item = self.merge(self.index[key], item)
+                self.index[key] = item
+                self.coalesced += 1
+                return
+            if len(self.items) >= self.maxlen:
+                del self.index[self.items.popleft()]
+                self.drops += 1
+            self.items.append(key)
+            self.index[key] = item
+        else:
+            if len(self.items) >= self.maxlen:
+                if self.overflow == 'block':
+                    while len(self.items) >= self.maxlen and not self.closed:
+                        self.not_full.wait()
+                    if self.closed:
+                        self.drops += 1
+                        return
+                else:
+                    self.items.popleft()
+                    self.drops += 1
+            self.items.append(item)
+
+        if len(self.items) > self.high_water:
+            self.high_water = len(self.items)
+
+    def put(self, item):
+        with self.lock:
+            self._put(item)
+
+    def extend(self, items):
+        with self.lock:
+            for item in items:
+                self._put(item)
+
+    # list compatibility for the client code
+    append = put
+
+    def drain(self, max_items=None):
+        """Забрать до max_items записей, O(пачки) а не O(очереди)
+        """
+        with self.lock:
+            if max_items is None or max_items >= len(self.items):
+                count = len(self.items)
+            else:
+                count = max_items
+            popleft = self.items.popleft
+            if self.overflow == 'coalesce':
+                index = self.index
+                batch = [index.pop(popleft()) for x in range(count)]
+            else:
+                batch = [popleft() for x in range(count)]
+            if count > 0 and self.overflow == 'block':
+                self.not_full.notify_all()
+        return batch
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.index.clear()
+            self.not_full.notify_all()
+
+    def open(self):
+        with self.lock:
+            self.closed = False
+
+    def close(self):
+        """Разблокировать ждущих производителей, новые записи отбрасываются
+        """
+        with self.lock:
+            self.closed = True
+            self.not_full.notify_all()
+
+    def get_stats(self):
+        return {
+            'length': len(self.items),
+            'maxlen': self.maxlen,
+            'overflow': self.overflow,
+            'total': self.total,
+            'drops': self.drops,
+            'coalesced': self.coalesced,
+            'coalesce_ratio': self.coalesced / self.total if self.total else 0.0,
+            'high_water': self.high_water,
+        }
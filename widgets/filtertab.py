@@ -1,5 +1,9 @@
+import re
+
 from gi.repository import Gtk
 
+from kismon.client_rest import DeviceFilter
+
 
 class FilterTab:
     def __init__(self, config, networks, networks_queue_progress):
@@ -42,6 +46,9 @@ class FilterTab:
         x += 1
         self.add_regex_filters(main_x=x, main_y=y)
 
+        x += 1
+        self.add_server_filters(main_x=x, main_y=y)
+
     def add_checkbox_list(self, config_key, title, kv, x, y):
         frame = Gtk.Frame()
         frame.set_label(title)
@@ -122,6 +129,63 @@ class FilterTab:
             hbox.pack_end(entry, False, False, 10)
             box.pack_start(hbox, False, False, 0)
 
+    def add_server_filters(self, main_x, main_y):
+        frame = Gtk.Frame()
+        frame.set_label("Фильтр на сервере")
+        frame.set_tooltip_text("Только 802.11 устройства, совпадающие с выражениями, "
+                               "передаются с сервера Kismet. Не зависит от фильтра отображения.")
+        self.grid.attach(frame, main_x, main_y, 1, 1)
+
+        box = Gtk.Box()
+        box.set_property('orientation', Gtk.Orientation.VERTICAL)
+        box.set_property('margin', 5)
+        frame.add(box)
+
+        checkbox = Gtk.CheckButton.new_with_label("Включить")
+        checkbox.set_active(self.config["server_filter"]["enabled"])
+        checkbox.connect('toggled', self.on_server_filter_toggled)
+        box.pack_start(checkbox, False, False, 0)
+
+        self.server_filter_entries = {}
+        for key in ('ssid', 'bssid'):
+            entry = Gtk.Entry()
+            entry.set_width_chars(30)
+            entry.set_text(self.config["server_filter"][key])
+            # every change means a new download from the server, so only on enter or the button
+            entry.connect('activate', self.on_server_filter_apply)
+            self.server_filter_entries[key] = entry
+            label = Gtk.Label(label="%s:" % key.upper())
+            hbox = Gtk.Box()
+            hbox.pack_start(label, False, False, 0)
+            hbox.pack_end(entry, False, False, 10)
+            box.pack_start(hbox, False, False, 0)
+
+        button = Gtk.Button.new_with_label("Применить")
+        button.connect('clicked', self.on_server_filter_apply)
+        box.pack_start(button, False, False, 0)
+
+        self.server_filter_error = Gtk.Label()
+        self.server_filter_error.set_property("xalign", 0)
+        self.server_filter_error.set_line_wrap(True)
+        box.pack_start(self.server_filter_error, False, False, 0)
+
+    def on_server_filter_toggled(self, widget):
+        self.config["server_filter"]["enabled"] = widget.get_active()
+
+    def on_server_filter_apply(self, widget):
+        ssid = self.server_filter_entries['ssid'].get_text()
+        bssid = self.server_filter_entries['bssid'].get_text()
+        try:
+            DeviceFilter(ssid, bssid)
+        except re.error as e:
+            # the clients keep the last valid filter
+            self.server_filter_error.set_text("Неверное выражение: %s" % e)
+            return
+        self.server_filter_error.set_text("")
+        # the clients read the config on every poll
+        self.config["server_filter"]["ssid"] = ssid
+        self.config["server_filter"]["bssid"] = bssid
+
     def apply(self):
         self.networks.apply_filters()
         self.networks_queue_progress()